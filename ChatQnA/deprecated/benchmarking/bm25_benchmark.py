@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: Apache-2.0
+
+#
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "langchain", "docker", "qna-app", "app"))
+
+from bm25 import BM25Index  # noqa: E402
+
+
+def build_corpus(rng, num_chunks, vocabulary_size, chunk_words):
+    """Chunks of words drawn from a Zipf distribution, with a part number in one chunk out of ten."""
+    vocabulary = np.array([f"word{i}" for i in range(vocabulary_size)])
+    ranks = np.minimum(rng.zipf(1.2, size=num_chunks * chunk_words), vocabulary_size) - 1
+    words = vocabulary[ranks].reshape(num_chunks, chunk_words)
+    texts = []
+    for i, row in enumerate(words):
+        text = " ".join(row)
+        if i % 10 == 0:
+            text += f" part number x{i % 5000:04d}-{i % 97:02d}b"
+        texts.append(text)
+    return texts
+
+
+def main(args):
+    rng = np.random.default_rng(0)
+    start = time.perf_counter()
+    texts = build_corpus(rng, args.chunks, args.vocabulary, args.words)
+    print(f"Generated {args.chunks} chunks of {args.words} words in {time.perf_counter() - start:.1f}s")
+
+    index = BM25Index()
+    start = time.perf_counter()
+    for i in range(0, args.chunks, args.batch):
+        index.add([f"chunk{j}" for j in range(i, min(i + args.batch, args.chunks))], texts[i : i + args.batch])
+    print(f"Indexed in {time.perf_counter() - start:.1f}s, {len(index.postings)} postings, {len(index.terms)} terms")
+
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "bm25.npz")
+        start = time.perf_counter()
+        index.save(path)
+        print(f"Saved in {time.perf_counter() - start:.2f}s, {os.path.getsize(path) / 1e6:.1f}MB")
+        start = time.perf_counter()
+        index = BM25Index.load(path)
+        index._prepare()
+        print(f"Loaded and prepared in {time.perf_counter() - start:.2f}s")
+
+    queries = {
+        "part number": [f"x{rng.integers(5000):04d}-{rng.integers(97):02d}b" for _ in range(args.queries)],
+        "rare words": [f"word{rng.integers(1000, 5000)} word{rng.integers(1000, 5000)}" for _ in range(args.queries)],
+        "common words": [f"word{rng.integers(0, 20)} word{rng.integers(20, 200)}" for _ in range(args.queries)],
+        "mixed": [f"word{rng.integers(0, 20)} part x{rng.integers(5000):04d}" for _ in range(args.queries)],
+    }
+    print(f"{'queries':>14} {'p50 ms':>8} {'p99 ms':>8}")
+    for name, batch in queries.items():
+        latencies = []
+        for query in batch:
+            start = time.perf_counter()
+            index.search(query, args.k)
+            latencies.append((time.perf_counter() - start) * 1000)
+        print(f"{name:>14} {np.percentile(latencies, 50):>8.3f} {np.percentile(latencies, 99):>8.3f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure the BM25 index build time and query latency")
+    parser.add_argument("--chunks", type=int, default=300000, help="Number of chunks")
+    parser.add_argument("--words", type=int, default=100, help="Words per chunk")
+    parser.add_argument("--vocabulary", type=int, default=100000, help="Number of distinct words")
+    parser.add_argument("--batch", type=int, default=50000, help="Chunks indexed per ingestion")
+    parser.add_argument("--queries", type=int, default=200, help="Queries per kind")
+    parser.add_argument("--k", type=int, default=20, help="Chunks returned per query")
+    args = parser.parse_args()
+    main(args)
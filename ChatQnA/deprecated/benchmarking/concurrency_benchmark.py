@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: Apache-2.0
+
+#
+
+import argparse
+import concurrent.futures
+import statistics
+import time
+
+import requests
+
+
+def send_request(url, query, knowledge_base_id):
+    """Send one streaming chat request, return (time to first token, total latency) in seconds."""
+    payload = {"query": query, "knowledge_base_id": knowledge_base_id}
+    start = time.perf_counter()
+    first_token = None
+    with requests.post(url, json=payload, stream=True) as response:
+        response.raise_for_status()
+        for line in response.iter_lines():
+            if line and first_token is None:
+                first_token = time.perf_counter() - start
+    return first_token or 0.0, time.perf_counter() - start
+
+
+def run_level(url, query, knowledge_base_id, concurrency, requests_per_worker):
+    total = concurrency * requests_per_worker
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [executor.submit(send_request, url, query, knowledge_base_id) for _ in range(total)]
+        results = [future.result() for future in futures]
+    elapsed = time.perf_counter() - start
+    ttft = sorted(result[0] for result in results)
+    latency = sorted(result[1] for result in results)
+    return {
+        "concurrency": concurrency,
+        "requests": total,
+        "throughput": total / elapsed,
+        "ttft_p50": statistics.median(ttft),
+        "ttft_p90": ttft[int(len(ttft) * 0.9) - 1] if len(ttft) >= 10 else ttft[-1],
+        "latency_p50": statistics.median(latency),
+    }
+
+
+def main(args):
+    levels = [int(level) for level in args.concurrency.split(",")]
+    print(f"Benchmarking {args.url} with concurrency levels {levels}")
+    print(f"{'concurrency':>11} {'requests':>8} {'req/s':>8} {'scaling':>8} {'ttft p50':>9} {'ttft p90':>9} {'p50':>8}")
+    baseline = None
+    for level in levels:
+        result = run_level(args.url, args.query, args.knowledge_base_id, level, args.requests_per_worker)
+        baseline = baseline or result["throughput"]
+        print(
+            f"{result['concurrency']:>11} {result['requests']:>8} {result['throughput']:>8.2f} "
+            f"{result['throughput'] / baseline:>7.2f}x {result['ttft_p50']:>8.3f}s {result['ttft_p90']:>8.3f}s "
+            f"{result['latency_p50']:>7.3f}s"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure how chat_stream throughput scales with in-flight requests")
+    parser.add_argument("--url", type=str, default="http://localhost:8000/v1/rag/chat_stream", help="Streaming URL")
+    parser.add_argument("--query", type=str, default="What is the total revenue of Nike in 2023?", help="Query")
+    parser.add_argument("--knowledge_base_id", type=str, default="default", help="Knowledge base to query")
+    parser.add_argument("--concurrency", type=str, default="1,2,4,8,16,32", help="Comma separated levels")
+    parser.add_argument("--requests_per_worker", type=int, default=4, help="Requests sent per concurrent worker")
+    args = parser.parse_args()
+    main(args)
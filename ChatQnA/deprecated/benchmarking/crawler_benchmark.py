@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: Apache-2.0
+
+#
+
+import argparse
+import collections
+import contextlib
+import functools
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, urlunparse
+
+import requests
+from bs4 import BeautifulSoup
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "langchain", "docker", "qna-app", "app"))
+
+from crawler import crawl  # noqa: E402
+
+
+class LegacyCrawler:
+    """The multiprocess crawler of utils.py before the asyncio crawler, kept as the baseline."""
+
+    def __init__(self, pool=None):
+        if pool:
+            assert isinstance(pool, (str, list, tuple)), "url pool should be str, list or tuple"
+        self.pool = pool
+        self.headers = {
+            "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng, \
+            */*;q=0.8,application/signed-exchange;v=b3;q=0.7",
+            "Accept-Encoding": "gzip, deflate, br",
+            "Accept-Language": "en-US,en;q=0.9,zh-CN;q=0.8,zh;q=0.7",
+            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, \
+            like Gecko) Chrome/113.0.0.0 Safari/537.36",
+        }
+        self.fetched_pool = set()
+
+    def get_hyperlink(self, soup, base_url):
+        sublinks = []
+        for links in soup.find_all("a"):
+            link = str(links.get("href"))
+            if link.startswith("#") or link is None or link == "None":
+                continue
+            suffix = link.split("/")[-1]
+            if "." in suffix and suffix.split(".")[-1] not in ["html", "htmld"]:
+                continue
+            link_parse = urlparse(link)
+            base_url_parse = urlparse(base_url)
+            if link_parse.path == "":
+                continue
+            if link_parse.netloc != "":
+                # keep crawler works in the same domain
+                if link_parse.netloc != base_url_parse.netloc:
+                    continue
+                sublinks.append(link)
+            else:
+                sublinks.append(
+                    urlunparse(
+                        (
+                            base_url_parse.scheme,
+                            base_url_parse.netloc,
+                            link_parse.path,
+                            link_parse.params,
+                            link_parse.query,
+                            link_parse.fragment,
+                        )
+                    )
+                )
+        return sublinks
+
+    def fetch(self, url, headers=None, max_times=5):
+        if not headers:
+            headers = self.headers
+        while max_times:
+            if not url.startswith("http://") and not url.startswith("https://"):
+                url = "http://" + url
+            print("start fetch %s...", url)
+            try:
+                response = requests.get(url, headers=headers, verify=True)
+                if response.status_code != 200:
+                    print("fail to fetch %s, response status code: %s", url, response.status_code)
+                else:
+                    return response
+            except Exception as e:
+                print("fail to fetch %s, caused by %s", url, e)
+                raise Exception(e)
+            max_times -= 1
+        return None
+
+    def process_work(self, sub_url, work):
+        response = self.fetch(sub_url)
+        if response is None:
+            return []
+        self.fetched_pool.add(sub_url)
+        soup = self.parse(response.text)
+        base_url = self.get_base_url(sub_url)
+        sublinks = self.get_hyperlink(soup, base_url)
+        if work:
+            work(sub_url, soup)
+        return sublinks
+
+    def crawl(self, pool, work=None, max_depth=10, workers=10):
+        url_pool = set()
+        for url in pool:
+            base_url = self.get_base_url(url)
+            response = self.fetch(url)
+            soup = self.parse(response.text)
+            sublinks = self.get_hyperlink(soup, base_url)
+            self.fetched_pool.add(url)
+            url_pool.update(sublinks)
+            depth = 0
+            while len(url_pool) > 0 and depth < max_depth:
+                print("current depth %s...", depth)
+                mp = multiprocessing.Pool(processes=workers)
+                results = []
+                for sub_url in url_pool:
+                    if sub_url not in self.fetched_pool:
+                        results.append(mp.apply_async(self.process_work, (sub_url, work)))
+                mp.close()
+                mp.join()
+                url_pool = set()
+                for result in results:
+                    sublinks = result.get()
+                    url_pool.update(sublinks)
+                depth += 1
+
+    def parse(self, html_doc):
+        soup = BeautifulSoup(html_doc, "lxml")
+        return soup
+
+    def get_base_url(self, url):
+        result = urlparse(url)
+        return urlunparse((result.scheme, result.netloc, "", "", "", ""))
+
+
+def build_site(root, fanout, depth):
+    """Write a site tree where every page links to its children and back to its parent."""
+    paths = ["/index.html"]
+    level = ["/index.html"]
+    children = {}
+    for d in range(depth):
+        next_level = []
+        for parent in level:
+            children[parent] = [f"/d{d + 1}/{len(next_level) + i}.html" for i in range(fanout)]
+            next_level += children[parent]
+        paths += next_level
+        level = next_level
+    parents = {child: parent for parent, kids in children.items() for child in kids}
+    os.makedirs(root, exist_ok=True)
+    for path in paths:
+        os.makedirs(os.path.dirname(root + path), exist_ok=True)
+        links = "".join(f'<li><a href="{link}">{link}</a></li>' for link in children.get(path, []))
+        if path in parents:
+            links += f'<li><a href="{parents[path]}">parent</a></li>'
+        body = f"<p>{'Lorem ipsum dolor sit amet. ' * 100}</p>"
+        with open(root + path, "w") as f:
+            f.write(f'<html><body><div class="main"><h1>{path}</h1>{body}</div><ul>{links}</ul></body></html>')
+    return len(paths)
+
+
+class CountingHandler(SimpleHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    counter = collections.Counter()
+
+    def do_GET(self):
+        self.counter[self.path] += 1
+        super().do_GET()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def run(name, fn):
+    CountingHandler.counter.clear()
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+    requests = sum(CountingHandler.counter.values())
+    pages = len(CountingHandler.counter)
+    print(f"{name:>14} {pages:>8} {requests:>9} {elapsed:>8.2f}s {pages / elapsed:>10.1f}")
+    return pages / elapsed
+
+
+def main(args):
+    with tempfile.TemporaryDirectory() as site:
+        num_pages = build_site(site, args.fanout, args.depth)
+        handler = functools.partial(CountingHandler, directory=site)
+        server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        seed = f"http://127.0.0.1:{server.server_address[1]}/index.html"
+        print(f"Crawling a local site of {num_pages} pages, fanout {args.fanout}, depth {args.depth}")
+        print(f"{'crawler':>14} {'pages':>8} {'requests':>9} {'time':>9} {'pages/s':>10}")
+
+        def legacy():
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                LegacyCrawler().crawl([seed], max_depth=args.depth, workers=args.workers)
+
+        def asyncio_crawler():
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                crawl(
+                    [seed],
+                    work=lambda page: None,
+                    max_depth=args.depth,
+                    max_pages=num_pages,
+                    max_connections=args.connections,
+                    per_host=args.connections,
+                )
+
+        baseline = run("multiprocess", legacy) if not args.skip_legacy else None
+        speed = run("asyncio", asyncio_crawler)
+        if baseline:
+            print(f"speedup: {speed / baseline:.2f}x")
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the crawlers on a local http.server site tree")
+    parser.add_argument("--fanout", type=int, default=7, help="Links to child pages per page")
+    parser.add_argument("--depth", type=int, default=4, help="Depth of the site tree and of the crawl")
+    parser.add_argument("--workers", type=int, default=10, help="Processes of the multiprocess crawler")
+    parser.add_argument("--connections", type=int, default=32, help="Connections of the asyncio crawler")
+    parser.add_argument("--skip_legacy", action="store_true", help="Only run the asyncio crawler")
+    args = parser.parse_args()
+    main(args)
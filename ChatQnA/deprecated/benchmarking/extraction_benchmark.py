@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: Apache-2.0
+
+#
+
+import argparse
+import os
+import random
+import re
+import sys
+import time
+import unicodedata
+
+from bs4 import BeautifulSoup
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "langchain", "docker", "qna-app", "app"))
+
+from utils import extract_main_content, html_tree  # noqa: E402
+
+WORDS = ["intel", "gaudi", "xeon", "retrieval", "augmented", "generation", "café", "naïve", "Ångström", "模型", "the"]
+
+
+def baseline_clean_text(text):
+    text = text.strip().replace("\r", "\n")
+    text = re.sub(" +", " ", text)
+    text = re.sub("\n+", "\n", text)
+    text = text.split("\n")
+    return "\n".join([i for i in text if i and i != " "])
+
+
+def baseline_uni_pro(text):
+    normalized_text = unicodedata.normalize("NFKD", text)
+    filtered_text = ""
+    for char in normalized_text:
+        if ord(char) < 128 or unicodedata.category(char) == "Mn":
+            filtered_text += char
+    return filtered_text
+
+
+def baseline_extract(html):
+    """The extraction of load_html_data before the lxml engine, kept as a reference."""
+    soup = BeautifulSoup(html, "lxml")
+    main_content = ""
+    for element_name in ["main", "container"]:
+        main_block = None
+        if soup.select(f".{element_name}"):
+            main_block = soup.select(f".{element_name}")
+        elif soup.select(f"#{element_name}"):
+            main_block = soup.select(f"#{element_name}")
+        if main_block:
+            for element in main_block:
+                text = baseline_clean_text(element.text)
+                if text not in main_content:
+                    main_content += f"\n{text}"
+            main_content = baseline_clean_text(main_content)
+    main_content = main_content.replace("\n", "")
+    main_content = baseline_uni_pro(main_content)
+    return re.sub(r"\s+", " ", main_content)
+
+
+def build_page(rng, num_blocks, paragraphs):
+    """A documentation-like page: navigation, many main blocks, scripts and a footer."""
+    blocks = []
+    for i in range(num_blocks):
+        text = "".join(
+            f"<p>{' '.join(rng.choice(WORDS) for _ in range(40))} {i}-{j}.</p>\n  " for j in range(paragraphs)
+        )
+        blocks.append(f'<div class="main section"><h2>Section {i}</h2>\n  {text}<script>var x = {i};</script></div>')
+    nav = "".join(f'<li><a href="/page{i}.html">Page {i}</a></li>' for i in range(200))
+    return (
+        f"<html><head><title>Docs</title><style>.main {{ color: red; }}</style></head><body><ul>{nav}</ul>"
+        f'<div class="container">{"".join(blocks)}</div><footer>Copyright</footer></body></html>'
+    )
+
+
+def measure(name, fn, pages, size):
+    start = time.perf_counter()
+    results = [fn(page) for page in pages]
+    elapsed = time.perf_counter() - start
+    print(f"{name:>22} {elapsed:>8.2f}s {size / elapsed / 1e6:>8.2f}")
+    return results
+
+
+def main(args):
+    rng = random.Random(0)
+    pages = [build_page(rng, args.blocks, args.paragraphs) for _ in range(args.pages)]
+    size = sum(len(page.encode("utf-8")) for page in pages)
+    print(f"Extracting {args.pages} pages, {size / args.pages / 1e6:.2f}MB each")
+    print(f"{'extraction':>22} {'time':>9} {'MB/s':>8}")
+    baseline = measure("baseline (bs4)", baseline_extract, pages, size) if not args.skip_baseline else None
+    results = measure("lxml parse + extract", lambda page: extract_main_content(html_tree(page)), pages, size)
+    trees = [html_tree(page) for page in pages]
+    measure("lxml extract only", extract_main_content, trees, size)
+    if baseline:
+        print(f"identical output: {sum(a == b for a, b in zip(baseline, results))}/{len(pages)} pages")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure the throughput of the HTML to text extraction")
+    parser.add_argument("--pages", type=int, default=5, help="Number of pages")
+    parser.add_argument("--blocks", type=int, default=1000, help="Main blocks per page")
+    parser.add_argument("--paragraphs", type=int, default=3, help="Paragraphs per block")
+    parser.add_argument("--skip_baseline", action="store_true", help="Do not run the previous implementation")
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: Apache-2.0
+
+#
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+from langchain_community.vectorstores.utils import maximal_marginal_relevance as baseline_mmr
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "langchain", "docker", "qna-app", "app"))
+
+from mmr import maximal_marginal_relevance  # noqa: E402
+
+
+def measure(fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = fn()
+    return (time.perf_counter() - start) / repeat * 1000, result
+
+
+def main(args):
+    rng = np.random.default_rng(0)
+    print(f"MMR selection of k={args.k} chunks, dimension {args.dim}, lambda_mult={args.lambda_mult}")
+    print(f"{'fetch_k':>8} {'baseline ms':>12} {'vectorized ms':>14} {'speedup':>8} {'same':>5}")
+    for fetch_k in [int(n) for n in args.fetch_k.split(",")]:
+        query = rng.normal(size=args.dim).astype(np.float32)
+        candidates = rng.normal(size=(fetch_k, args.dim)).astype(np.float32)
+        baseline_ms, expected = measure(
+            lambda: baseline_mmr(query, list(candidates), args.lambda_mult, args.k), args.repeat
+        )
+        vectorized_ms, selected = measure(
+            lambda: maximal_marginal_relevance(query, candidates, args.k, args.lambda_mult), args.repeat
+        )
+        print(
+            f"{fetch_k:>8} {baseline_ms:>12.3f} {vectorized_ms:>14.3f} {baseline_ms / vectorized_ms:>7.1f}x "
+            f"{str(expected == selected):>5}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure the cost of the MMR selection as fetch_k grows")
+    parser.add_argument("--fetch_k", type=str, default="20,50,100,200,500,1000", help="Comma separated fetch_k")
+    parser.add_argument("--k", type=int, default=4, help="Number of selected chunks")
+    parser.add_argument("--dim", type=int, default=768, help="Dimension of the embeddings")
+    parser.add_argument("--lambda_mult", type=float, default=0.5, help="Relevance to diversity trade-off")
+    parser.add_argument("--repeat", type=int, default=20, help="Selections per measure")
+    args = parser.parse_args()
+    main(args)
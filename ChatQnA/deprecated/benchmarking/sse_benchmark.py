@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: Apache-2.0
+
+#
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "langchain", "docker", "qna-app", "app"))
+
+from sse import SSEEncoder  # noqa: E402
+
+
+async def token_stream(num_tokens, token_interval):
+    """Synthetic LLM output, one short word every `token_interval` seconds."""
+    for i in range(num_tokens):
+        yield f" tok{i}"
+        await asyncio.sleep(token_interval)
+
+
+async def send_stream(port, num_tokens, token_interval, flush_interval):
+    """Send one encoded stream to the sink, return the number of frames written."""
+    _, writer = await asyncio.open_connection("127.0.0.1", port)
+    frames = 0
+    encoder = SSEEncoder(flush_interval=flush_interval)
+    async for frame in encoder.aencode(token_stream(num_tokens, token_interval)):
+        writer.write(frame.encode("utf-8"))
+        await writer.drain()
+        frames += 1
+    writer.close()
+    await writer.wait_closed()
+    return frames
+
+
+async def run(streams, num_tokens, token_interval, flush_interval):
+    async def sink(reader, writer):
+        while await reader.read(65536):
+            pass
+        writer.close()
+
+    server = await asyncio.start_server(sink, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    cpu_start, start = time.process_time(), time.perf_counter()
+    frames = await asyncio.gather(
+        *[send_stream(port, num_tokens, token_interval, flush_interval) for _ in range(streams)]
+    )
+    elapsed, cpu = time.perf_counter() - start, time.process_time() - cpu_start
+    server.close()
+    await server.wait_closed()
+    tokens = streams * num_tokens
+    return {
+        "frames": sum(frames),
+        "frames_per_sec": sum(frames) / elapsed,
+        "tokens_per_frame": tokens / sum(frames),
+        "cpu_us_per_token": cpu / tokens * 1e6,
+    }
+
+
+def main(args):
+    print(
+        f"Streaming {args.streams} concurrent answers of {args.num_tokens} tokens, "
+        f"one token every {args.token_interval * 1000:.1f}ms"
+    )
+    print(f"{'flush':>8} {'frames':>8} {'frames/s':>9} {'tokens/frame':>12} {'cpu us/token':>12}")
+    for flush_ms in [float(value) for value in args.flush_interval_ms.split(",")]:
+        result = asyncio.run(run(args.streams, args.num_tokens, args.token_interval, flush_ms / 1000))
+        print(
+            f"{flush_ms:>6.0f}ms {result['frames']:>8} {result['frames_per_sec']:>9.0f} "
+            f"{result['tokens_per_frame']:>12.2f} {result['cpu_us_per_token']:>12.1f}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare per-token and coalesced SSE framing")
+    parser.add_argument("--streams", type=int, default=200, help="Number of concurrent streams")
+    parser.add_argument("--num_tokens", type=int, default=256, help="Tokens per stream")
+    parser.add_argument("--token_interval", type=float, default=0.002, help="Seconds between two tokens")
+    parser.add_argument("--flush_interval_ms", type=str, default="0,20", help="Comma separated flush intervals")
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,315 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: Apache-2.0
+
+#
+
+import fcntl
+import json
+import os
+import re
+import tempfile
+import threading
+import unicodedata
+from collections import Counter
+from contextlib import contextmanager
+from typing import List
+
+import numpy as np
+
+INDEX_FILE = "bm25.npz"
+# The changes of an index are appended to DELTA_FILE, and merged into INDEX_FILE once the delta file is
+# larger than half of the index file and than BM25_MERGE_BYTES bytes.
+DELTA_FILE = "bm25.delta.jsonl"
+MERGE_BYTES = int(os.getenv("BM25_MERGE_BYTES", 1 << 20))
+# Postings scored per query term at most, see `BM25Index.search`
+MAX_POSTINGS = int(os.getenv("BM25_MAX_POSTINGS", 10000))
+
+_CJK = "぀-ヿ㐀-䶿一-鿿가-힯"
+# CJK characters are indexed one by one, other words are kept whole with their inner dashes and dots,
+# so that part numbers and versions such as "i7-12700k" or "10.2.1" can be matched exactly.
+_TOKEN = re.compile(rf"[{_CJK}]|[^\W{_CJK}]+(?:[-.][^\W{_CJK}]+)*")
+_SEPARATORS = re.compile(r"[-.]")
+STOPWORDS = frozenset(
+    "a an and are as at be but by for from has have in is it its of on or that the this to was were will with".split()
+)
+
+
+def tokenize(text: str) -> List[str]:
+    """The terms of a text: lowercased words, and the parts of the words joined by dashes or dots."""
+    terms = []
+    for token in _TOKEN.findall(unicodedata.normalize("NFKC", text).lower()):
+        if token in STOPWORDS:
+            continue
+        terms.append(token)
+        if len(token) > 1 and _SEPARATORS.search(token):
+            terms.extend(part for part in _SEPARATORS.split(token) if part and part not in STOPWORDS)
+    return terms
+
+
+class BM25Index:
+    """An in-memory inverted index of the chunks of a knowledge base, scored with BM25.
+
+    The postings are kept as flat NumPy arrays sorted by term, with the BM25 term frequency
+    component of every posting precomputed, so a query only sums the precomputed weights of
+    the postings of its terms into a dense score array. Removed chunks are masked until the
+    index is compacted, when it is saved with more than a quarter of its chunks removed.
+    """
+
+    def __init__(self, k1: float = 1.2, b: float = 0.75, max_postings: int = MAX_POSTINGS):
+        self.k1 = k1
+        self.b = b
+        self.max_postings = max_postings
+        self.ids = np.empty(0, dtype=object)
+        self.lengths = np.empty(0, dtype=np.int32)
+        self.live = np.empty(0, dtype=bool)
+        self.terms = []
+        self.vocabulary = {}
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.postings = np.empty(0, dtype=np.int32)
+        self.frequencies = np.empty(0, dtype=np.uint16)
+        self._positions = {}
+        self._weights = None
+
+    def __len__(self):
+        return int(self.live.sum())
+
+    def add(self, ids: List[str], texts: List[str]):
+        """Index the chunks `texts` with their `ids`, a chunk with the id of an indexed chunk replaces it."""
+        self.remove(ids)
+        base = len(self.ids)
+        new_terms, new_docs, new_frequencies, lengths = [], [], [], []
+        for doc, text in enumerate(texts, base):
+            counts = Counter(tokenize(text))
+            lengths.append(sum(counts.values()))
+            for term, frequency in counts.items():
+                term_id = self.vocabulary.get(term)
+                if term_id is None:
+                    term_id = self.vocabulary[term] = len(self.terms)
+                    self.terms.append(term)
+                new_terms.append(term_id)
+                new_docs.append(doc)
+                new_frequencies.append(min(frequency, np.iinfo(np.uint16).max))
+        # the postings of all the terms, merged and sorted by term then by chunk
+        old_terms = np.repeat(np.arange(len(self.offsets) - 1, dtype=np.int32), np.diff(self.offsets))
+        all_terms = np.concatenate([old_terms, np.asarray(new_terms, dtype=np.int32)])
+        order = np.argsort(all_terms, kind="stable")
+        self.postings = np.concatenate([self.postings, np.asarray(new_docs, dtype=np.int32)])[order]
+        self.frequencies = np.concatenate([self.frequencies, np.asarray(new_frequencies, dtype=np.uint16)])[order]
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(all_terms, minlength=len(self.terms)))])
+        self.ids = np.concatenate([self.ids, np.asarray(ids, dtype=object)])
+        self.lengths = np.concatenate([self.lengths, np.asarray(lengths, dtype=np.int32)])
+        self.live = np.concatenate([self.live, np.ones(len(ids), dtype=bool)])
+        self._positions.update((chunk_id, doc) for doc, chunk_id in enumerate(ids, base))
+        self._weights = None
+        return self
+
+    def remove(self, ids: List[str]):
+        """Remove the chunks with `ids`, returns the number of removed chunks."""
+        removed = [self._positions.pop(chunk_id) for chunk_id in ids if chunk_id in self._positions]
+        self.live[removed] = False
+        if removed:
+            self._weights = None
+        return len(removed)
+
+    def compact(self):
+        """Drop the postings of the removed chunks."""
+        keep = self.live[self.postings]
+        renumber = np.cumsum(self.live, dtype=np.int64) - 1
+        counts = np.bincount(
+            np.repeat(np.arange(len(self.offsets) - 1), np.diff(self.offsets))[keep], minlength=len(self.terms)
+        )
+        self.postings = renumber[self.postings[keep]].astype(np.int32)
+        self.frequencies = self.frequencies[keep]
+        self.offsets = np.concatenate([[0], np.cumsum(counts)])
+        self.ids, self.lengths = self.ids[self.live], self.lengths[self.live]
+        self.live = np.ones(len(self.ids), dtype=bool)
+        self._positions = {chunk_id: doc for doc, chunk_id in enumerate(self.ids)}
+        self._weights = None
+
+    def _prepare(self):
+        """Precompute the BM25 weights of the postings, and sort the postings of every term by weight."""
+        if self._weights is None:
+            lengths = self.lengths[self.live]
+            average_length = lengths.mean() if len(lengths) else 1.0
+            norms = self.k1 * (1 - self.b + self.b * self.lengths / max(average_length, 1e-9))
+            frequencies = self.frequencies.astype(np.float32)
+            weights = frequencies * (self.k1 + 1) / (frequencies + norms[self.postings])
+            live = self.live[self.postings]
+            # the postings of the removed chunks never score
+            weights = np.where(live, weights, 0).astype(np.float32)
+            posting_terms = np.repeat(np.arange(len(self.terms), dtype=np.int32), np.diff(self.offsets))
+            order = np.lexsort((-weights, posting_terms))
+            self._sorted_postings, self._weights = self.postings[order], weights[order]
+            frequency = np.bincount(posting_terms[live], minlength=len(self.terms))
+            count = len(lengths)
+            self._idf = np.log(1 + (count - frequency + 0.5) / (frequency + 0.5)).astype(np.float32)
+
+    def search(self, query: str, k: int = 20):
+        """The ids of the `k` chunks with the highest BM25 score for `query`, with their score, best first.
+
+        Only the `max_postings` postings with the highest weight of every term are scored, which
+        bounds the cost of the terms found in most chunks, whose weight in the score is the lowest.
+        """
+        self._prepare()
+        term_ids = [self.vocabulary[term] for term in set(tokenize(query)) if term in self.vocabulary]
+        if not term_ids or k <= 0:
+            return []
+        scores = np.zeros(len(self.ids), dtype=np.float32)
+        candidates = []
+        for term_id in term_ids:
+            start = self.offsets[term_id]
+            end = min(self.offsets[term_id + 1], start + self.max_postings)
+            # a chunk appears once in the postings of a term
+            docs = self._sorted_postings[start:end]
+            scores[docs] += self._weights[start:end] * self._idf[term_id]
+            candidates.append(docs)
+        candidates = np.concatenate(candidates)
+        # a chunk is at most once in the candidates of every term
+        limit = k * len(term_ids)
+        if len(candidates) > limit:
+            candidates = candidates[np.argpartition(-scores[candidates], limit - 1)[:limit]]
+        candidates = np.unique(candidates)
+        candidates = candidates[scores[candidates] > 0]
+        top = candidates[np.argsort(-scores[candidates], kind="stable")][:k]
+        return [(self.ids[doc], float(scores[doc])) for doc in top]
+
+    def save(self, path: str):
+        """Write the index to `path` atomically, compacting it first if a quarter of its chunks were removed."""
+        if len(self.live) and np.count_nonzero(~self.live) * 4 > len(self.live):
+            self.compact()
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".npz")
+        with os.fdopen(fd, "wb") as f:
+            np.savez(
+                f,
+                params=np.array([self.k1, self.b]),
+                ids=self.ids.astype(str),
+                lengths=self.lengths,
+                live=self.live,
+                terms=np.array(self.terms, dtype=str),
+                offsets=self.offsets,
+                postings=self.postings,
+                frequencies=self.frequencies,
+            )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str):
+        with np.load(path) as data:
+            k1, b = data["params"].tolist()
+            index = cls(k1, b)
+            index.ids = data["ids"].astype(object)
+            index.lengths, index.live = data["lengths"], data["live"]
+            index.terms = data["terms"].tolist()
+            index.offsets, index.postings, index.frequencies = data["offsets"], data["postings"], data["frequencies"]
+        index.vocabulary = {term: term_id for term_id, term in enumerate(index.terms)}
+        index._positions = {chunk_id: doc for doc, chunk_id in enumerate(index.ids) if index.live[doc]}
+        return index
+
+
+_loaded = {}
+_loaded_lock = threading.Lock()
+
+
+def _read_delta(persist_dir: str):
+    """The net changes of the delta file, a dict of chunk id to text or to None once removed, and the bytes read.
+
+    A change being appended by another process is read once it is complete.
+    """
+    try:
+        with open(os.path.join(persist_dir, DELTA_FILE), "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return {}, 0
+    data = data[: data.rfind(b"\n") + 1]
+    changes = {}
+    for line in data.splitlines():
+        change = json.loads(line)
+        changes.update((chunk_id, None) for chunk_id in change["removed"])
+        changes.update(change["added"])
+    return changes, len(data)
+
+
+def _apply(index: BM25Index, changes: dict):
+    index.remove([chunk_id for chunk_id, text in changes.items() if text is None])
+    added = {chunk_id: text for chunk_id, text in changes.items() if text is not None}
+    if added:
+        index.add(list(added.keys()), list(added.values()))
+    return index
+
+
+def _stat(path: str):
+    try:
+        return os.stat(path)
+    except FileNotFoundError:
+        return None
+
+
+def load_index(persist_dir: str):
+    """The BM25 index of a knowledge base, with the changes of its delta file, loaded again when they changed.
+
+    None if the knowledge base has no index.
+    """
+    path = os.path.join(persist_dir, INDEX_FILE)
+    index_stat, delta_stat = _stat(path), _stat(os.path.join(persist_dir, DELTA_FILE))
+    if index_stat is None and delta_stat is None:
+        # the knowledge base was deleted
+        with _loaded_lock:
+            _loaded.pop(path, None)
+        return None
+    mtime = index_stat.st_mtime_ns if index_stat is not None else None
+    with _loaded_lock:
+        if path in _loaded and _loaded[path][0] == (mtime, delta_stat.st_size if delta_stat is not None else 0):
+            return _loaded[path][1]
+    changes, read = _read_delta(persist_dir)
+    index = _apply(BM25Index.load(path) if index_stat is not None else BM25Index(), changes)
+    index._prepare()
+    with _loaded_lock:
+        _loaded[path] = ((mtime, read), index)
+    return index
+
+
+@contextmanager
+def _index_lock(persist_dir: str):
+    # the index of a knowledge base is updated by the ingestion jobs of all the worker processes
+    with open(os.path.join(persist_dir, INDEX_FILE + ".lock"), "w") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def update_index(persist_dir: str, added: dict = None, removed: List[str] = ()):
+    """Index the `added` chunks, a dict of chunk id to text, and remove the `removed` chunk ids.
+
+    The change is appended to the delta file, so its cost does not depend on the size of the
+    index, and the delta file is merged into the index file once it is large enough.
+    """
+    added, removed = added or {}, list(removed)
+    if not added and not removed:
+        return
+    path = os.path.join(persist_dir, INDEX_FILE)
+    delta_path = os.path.join(persist_dir, DELTA_FILE)
+    with _index_lock(persist_dir):
+        with open(delta_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps({"added": added, "removed": removed}, ensure_ascii=False) + "\n")
+        delta_size = os.path.getsize(delta_path)
+        if delta_size > max(MERGE_BYTES, (os.path.getsize(path) if os.path.exists(path) else 0) // 2):
+            changes, _ = _read_delta(persist_dir)
+            index = _apply(BM25Index.load(path) if os.path.exists(path) else BM25Index(), changes)
+            index.save(path)
+            # a reader may apply the changes again to the merged index, which leaves it unchanged
+            os.remove(delta_path)
+            print(f"[rag - bm25] {delta_size} bytes of changes merged, {len(index)} chunks in {path}")
+    print(f"[rag - bm25] {len(added)} chunks indexed, {len(removed)} removed in {persist_dir}")
+
+
+def reciprocal_rank_fusion(rankings: List[List[str]], k: int = 60):
+    """Fuse rankings of ids, best first, by the sum of 1 / (k + rank) of every id, returns (id, score) best first."""
+    scores = {}
+    for ranking in rankings:
+        for rank, item in enumerate(ranking, 1):
+            scores[item] = scores.get(item, 0.0) + 1.0 / (k + rank)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: Apache-2.0
+
+#
+
+import threading
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+class LRUCache:
+    """A thread-safe LRU cache with a bounded size and an idle TTL.
+
+    Entries that have not been accessed for `ttl` seconds are expired lazily, and the least
+    recently used entry is evicted once `maxsize` is exceeded. `on_evict(key, value)` is
+    called for every entry that leaves the cache, so owners can release pooled resources.
+    """
+
+    def __init__(self, maxsize: int = 32, ttl: float = 600, on_evict=None):
+        assert maxsize > 0, "maxsize should be positive"
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self._data = OrderedDict()
+        self._lock = threading.RLock()
+        self._building = {}
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+    def __contains__(self, key):
+        with self._lock:
+            return self._lookup(key) is not None
+
+    def _expired(self, last_access, now):
+        return self.ttl is not None and self.ttl > 0 and now - last_access > self.ttl
+
+    def _lookup(self, key):
+        item = self._data.get(key)
+        if item is None:
+            return None
+        value, last_access = item
+        now = time.monotonic()
+        if self._expired(last_access, now):
+            del self._data[key]
+            self._evicted(key, value)
+            return None
+        self._data[key] = (value, now)
+        self._data.move_to_end(key)
+        return item
+
+    def _evicted(self, key, value):
+        if self.on_evict is None:
+            return
+        try:
+            self.on_evict(key, value)
+        except Exception as e:
+            print(f"[rag - cache] failed to release entry {key}: {e}")
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._lookup(key)
+            return default if item is None else item[0]
+
+    def put(self, key, value):
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None and old[0] is not value:
+                self._evicted(key, old[0])
+            self._data[key] = (value, time.monotonic())
+            while len(self._data) > self.maxsize:
+                old_key, (old_value, _) = self._data.popitem(last=False)
+                self._evicted(old_key, old_value)
+
+    def get_or_create(self, key, factory):
+        """Return the cached value for `key`, building it with `factory()` on a miss.
+
+        Concurrent misses on the same key are serialized, so the value is built only once,
+        while lookups of other keys are not blocked by a slow build.
+        """
+        value = self.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+        with self._lock:
+            build_lock = self._building.setdefault(key, threading.Lock())
+        try:
+            with build_lock:
+                value = self.get(key, _MISSING)
+                if value is _MISSING:
+                    value = factory()
+                    self.put(key, value)
+                return value
+        finally:
+            with self._lock:
+                self._building.pop(key, None)
+
+    def invalidate(self, key):
+        with self._lock:
+            item = self._data.pop(key, None)
+            if item is not None:
+                self._evicted(key, item[0])
+            return item is not None
+
+    def clear(self):
+        with self._lock:
+            items = list(self._data.items())
+            self._data.clear()
+        for key, (value, _) in items:
+            self._evicted(key, value)
+
+    def expire(self):
+        """Drop all idle entries, returns the number of evicted entries."""
+        with self._lock:
+            now = time.monotonic()
+            stale = [key for key, (_, last_access) in self._data.items() if self._expired(last_access, now)]
+            for key in stale:
+                value, _ = self._data.pop(key)
+                self._evicted(key, value)
+        return len(stale)
@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: Apache-2.0
+
+#
+
+import asyncio
+import hashlib
+from collections import Counter, namedtuple
+from urllib.parse import urldefrag, urljoin, urlparse
+
+import aiohttp
+from lxml import etree
+
+# `root` is the lxml tree of the page, `links` the crawlable links found in it
+Page = namedtuple("Page", ["url", "html", "root", "links", "depth"])
+
+HEADERS = {
+    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+    "Accept-Encoding": "gzip, deflate",
+    "Accept-Language": "en-US,en;q=0.9,zh-CN;q=0.8,zh;q=0.7",
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, \
+    like Gecko) Chrome/113.0.0.0 Safari/537.36",
+}
+
+
+# returned by `AsyncCrawler.fetch` for the pages unchanged since they were cached
+UNCHANGED = object()
+
+
+class PageTooLarge(Exception):
+    pass
+
+
+class AsyncCrawler:
+    """Crawl web pages concurrently over a pooled HTTP client.
+
+    Connections are kept alive and reused, with at most `max_connections` requests in flight
+    and `per_host` of them to the same host. The links found up to `max_depth` hops from the
+    seed urls go through a single frontier, so every url is fetched once whatever the depth it
+    is found at. Pages are parsed while they are downloaded, and non HTML responses or pages
+    larger than `max_bytes` are skipped.
+
+    With an `HttpCache`, pages are re-fetched with conditional requests, and the pages that
+    come back 304 or with the same content hash are not parsed nor returned again, only their
+    cached links are followed.
+    """
+
+    def __init__(
+        self,
+        max_depth: int = 0,
+        max_pages: int = 1000,
+        max_connections: int = 64,
+        per_host: int = 8,
+        timeout: float = 30,
+        max_bytes: int = 5 * 1024 * 1024,
+        max_retries: int = 2,
+        same_host: bool = True,
+        headers: dict = None,
+        cache=None,
+    ):
+        self.max_depth = max_depth
+        self.max_pages = max_pages
+        self.max_connections = max_connections
+        self.per_host = per_host
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.max_bytes = max_bytes
+        self.max_retries = max_retries
+        self.same_host = same_host
+        self.headers = headers or HEADERS
+        self.cache = cache
+        self.stats = Counter()
+
+    def get_hyperlinks(self, hrefs, page_url):
+        """Resolve the hrefs of a page, keep the html pages of the same host."""
+        host = urlparse(page_url).netloc
+        links = []
+        for href in hrefs:
+            href = href.strip()
+            if not href or href.startswith("#"):
+                continue
+            link, _ = urldefrag(urljoin(page_url, href))
+            link_parse = urlparse(link)
+            if link_parse.scheme not in ("http", "https") or link_parse.path == "":
+                continue
+            if self.same_host and link_parse.netloc != host:
+                continue
+            suffix = link_parse.path.split("/")[-1]
+            if "." in suffix and suffix.split(".")[-1] not in ["html", "htm"]:
+                continue
+            links.append(link)
+        return links
+
+    async def fetch(self, session, url):
+        """Download and parse a page.
+
+        Returns (html, root, hrefs, validators), `UNCHANGED` if the cached version is still
+        valid, or None if the page is skipped.
+        """
+        entry = self.cache.get(url) if self.cache else None
+        headers = self.cache.conditional_headers(url) if entry else None
+        async with session.get(url, headers=headers) as response:
+            if response.status == 304 and entry:
+                self.stats["not_modified"] += 1
+                return UNCHANGED
+            if response.status != 200:
+                print(f"[rag - crawler] fail to fetch {url}, response status code: {response.status}")
+                if response.status >= 500:
+                    response.raise_for_status()
+                return None
+            if response.content_type and "html" not in response.content_type:
+                print(f"[rag - crawler] skip {url}, content type: {response.content_type}")
+                return None
+            if (response.content_length or 0) > self.max_bytes:
+                raise PageTooLarge(f"{response.content_length} bytes")
+
+            # a page seen before is only parsed once it is known to have changed
+            parser = None if entry else etree.HTMLPullParser(events=("start",), tag="a", encoding=response.charset)
+            chunks, size, hrefs = [], 0, []
+            async for chunk in response.content.iter_chunked(64 * 1024):
+                size += len(chunk)
+                if size > self.max_bytes:
+                    raise PageTooLarge(f"more than {self.max_bytes} bytes")
+                chunks.append(chunk)
+                if parser is not None:
+                    parser.feed(chunk)
+                    hrefs.extend(element.get("href") or "" for _, element in parser.read_events())
+            self.stats["bytes"] += size
+            body = b"".join(chunks)
+            validators = {
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+                "content_hash": hashlib.sha256(body).hexdigest(),
+            }
+            if entry and entry["content_hash"] == validators["content_hash"]:
+                # keep the new validators, so that the next request can be answered with a 304
+                self.cache.stage(url, links=entry["links"], **validators)
+                self.stats["unchanged"] += 1
+                return UNCHANGED
+            if parser is None:
+                parser = etree.HTMLPullParser(events=("start",), tag="a", encoding=response.charset)
+                parser.feed(body)
+            root = parser.close()
+            hrefs.extend(element.get("href") or "" for _, element in parser.read_events())
+            html = body.decode(response.charset or "utf-8", errors="replace")
+            self.stats["fetched"] += 1
+            return html, root, hrefs, validators
+
+    async def fetch_with_retries(self, session, url):
+        for attempt in range(self.max_retries + 1):
+            try:
+                return await self.fetch(session, url)
+            except PageTooLarge as e:
+                print(f"[rag - crawler] skip {url}, page too large: {e}")
+                return None
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                print(f"[rag - crawler] fail to fetch {url} (attempt {attempt + 1}), caused by {e!r}")
+            except etree.LxmlError as e:
+                print(f"[rag - crawler] fail to parse {url}, caused by {e}")
+                return None
+        return None
+
+    async def crawl(self, urls, work=None):
+        """Crawl from the seed `urls`, returns the pages in the order they were fetched.
+
+        If `work(page)` is given, it is called for every page instead and nothing is returned,
+        so that large crawls do not keep all the pages in memory.
+        """
+        if isinstance(urls, str):
+            urls = [urls]
+        frontier = asyncio.Queue()
+        self.stats.clear()
+        seen = set()
+        pages = []
+
+        def enqueue(url, depth):
+            if url not in seen and len(seen) < self.max_pages:
+                seen.add(url)
+                frontier.put_nowait((url, depth))
+
+        async def worker(session):
+            while True:
+                url, depth = await frontier.get()
+                try:
+                    result = await self.fetch_with_retries(session, url)
+                    if result is None:
+                        continue
+                    if result is UNCHANGED:
+                        links = self.cache.get(url)["links"]
+                    else:
+                        html, root, hrefs, validators = result
+                        links = self.get_hyperlinks(hrefs, url)
+                        if self.cache:
+                            self.cache.stage(url, links=links, **validators)
+                    if depth < self.max_depth:
+                        for link in links:
+                            enqueue(link, depth + 1)
+                    if result is UNCHANGED:
+                        continue
+                    page = Page(url, html, root, links, depth)
+                    if work:
+                        work(page)
+                    else:
+                        pages.append(page)
+                except Exception as e:
+                    print(f"[rag - crawler] fail to process {url}, caused by {e!r}")
+                finally:
+                    frontier.task_done()
+
+        for url in urls:
+            enqueue(urldefrag(url)[0], 0)
+        connector = aiohttp.TCPConnector(limit=self.max_connections, limit_per_host=self.per_host)
+        async with aiohttp.ClientSession(connector=connector, headers=self.headers, timeout=self.timeout) as session:
+            workers = [asyncio.create_task(worker(session)) for _ in range(self.max_connections)]
+            try:
+                await frontier.join()
+            finally:
+                for task in workers:
+                    task.cancel()
+                await asyncio.gather(*workers, return_exceptions=True)
+        print(
+            f"[rag - crawler] visited {len(seen)} urls from {len(urls)} seeds, {self.stats['fetched']} new or "
+            f"changed, {self.stats['not_modified']} not modified, {self.stats['unchanged']} with unchanged content, "
+            f"{self.stats['bytes']} bytes downloaded"
+        )
+        return None if work else pages
+
+
+def crawl(urls, work=None, **kwargs):
+    """Blocking helper running an `AsyncCrawler` in a new event loop, for the code run in threads."""
+    return asyncio.run(AsyncCrawler(**kwargs).crawl(urls, work))
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: Apache-2.0
+
+#
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+REGISTRY_FILE = "documents.sqlite"
+
+
+class DocumentRegistry:
+    """The documents of a knowledge base, keyed by their source.
+
+    For every document it keeps its `identify_id`, the ids of its chunks in the vector store and
+    an estimate of their size in bytes, so that a document can be replaced or deleted without
+    scanning the index. The registry is a sqlite file in the persist folder of the knowledge base.
+    """
+
+    def __init__(self, persist_dir: str):
+        self.path = os.path.join(persist_dir, REGISTRY_FILE)
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS documents (source TEXT PRIMARY KEY, identify_id TEXT, ids TEXT, added_at REAL, "
+            "bytes INTEGER DEFAULT 0)"
+        )
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(documents)")]
+        if "bytes" not in columns:
+            # registries written before the sizes were recorded
+            self._conn.execute("ALTER TABLE documents ADD COLUMN bytes INTEGER DEFAULT 0")
+        self._conn.commit()
+        self._lock = threading.Lock()
+
+    def get(self, source: str):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT identify_id, ids, added_at FROM documents WHERE source = ?", (source,)
+            ).fetchone()
+        if row is None:
+            return None
+        identify_id, ids, added_at = row
+        return {"source": source, "identify_id": identify_id, "ids": json.loads(ids), "added_at": added_at}
+
+    def put(self, source: str, identify_id: str, ids: list, size_bytes: int = 0):
+        """Record a document, returns the entry of the document it replaces, if any."""
+        with self._lock:
+            row = self._conn.execute("SELECT identify_id, ids FROM documents WHERE source = ?", (source,)).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO documents (source, identify_id, ids, added_at, bytes) VALUES (?, ?, ?, ?, ?)",
+                (source, identify_id, json.dumps(ids), time.time(), size_bytes),
+            )
+            self._conn.commit()
+        if row is None or row[0] == identify_id:
+            return None
+        return {"source": source, "identify_id": row[0], "ids": json.loads(row[1])}
+
+    def remove(self, source: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM documents WHERE source = ?", (source,))
+            self._conn.commit()
+
+    def list(self):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT source, identify_id, ids, added_at, bytes FROM documents ORDER BY added_at"
+            ).fetchall()
+        return [
+            {
+                "source": source,
+                "identify_id": identify_id,
+                "chunks": len(json.loads(ids)),
+                "added_at": added_at,
+                "bytes": size_bytes,
+            }
+            for source, identify_id, ids, added_at, size_bytes in rows
+        ]
+
+    def all_ids(self):
+        with self._lock:
+            rows = self._conn.execute("SELECT ids FROM documents").fetchall()
+        return [chunk_id for (ids,) in rows for chunk_id in json.loads(ids)]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: Apache-2.0
+
+#
+
+import hashlib
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import Counter
+from typing import List
+
+import numpy as np
+from cache import LRUCache
+from langchain_core.embeddings import Embeddings
+
+
+def normalize_text(text: str):
+    """The form of a chunk used for its key: NFC, whitespace runs collapsed, surrounding spaces stripped."""
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+def content_key(text: str, model_id: str):
+    return hashlib.sha256(f"{model_id}\x00{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+
+class EmbeddingStore:
+    """On-disk, content-addressed store of chunk embeddings, shared by all knowledge bases.
+
+    Vectors are stored as float32 blobs keyed by `content_key`, so the same chunk uploaded to
+    several knowledge bases, or uploaded again, is embedded only once per embedding model.
+    The store keeps at most `max_rows` vectors, the least recently used are deleted first, and
+    the vectors unused for `max_age` seconds are deleted, 0 disables either limit.
+    """
+
+    def __init__(self, path: str, max_rows: int = 0, max_age: float = 0):
+        self.path = path
+        self.max_rows = max_rows
+        self.max_age = max_age
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        # the store may be shared by several server workers
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB, created_at REAL)")
+        columns = [column[1] for column in self._conn.execute("PRAGMA table_info(embeddings)")]
+        if "last_used" not in columns:
+            # the stores created before the vectors were pruned
+            self._conn.execute("ALTER TABLE embeddings ADD COLUMN last_used REAL")
+            self._conn.execute("UPDATE embeddings SET last_used = created_at")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        self._conn.commit()
+        self._lock = threading.Lock()
+
+    def _batches(self, keys: List[str]):
+        # bounded by the number of host parameters of sqlite
+        for i in range(0, len(keys), 500):
+            batch = list(keys[i : i + 500])
+            yield batch, ",".join("?" * len(batch))
+
+    def get_many(self, keys: List[str]):
+        """Return a dict of the stored vectors of `keys`, the missing keys are left out."""
+        found = {}
+        now = time.time()
+        with self._lock:
+            for batch, parameters in self._batches(keys):
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({parameters})", batch
+                ).fetchall()
+                found.update((key, np.frombuffer(vector, dtype=np.float32).tolist()) for key, vector in rows)
+                if rows:
+                    self._conn.execute(
+                        f"UPDATE embeddings SET last_used = ? WHERE key IN ({parameters})", [now, *batch]
+                    )
+            self._conn.commit()
+        return found
+
+    def put_many(self, items):
+        now = time.time()
+        rows = [(key, np.asarray(vector, dtype=np.float32).tobytes(), now, now) for key, vector in items]
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector, created_at, last_used) VALUES (?, ?, ?, ?)", rows
+            )
+            self._prune(now)
+            self._conn.commit()
+
+    def _prune(self, now: float):
+        deleted = 0
+        if self.max_age > 0:
+            deleted += self._conn.execute("DELETE FROM embeddings WHERE last_used < ?", (now - self.max_age,)).rowcount
+        if self.max_rows > 0:
+            excess = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0] - self.max_rows
+            if excess > 0:
+                deleted += self._conn.execute(
+                    "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY last_used LIMIT ?)",
+                    (excess,),
+                ).rowcount
+        if deleted:
+            print(f"[rag - embeddings] {deleted} unused embeddings deleted from {self.path}")
+
+    def delete_many(self, keys: List[str]):
+        """Delete the stored vectors of `keys`."""
+        with self._lock:
+            for batch, parameters in self._batches(keys):
+                self._conn.execute(f"DELETE FROM embeddings WHERE key IN ({parameters})", batch)
+            self._conn.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class QueryEmbeddingCache:
+    """Two-tier cache of query embeddings: an in-process `LRUCache`, then an optional shared Redis.
+
+    A vector found in Redis is copied to the LRU, and a computed vector is stored in both tiers,
+    in Redis as float32 bytes expiring after `ttl` seconds, so that the workers and replicas of
+    the service embed a query once. Redis errors are reported and the lookups count as misses.
+    """
+
+    def __init__(self, maxsize: int = 10000, redis_client=None, ttl: int = 86400):
+        self.lru = LRUCache(maxsize=maxsize, ttl=0) if maxsize > 0 else None
+        self.redis = redis_client
+        self.ttl = ttl
+        self._stats = Counter()
+        self._lock = threading.Lock()
+
+    def _count(self, name: str):
+        with self._lock:
+            self._stats[name] += 1
+
+    def get(self, key: str):
+        """The cached vector of `key`, None on a miss."""
+        vector = self.lru.get(key) if self.lru is not None else None
+        if vector is not None:
+            self._count("lru_hits")
+            return vector.tolist()
+        if self.redis is not None:
+            try:
+                value = self.redis.get(f"embedding:query:{key}")
+            except Exception as e:
+                print(f"[rag - embeddings] query cache lookup failed: {e}")
+                value = None
+            if value:
+                vector = np.frombuffer(value, dtype=np.float32)
+                if self.lru is not None:
+                    self.lru.put(key, vector)
+                self._count("redis_hits")
+                return vector.tolist()
+        self._count("misses")
+        return None
+
+    def put(self, key: str, vector: List[float]):
+        vector = np.asarray(vector, dtype=np.float32)
+        if self.lru is not None:
+            self.lru.put(key, vector)
+        if self.redis is not None:
+            try:
+                self.redis.set(f"embedding:query:{key}", vector.tobytes(), ex=self.ttl or None)
+            except Exception as e:
+                print(f"[rag - embeddings] query cache store failed: {e}")
+
+    def stats(self):
+        """The number of lookups, of hits in every tier, and the hit rate since the cache was created."""
+        with self._lock:
+            lru_hits, redis_hits, misses = self._stats["lru_hits"], self._stats["redis_hits"], self._stats["misses"]
+        lookups = lru_hits + redis_hits + misses
+        return {
+            "lookups": lookups,
+            "lru_hits": lru_hits,
+            "redis_hits": redis_hits,
+            "misses": misses,
+            "hit_rate": (lru_hits + redis_hits) / lookups if lookups else 0.0,
+            "size": len(self.lru) if self.lru is not None else 0,
+        }
+
+
+class CachedEmbeddings(Embeddings):
+    """Embeddings that only compute the chunks and the queries never seen before.
+
+    `embed_documents` looks every text up in the `EmbeddingStore` by the hash of its normalized
+    content and of `model_id`, embeds the missing ones once, even if they are repeated in the
+    batch, and stores them. `embed_query` looks the query up in the `QueryEmbeddingCache` by the
+    same key. Without a store or a query cache, the texts are passed through to the embeddings.
+    """
+
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        store: EmbeddingStore = None,
+        model_id: str = "",
+        query_cache: QueryEmbeddingCache = None,
+    ):
+        self.embeddings = embeddings
+        self.store = store
+        self.model_id = model_id
+        self.query_cache = query_cache
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if self.store is None:
+            return self.embeddings.embed_documents(texts)
+        keys = [content_key(text, self.model_id) for text in texts]
+        vectors = self.store.get_many(list(set(keys)))
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in vectors:
+                missing.setdefault(key, text)
+        if missing:
+            embedded = self.embeddings.embed_documents(list(missing.values()))
+            new_vectors = dict(zip(missing, embedded))
+            self.store.put_many(new_vectors.items())
+            vectors.update(new_vectors)
+        print(f"[rag - embeddings] {len(texts)} chunks, {len(missing)} embedded, {len(texts) - len(missing)} reused")
+        return [vectors[key] for key in keys]
+
+    def forget(self, texts: List[str]):
+        """Delete the stored embeddings of the chunks `texts`, once they were deleted from a knowledge base."""
+        if self.store is not None and texts:
+            self.store.delete_many(list({content_key(text, self.model_id) for text in texts}))
+
+    def embed_query(self, text: str) -> List[float]:
+        if self.query_cache is None:
+            return self.embeddings.embed_query(text)
+        key = content_key(text, self.model_id)
+        vector = self.query_cache.get(key)
+        if vector is None:
+            vector = self.embeddings.embed_query(text)
+            self.query_cache.put(key, vector)
+        return vector
@@ -5,6 +5,10 @@
 
 #
 
+import asyncio
+import re
+from collections import deque
+
 unsafe_categories = """O1: Violence and Hate.
 Should not
 - Help people plan or engage in violence.
@@ -62,12 +66,8 @@ unsafe_dict = {
 }
 
 
-def moderation_prompt_for_chat(chat):
-    # For simplicity, we assume the chat dictionary correctly alternates "user" and "assistant" roles
-    # Feel free to include error checking if needed
-    conversation = [turn["content"] for turn in chat]
-    is_agent = len(conversation) % 2 == 0
-    role = "Agent" if len(conversation) % 2 == 0 else "User"
+def moderation_prompt_for_chat(role, conversation):
+    """Build the Llama Guard prompt that checks the `role` ("User" or "Agent") messages of `conversation`."""
     prompt = f"""[INST] Task: Check if there is unsafe content in '{role}' messages in conversations according our safety policy with the below categories.
 
 <BEGIN UNSAFE CONTENT CATEGORIES>
@@ -76,15 +76,160 @@ def moderation_prompt_for_chat(chat):
 
 <BEGIN CONVERSATION>
 
-"""
+{conversation}
 
-    # Alternate User/Agent turns, inserting 2 newlines between each
-    for i, m in enumerate(conversation):
-        role = "User" if i % 2 == 0 else "Agent"
-        prompt += f"{role}: {m}\n\n"
-    prompt += f"""<END CONVERSATION>
+<END CONVERSATION>
 
 Provide your safety assessment for {role} in the above conversation:
 - First line must read 'safe' or 'unsafe'.
 - If unsafe, a second line must include a comma-separated list of violated categories. [/INST]"""
     return prompt
+
+
+def get_policy_violations(guard_response: str):
+    """Return the names of the policies violated according to a Llama Guard response, None if it is safe."""
+    lines = guard_response.strip().split("\n")
+    if "unsafe" not in lines[0]:
+        return None
+    categories = lines[1].split(",") if len(lines) > 1 else []
+    policy_violations = [unsafe_dict.get(category.strip(), category.strip()) for category in categories]
+    return ", ".join(policy_violations) or "Unknown policy"
+
+
+class GuardrailViolation(Exception):
+    """Raised when the safety guard flags the user input or the answer while it is being streamed."""
+
+    def __init__(self, policy_violations: str, role: str = "User"):
+        super().__init__(policy_violations)
+        self.policy_violations = policy_violations
+        self.role = role
+
+
+async def _cancel(task):
+    if task is not None and not task.done():
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+
+async def speculative_call(guard, call):
+    """Run the `call` coroutine while the `guard` coroutine checks its input.
+
+    Returns `(policy_violations, result)`. The call is cancelled and its result discarded as
+    soon as the guard reports violations, so the safe case pays max(guard, call) instead of
+    guard + call.
+    """
+    guard_task = asyncio.ensure_future(guard)
+    call_task = asyncio.ensure_future(call)
+    try:
+        policy_violations = await guard_task
+        if policy_violations:
+            return policy_violations, None
+        return None, await call_task
+    finally:
+        await _cancel(call_task)
+        await _cancel(guard_task)
+
+
+async def speculative_stream(guard, stream):
+    """Iterate the async `stream` while the `guard` coroutine checks its input.
+
+    The stream starts immediately and its items are held back in a buffer until the guard
+    returns. If the guard reports violations the buffer is discarded, the stream is closed
+    and `GuardrailViolation` is raised, otherwise the buffer is flushed and the stream
+    continues unbuffered.
+    """
+    guard_task = asyncio.ensure_future(guard)
+    iterator = stream.__aiter__()
+    buffer = []
+    pending = None
+    exhausted = False
+    try:
+        while not guard_task.done() and not exhausted:
+            if pending is None:
+                pending = asyncio.ensure_future(iterator.__anext__())
+            await asyncio.wait({guard_task, pending}, return_when=asyncio.FIRST_COMPLETED)
+            if pending.done():
+                try:
+                    buffer.append(pending.result())
+                except StopAsyncIteration:
+                    exhausted = True
+                pending = None
+
+        policy_violations = await guard_task
+        if policy_violations:
+            raise GuardrailViolation(policy_violations)
+
+        for item in buffer:
+            yield item
+        buffer.clear()
+        if pending is not None:
+            try:
+                yield await pending
+            except StopAsyncIteration:
+                exhausted = True
+            pending = None
+        if not exhausted:
+            async for item in iterator:
+                yield item
+    finally:
+        await _cancel(pending)
+        await _cancel(guard_task)
+        if hasattr(iterator, "aclose"):
+            await iterator.aclose()
+
+
+_SENTENCE_END = re.compile(r"[.!?\n]\s*$")
+
+
+class StreamingOutputModerator:
+    """Moderate a streamed answer window by window while the tokens keep flowing.
+
+    The answer is cut into windows of about `window_size` characters, closed at a sentence
+    boundary when possible. Every window is checked together with the previous one, so that
+    unsafe content split across a boundary is still seen, by `check(text)` which returns the
+    violated policies or None. Checks run concurrently with the generation, and a text is only
+    sent once the client has at most `max_lag` unchecked windows with it, counting the window
+    that is still open.
+    """
+
+    def __init__(self, check, window_size: int = 256, max_lag: int = 2):
+        assert window_size > 0 and max_lag > 0, "window_size and max_lag should be positive"
+        self.check = check
+        self.window_size = window_size
+        self.max_lag = max_lag
+
+    def _window_closed(self, window: str):
+        if len(window) >= 2 * self.window_size:
+            return True
+        return len(window) >= self.window_size and _SENTENCE_END.search(window) is not None
+
+    @staticmethod
+    async def _verdict(task):
+        policy_violations = await task
+        if policy_violations:
+            raise GuardrailViolation(policy_violations, role="Agent")
+
+    async def moderate(self, stream):
+        """Yield the items of the async `stream`, raise `GuardrailViolation` when a window is flagged."""
+        pending = deque()
+        previous, window = "", ""
+        try:
+            async for text in stream:
+                while pending and pending[0].done():
+                    await self._verdict(pending.popleft())
+                window += text
+                if self._window_closed(window):
+                    pending.append(asyncio.ensure_future(self.check(previous + window)))
+                    previous, window = window, ""
+                # the windows being checked and the open window are the unchecked windows of the client
+                while len(pending) + bool(window) > self.max_lag:
+                    await self._verdict(pending.popleft())
+                yield text
+            if window.strip():
+                pending.append(asyncio.ensure_future(self.check(previous + window)))
+            while pending:
+                await self._verdict(pending.popleft())
+        finally:
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
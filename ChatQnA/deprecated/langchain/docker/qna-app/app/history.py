@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: Apache-2.0
+
+#
+
+import json
+import os
+import threading
+from abc import ABC, abstractmethod
+
+from cache import LRUCache
+from langchain_core.messages import SystemMessage, message_to_dict, messages_from_dict
+
+SUMMARY_PREFIX = "Summary of the earlier conversation: "
+
+
+def approx_token_count(text: str):
+    """Cheap token estimate, about 4 characters per token for English text."""
+    return len(text) // 4 + 1
+
+
+class ChatHistoryStore(ABC):
+    """Chat history keyed by session id, bounded by a token budget.
+
+    A turn is stored with `push`, which appends it atomically, so that the concurrent turns of a
+    session are all kept. `compact` then drops the oldest turns until the history fits in
+    `max_tokens`, so that the prompt size and the memory used by a session stay roughly
+    constant. If a `summarizer(text) -> str` is given, the dropped turns are folded into a
+    summary message kept at the head of the history instead of being forgotten. The latest
+    turn is always kept.
+    """
+
+    def __init__(self, max_tokens: int = 1024, count_tokens=approx_token_count, summarizer=None):
+        self.max_tokens = max_tokens
+        self.count_tokens = count_tokens
+        self.summarizer = summarizer
+
+    @abstractmethod
+    def load(self, session_id: str):
+        """The messages of a session, oldest first."""
+
+    @abstractmethod
+    def push(self, session_id: str, messages: list):
+        """Append `messages` to the history of a session atomically."""
+
+    @abstractmethod
+    def compact(self, session_id: str, keep_last: int = 2):
+        """Fit the history of a session in the budget, see `fit_budget`."""
+
+    @abstractmethod
+    def clear(self, session_id: str):
+        """Delete the history of a session."""
+
+    def get(self, session_id: str):
+        return self.load(session_id)
+
+    def append(self, session_id: str, messages: list):
+        self.push(session_id, messages)
+        self.compact(session_id, len(messages))
+
+    def fit_budget(self, messages: list, keep_last: int = 2):
+        summary = None
+        if messages and isinstance(messages[0], SystemMessage):
+            summary, messages = messages[0], messages[1:]
+        sizes = [self.count_tokens(message.content) for message in messages]
+        total = sum(sizes) + (self.count_tokens(summary.content) if summary else 0)
+        if total <= self.max_tokens:
+            return ([summary] if summary else []) + messages
+
+        # drop whole turns from the head, the latest turn is kept even if it is over budget
+        start = 0
+        while total > self.max_tokens and start < len(messages) - keep_last:
+            total -= sizes[start] + (sizes[start + 1] if start + 1 < len(messages) else 0)
+            start += 2
+        start = min(start, max(len(messages) - keep_last, 0))
+        if start == 0:
+            # only the latest turn is over budget, there is nothing to summarize
+            return ([summary] if summary else []) + messages
+        dropped, messages = messages[:start], messages[start:]
+        if self.summarizer is None:
+            return messages
+
+        text = "\n".join(f"{message.type}: {message.content}" for message in dropped)
+        if summary:
+            text = summary.content[len(SUMMARY_PREFIX) :] + "\n" + text
+        try:
+            summary = SystemMessage(content=SUMMARY_PREFIX + self.summarizer(text).strip())
+        except Exception as e:
+            print(f"[rag - history] failed to summarize the chat history: {e}")
+            return messages
+        if self.count_tokens(summary.content) + sum(self.count_tokens(m.content) for m in messages) > self.max_tokens:
+            return messages
+        return [summary] + messages
+
+    def trim(self, messages: list, keep_last: int = 2):
+        """The number of messages to drop from the head of `messages`, and the summary replacing them, None if they fit."""
+        fitted = self.fit_budget(messages, keep_last)
+        if len(fitted) == len(messages) and all(a is b for a, b in zip(fitted, messages)):
+            return None
+        summary = fitted[0] if fitted and isinstance(fitted[0], SystemMessage) else None
+        return len(messages) - len(fitted) + (1 if summary else 0), summary
+
+
+class InMemoryChatHistoryStore(ChatHistoryStore):
+    """Chat history kept in the memory of the server process, only valid with a single worker.
+
+    At most `max_sessions` sessions are kept, the least recently used and the ones idle for
+    more than `ttl` seconds are dropped.
+    """
+
+    def __init__(self, max_sessions: int = 1000, ttl: float = 3600, **kwargs):
+        super().__init__(**kwargs)
+        self._sessions = LRUCache(maxsize=max_sessions, ttl=ttl)
+        self._lock = threading.Lock()
+
+    def load(self, session_id: str):
+        return list(self._sessions.get(session_id, []))
+
+    def push(self, session_id: str, messages: list):
+        with self._lock:
+            self._sessions.put(session_id, self.load(session_id) + list(messages))
+
+    def compact(self, session_id: str, keep_last: int = 2):
+        messages = self.load(session_id)
+        # the history is summarized without the lock, the turns pushed meanwhile are kept
+        trim = self.trim(messages, keep_last)
+        if trim is None:
+            return
+        drop, summary = trim
+        with self._lock:
+            current = self.load(session_id)
+            if len(current) >= drop and all(a is b for a, b in zip(current, messages[:drop])):
+                self._sessions.put(session_id, ([summary] if summary else []) + current[drop:])
+
+    def clear(self, session_id: str):
+        self._sessions.invalidate(session_id)
+
+
+class RedisChatHistoryStore(ChatHistoryStore):
+    """Chat history kept in Redis lists, shared by all the workers of the server.
+
+    Turns are appended with RPUSH, and the history is compacted by trimming the head of the
+    list with LTRIM, so the turns appended concurrently by other workers are never lost.
+    """
+
+    def __init__(self, redis_url: str, key_prefix: str = "rag-chat-history:", ttl: int = 3600, **kwargs):
+        import redis
+
+        super().__init__(**kwargs)
+        self.client = redis.Redis.from_url(redis_url)
+        self.key_prefix = key_prefix
+        self.ttl = ttl
+
+    def _key(self, session_id: str):
+        return self.key_prefix + session_id
+
+    def load(self, session_id: str):
+        items = self.client.lrange(self._key(session_id), 0, -1)
+        return messages_from_dict([json.loads(item) for item in items])
+
+    def push(self, session_id: str, messages: list):
+        if not messages:
+            return
+        key = self._key(session_id)
+        pipeline = self.client.pipeline(transaction=True)
+        pipeline.rpush(key, *[json.dumps(message_to_dict(message)) for message in messages])
+        if self.ttl:
+            pipeline.expire(key, self.ttl)
+        pipeline.execute()
+
+    def compact(self, session_id: str, keep_last: int = 2):
+        import redis
+
+        key = self._key(session_id)
+        items = self.client.lrange(key, 0, -1)
+        trim = self.trim(messages_from_dict([json.loads(item) for item in items]), keep_last)
+        if trim is None:
+            return
+        drop, summary = trim
+        with self.client.pipeline(transaction=True) as pipeline:
+            try:
+                pipeline.watch(key)
+                # the head was compacted by another turn meanwhile
+                if pipeline.lrange(key, 0, drop - 1) != items[:drop]:
+                    return
+                pipeline.multi()
+                pipeline.ltrim(key, drop, -1)
+                if summary:
+                    pipeline.lpush(key, json.dumps(message_to_dict(summary)))
+                pipeline.execute()
+            except redis.WatchError:
+                # the history changed while it was trimmed, it is compacted again on the next turn
+                pass
+
+    def clear(self, session_id: str):
+        self.client.delete(self._key(session_id))
+
+
+def create_chat_history_store(redis_url=None, summarizer=None):
+    """Create the history store selected by `CHAT_HISTORY_BACKEND` ("memory" or "redis").
+
+    Redis is used by default when `CHAT_HISTORY_REDIS_URL` or `redis_url` is set.
+    """
+    redis_url = os.getenv("CHAT_HISTORY_REDIS_URL", redis_url)
+    backend = os.getenv("CHAT_HISTORY_BACKEND", "redis" if redis_url else "memory").lower()
+    ttl = int(os.getenv("CHAT_HISTORY_TTL", 3600))
+    kwargs = {
+        "max_tokens": int(os.getenv("CHAT_HISTORY_MAX_TOKENS", 1024)),
+        "summarizer": summarizer,
+    }
+    if backend == "redis":
+        assert redis_url, "CHAT_HISTORY_REDIS_URL should be set to store the chat history in redis"
+        print(f"[rag - history] chat history stored in redis, ttl={ttl}s")
+        return RedisChatHistoryStore(redis_url, ttl=ttl, **kwargs)
+    elif backend == "memory":
+        max_sessions = int(os.getenv("CHAT_HISTORY_MAX_SESSIONS", 1000))
+        print(f"[rag - history] chat history stored in process memory, max sessions={max_sessions}")
+        return InMemoryChatHistoryStore(max_sessions=max_sessions, ttl=ttl, **kwargs)
+    raise ValueError(f"Invalid CHAT_HISTORY_BACKEND: {backend}")
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: Apache-2.0
+
+#
+
+import json
+import sqlite3
+import threading
+import time
+
+
+class HttpCache:
+    """On-disk cache of the crawled pages of a knowledge base, keyed by url.
+
+    For every page it keeps the ETag and Last-Modified validators sent by the server, the
+    hash of the content and the links found in it, so that a page can be re-fetched with a
+    conditional request and skipped when it has not changed. New entries are staged by the
+    crawler and only written by `commit()`, once the pages are stored in the vector database,
+    so that a failed ingestion does not mark its pages as already ingested.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS pages (url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, "
+            "content_hash TEXT, links TEXT, fetched_at REAL)"
+        )
+        self._conn.commit()
+        self._lock = threading.Lock()
+        self._staged = {}
+
+    def get(self, url: str):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT etag, last_modified, content_hash, links FROM pages WHERE url = ?", (url,)
+            ).fetchone()
+        if row is None:
+            return None
+        etag, last_modified, content_hash, links = row
+        return {"etag": etag, "last_modified": last_modified, "content_hash": content_hash, "links": json.loads(links)}
+
+    def conditional_headers(self, url: str):
+        """Headers making the request conditional on the cached validators of `url`."""
+        entry = self.get(url)
+        headers = {}
+        if entry and entry["etag"]:
+            headers["If-None-Match"] = entry["etag"]
+        if entry and entry["last_modified"]:
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def stage(self, url: str, etag=None, last_modified=None, content_hash=None, links=()):
+        with self._lock:
+            self._staged[url] = (etag, last_modified, content_hash, json.dumps(list(links)), time.time())
+
+    def commit(self):
+        """Write the staged entries, returns the number of written entries."""
+        with self._lock:
+            rows = [(url, *entry) for url, entry in self._staged.items()]
+            self._conn.executemany("INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?)", rows)
+            self._conn.commit()
+            self._staged.clear()
+        return len(rows)
+
+    def close(self):
+        with self._lock:
+            self._staged.clear()
+            self._conn.close()
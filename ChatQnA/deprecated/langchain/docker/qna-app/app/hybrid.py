@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: Apache-2.0
+
+#
+
+import os
+
+from bm25 import load_index, reciprocal_rank_fusion
+from langchain_core.runnables import ConfigurableField
+from mmr import MMRRetriever, chunk_id, documents_by_ids
+
+# Knowledge bases are searched by both BM25 and vector similarity by default when HYBRID_SEARCH is true,
+# the two rankings are fused by reciprocal rank with the RRF_K constant.
+HYBRID_SEARCH = os.getenv("HYBRID_SEARCH", "false").lower() in ["true", "1"]
+RRF_K = int(os.getenv("RRF_K", 60))
+
+
+class HybridRetriever(MMRRetriever):
+    """Retrieve chunks by reciprocal rank fusion of the BM25 and the vector similarity rankings.
+
+    The `fetch_k` best chunks of both rankings are fused, and the chunks found only by BM25 are
+    fetched from the vector store by id. Without `hybrid`, or while the knowledge base in
+    `persist_dir` has no BM25 index, the chunks are retrieved by maximal marginal relevance.
+    """
+
+    persist_dir: str
+    hybrid: bool = HYBRID_SEARCH
+    rrf_k: int = RRF_K
+
+    def _search(self, query: str):
+        index = load_index(self.persist_dir) if self.hybrid else None
+        if index is None:
+            return super()._search(query)
+        fetch_k = max(self.fetch_k, self.k)
+        embedding = self.vectorstore.embeddings.embed_query(query)
+        dense = {
+            chunk_id(self.vectorstore, doc): doc
+            for doc in self.vectorstore.similarity_search_by_vector(embedding, k=fetch_k)
+        }
+        lexical = [i for i, _ in index.search(query, fetch_k)]
+        fused = reciprocal_rank_fusion([list(dense), lexical], self.rrf_k)[: self.k]
+        missing = [i for i, _ in fused if i not in dense]
+        found = dict(zip(missing, documents_by_ids(self.vectorstore, missing))) if missing else {}
+        results = [(dense.get(i) or found.get(i), score) for i, score in fused]
+        return [(doc, score) for doc, score in results if doc is not None]
+
+    def _search_params(self):
+        return super()._search_params() + (self.hybrid and load_index(self.persist_dir) is not None, self.rrf_k)
+
+    def configurable(self):
+        """The retriever with its parameters set per request, and hybrid search by the `hybrid` config key."""
+        return self.configurable_fields(
+            **super().configurable().fields,
+            hybrid=ConfigurableField(id="hybrid", name="hybrid", description="Fuse BM25 and vector rankings"),
+        )
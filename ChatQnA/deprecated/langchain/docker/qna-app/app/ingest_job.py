@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: Apache-2.0
+
+#
+
+import glob
+import hashlib
+import json
+import os
+import tempfile
+import time
+import uuid
+
+JOB_SUFFIX = "_job.json"
+CHUNKS_SUFFIX = "_chunks.jsonl"
+
+
+def _atomic_write(path, write):
+    # written to a temporary file first, so that a crash never leaves a truncated checkpoint
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        write(f)
+    os.replace(tmp_path, path)
+
+
+class IngestJob:
+    """A checkpointed ingestion of a document into the index of a knowledge base.
+
+    The job state is kept in the persist folder of the knowledge base: the chunks are saved
+    once the document is parsed, and the number of stored chunks after every batch. A job that
+    failed, or was interrupted by a restart, resumes from its last checkpoint without parsing the
+    document again. Chunk ids are derived from the index name, the document, the position and the
+    content of every chunk, so a batch stored twice overwrites itself instead of being duplicated.
+    A knowledge base has one job per ingestion of a document, named after the `identify_id` of
+    the ingestion, and the source of the document is kept in the job state.
+    """
+
+    def __init__(self, persist_dir: str, name: str = "ingest"):
+        self.persist_dir = persist_dir
+        self.name = name
+        self.job_path = os.path.join(persist_dir, name + JOB_SUFFIX)
+        self.chunks_path = os.path.join(persist_dir, name + CHUNKS_SUFFIX)
+        self.state = {}
+        if os.path.exists(self.job_path):
+            with open(self.job_path, encoding="utf-8") as f:
+                self.state = json.load(f)
+
+    @property
+    def status(self):
+        """The job status: "new", "embedding" once the chunks are saved, "done" once they are all stored."""
+        return self.state.get("status", "new")
+
+    @classmethod
+    def unfinished(cls, persist_dir: str):
+        """The jobs of a knowledge base that were parsed but not completed."""
+        jobs = [
+            cls(persist_dir, os.path.basename(path)[: -len(JOB_SUFFIX)])
+            for path in sorted(glob.glob(os.path.join(persist_dir, "*" + JOB_SUFFIX)))
+        ]
+        return [job for job in jobs if job.status == "embedding"]
+
+    @property
+    def parsed(self):
+        return self.status in ["embedding", "done"]
+
+    def _save_state(self, **changes):
+        self.state.update(changes, updated_at=time.time())
+        _atomic_write(self.job_path, lambda f: json.dump(self.state, f))
+
+    def save_chunks(self, index_name: str, source: str, texts: list, metadatas: list, identify_id: str = ""):
+        def write(f):
+            for text, metadata in zip(texts, metadatas):
+                f.write(json.dumps({"text": text, "metadata": metadata}) + "\n")
+
+        _atomic_write(self.chunks_path, write)
+        self._save_state(
+            status="embedding",
+            index_name=index_name,
+            source=source,
+            identify_id=identify_id,
+            total=len(texts),
+            committed=0,
+        )
+
+    def load_chunks(self):
+        texts, metadatas = [], []
+        with open(self.chunks_path, encoding="utf-8") as f:
+            for line in f:
+                chunk = json.loads(line)
+                texts.append(chunk["text"])
+                metadatas.append(chunk["metadata"])
+        return texts, metadatas
+
+    def chunk_ids(self, texts: list):
+        prefix = f"{self.state['index_name']}:{self.state.get('identify_id', '')}"
+        return [
+            str(uuid.uuid5(uuid.NAMESPACE_OID, f"{prefix}:{i}:{hashlib.sha256(text.encode('utf-8')).hexdigest()}"))
+            for i, text in enumerate(texts)
+        ]
+
+    def run(self, write_batch, batch_size: int = 128, progress=None):
+        """Store the saved chunks from the last checkpoint on with `write_batch(texts, metadatas, ids)`.
+
+        `progress(done, total)` is called with the number of stored chunks after every batch.
+        Returns the ids of all the chunks and the size of their texts and metadata in bytes,
+        the job is completed by `finish()`.
+        """
+        texts, metadatas = self.load_chunks()
+        ids = self.chunk_ids(texts)
+        committed = self.state["committed"]
+        if committed:
+            print(f"[rag - ingest job] resume {self.persist_dir} from chunk {committed}/{len(texts)}")
+        for i in range(committed, len(texts), batch_size):
+            end = i + batch_size
+            write_batch(texts[i:end], metadatas[i:end], ids[i:end])
+            committed = min(end, len(texts))
+            self._save_state(committed=committed)
+            print(f"[rag - ingest job] stored {committed}/{len(texts)} chunks")
+            if progress:
+                progress(committed, len(texts))
+        size_bytes = sum(
+            len(text.encode("utf-8")) + len(json.dumps(metadata)) for text, metadata in zip(texts, metadatas)
+        )
+        return ids, size_bytes
+
+    def finish(self):
+        self._save_state(status="done")
+        # the chunks are kept in the index, the copy is only needed to resume
+        if os.path.exists(self.chunks_path):
+            os.remove(self.chunks_path)
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: Apache-2.0
+
+#
+
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+JOB_ID_PATTERN = re.compile(r"^job_[0-9a-f]{12}$")
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+class Job:
+    """Status of a background ingestion job, saved to disk on every change.
+
+    The status is a file in the jobs folder, so that it can be read by any worker process of
+    the service, not only by the one running the job.
+    """
+
+    def __init__(self, path: str, job_id: str, kind: str, kb_id: str):
+        self.path = path
+        self.status = {
+            "job_id": job_id,
+            "kind": kind,
+            "knowledge_base_id": kb_id,
+            "status": "queued",
+            "stage": None,
+            "progress": {"done": 0, "total": None},
+            "throughput": None,
+            "error": None,
+            "created_at": time.time(),
+            "started_at": None,
+            "finished_at": None,
+            "pid": os.getpid(),
+        }
+        self._lock = threading.Lock()
+
+    @property
+    def job_id(self):
+        return self.status["job_id"]
+
+    def _save(self):
+        # written to a temporary file first, so that a reader never sees a partial status
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path), suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(self.status, f)
+        os.replace(tmp_path, self.path)
+
+    def update(self, **changes):
+        with self._lock:
+            self.status.update(changes)
+            self._save()
+
+    def set_stage(self, stage: str):
+        self.update(stage=stage)
+
+    def progress(self, done: int, total: int):
+        """Report `done` out of `total` chunks stored, the throughput is measured from the start of the job."""
+        elapsed = time.time() - self.status["started_at"]
+        throughput = round(done / elapsed, 2) if elapsed > 0 else None
+        self.update(progress={"done": done, "total": total}, throughput=throughput)
+
+
+class JobManager:
+    """Run ingestion jobs in a bounded pool of background threads.
+
+    At most `max_workers` jobs run at once in every worker process, and at most `max_pending`
+    jobs wait for a thread, further submissions raise `JobQueueFull`. Finished job statuses are
+    removed after `ttl` seconds.
+    """
+
+    def __init__(self, jobs_dir: str, max_workers: int = 2, max_pending: int = 100, ttl: float = 86400):
+        self.jobs_dir = jobs_dir
+        self.max_pending = max_pending
+        self.ttl = ttl
+        os.makedirs(jobs_dir, exist_ok=True)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="rag-ingest")
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._active = Counter()
+
+    def _path(self, job_id: str):
+        return os.path.join(self.jobs_dir, f"{job_id}.json")
+
+    def submit(self, kind: str, kb_id: str, fn):
+        """Queue `fn(job)` and return its `Job`, the job fails if `fn` raises."""
+        with self._lock:
+            if self._pending >= self.max_pending:
+                raise JobQueueFull(f"{self._pending} ingestion jobs are already pending")
+            self._pending += 1
+            self._active[kb_id] += 1
+        self.expire()
+        job_id = f"job_{uuid.uuid4().hex[:12]}"
+        job = Job(self._path(job_id), job_id, kind, kb_id)
+        job.update()
+        self._executor.submit(self._run, job, fn)
+        print(f"[rag - jobs] {kind} job {job_id} queued for {kb_id}")
+        return job
+
+    def _run(self, job: Job, fn):
+        with self._lock:
+            self._pending -= 1
+        job.update(status="running", started_at=time.time())
+        try:
+            fn(job)
+        except Exception as e:
+            print(f"[rag - jobs] job {job.job_id} failed! {e}")
+            job.update(status="failed", error=str(e), finished_at=time.time())
+        else:
+            print(f"[rag - jobs] job {job.job_id} done")
+            job.update(status="done", stage=None, finished_at=time.time())
+        finally:
+            with self._lock:
+                self._active[job.status["knowledge_base_id"]] -= 1
+                self._active += Counter()
+
+    def active_knowledge_bases(self):
+        """The knowledge bases with a queued or running job in any worker process.
+
+        The jobs of the other processes are read from their status files, the jobs of this
+        process are also counted before their status is written.
+        """
+        active = set()
+        for name in os.listdir(self.jobs_dir):
+            if not name.endswith(".json"):
+                continue
+            status = self.get(name[: -len(".json")])
+            if status and status["status"] in ["queued", "running"]:
+                active.add(status["knowledge_base_id"])
+        with self._lock:
+            return active | set(self._active)
+
+    def get(self, job_id: str):
+        """Return the status of a job, None if it does not exist."""
+        if not JOB_ID_PATTERN.match(job_id):
+            return None
+        try:
+            with open(self._path(job_id), encoding="utf-8") as f:
+                status = json.load(f)
+        except FileNotFoundError:
+            return None
+        pid = status.pop("pid")
+        if status["status"] in ["queued", "running"] and not _process_alive(pid):
+            # the service was restarted while the job was pending
+            status["status"] = "interrupted"
+        return status
+
+    def expire(self):
+        """Remove the statuses of the jobs finished more than `ttl` seconds ago."""
+        now = time.time()
+        for name in os.listdir(self.jobs_dir):
+            path = os.path.join(self.jobs_dir, name)
+            try:
+                if not name.endswith(".json") or now - os.path.getmtime(path) < self.ttl:
+                    continue
+                status = self.get(name[: -len(".json")])
+                if status and status["status"] not in ["queued", "running"]:
+                    os.remove(path)
+            except FileNotFoundError:
+                # removed by another worker process
+                pass
+
+
+def _process_alive(pid: int):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
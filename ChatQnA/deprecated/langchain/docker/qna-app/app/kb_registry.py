@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: Apache-2.0
+
+#
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+REGISTRY_FILE = "knowledge_bases.sqlite"
+COLUMNS = [
+    "kb_id",
+    "index_name",
+    "created_at",
+    "last_used_at",
+    "documents",
+    "chunks",
+    "bytes",
+    "search_params",
+    "generation",
+]
+
+
+class KnowledgeBaseRegistry:
+    """The knowledge bases of the service, with their footprint in the vector database.
+
+    For every knowledge base it keeps its creation time, the time it was last used by a query
+    or an ingestion, the number of documents, chunks and bytes it stores, its retrieval
+    parameters, and its generation, incremented whenever its chunks change, which scopes the
+    retrieval results cached by the workers. The registry is a sqlite file in the upload folder,
+    shared by the worker processes of the service. Uses are written at most once every
+    `touch_interval` seconds per knowledge base and process.
+    """
+
+    def __init__(self, upload_dir: str, touch_interval: float = 60):
+        self.path = os.path.join(upload_dir, REGISTRY_FILE)
+        self.touch_interval = touch_interval
+        os.makedirs(upload_dir, exist_ok=True)
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        # the registry is shared by several server workers
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS knowledge_bases (kb_id TEXT PRIMARY KEY, index_name TEXT, created_at REAL, "
+            "last_used_at REAL, documents INTEGER DEFAULT 0, chunks INTEGER DEFAULT 0, bytes INTEGER DEFAULT 0, "
+            "search_params TEXT DEFAULT '{}', generation INTEGER DEFAULT 0)"
+        )
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(knowledge_bases)")]
+        if "search_params" not in columns:
+            # registries written before the retrieval parameters were recorded
+            self._conn.execute("ALTER TABLE knowledge_bases ADD COLUMN search_params TEXT DEFAULT '{}'")
+        if "generation" not in columns:
+            self._conn.execute("ALTER TABLE knowledge_bases ADD COLUMN generation INTEGER DEFAULT 0")
+        self._conn.commit()
+        self._lock = threading.Lock()
+        self._touched = {}
+
+    def register(self, kb_id: str, index_name: str, created_at: float = None):
+        """Add a knowledge base, a registered knowledge base is left unchanged."""
+        created_at = created_at or time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO knowledge_bases (kb_id, index_name, created_at, last_used_at) VALUES (?, ?, ?, ?)",
+                (kb_id, index_name, created_at, created_at),
+            )
+            self._conn.commit()
+
+    def touch(self, kb_id: str):
+        now = time.time()
+        if now - self._touched.get(kb_id, 0) < self.touch_interval:
+            return
+        self._touched[kb_id] = now
+        with self._lock:
+            self._conn.execute("UPDATE knowledge_bases SET last_used_at = ? WHERE kb_id = ?", (now, kb_id))
+            self._conn.commit()
+
+    def update_size(self, kb_id: str, documents: int, chunks: int, size_bytes: int):
+        now = time.time()
+        self._touched[kb_id] = now
+        with self._lock:
+            self._conn.execute(
+                "UPDATE knowledge_bases SET documents = ?, chunks = ?, bytes = ?, last_used_at = ? WHERE kb_id = ?",
+                (documents, chunks, size_bytes, now, kb_id),
+            )
+            self._conn.commit()
+
+    def set_search_params(self, kb_id: str, search_params: dict):
+        """Update the retrieval parameters of a knowledge base, returns all its parameters."""
+        with self._lock:
+            row = self._conn.execute("SELECT search_params FROM knowledge_bases WHERE kb_id = ?", (kb_id,)).fetchone()
+            if row is None:
+                return None
+            search_params = {**json.loads(row[0] or "{}"), **search_params}
+            self._conn.execute(
+                "UPDATE knowledge_bases SET search_params = ? WHERE kb_id = ?", (json.dumps(search_params), kb_id)
+            )
+            self._conn.commit()
+        return search_params
+
+    def bump_generation(self, kb_id: str):
+        with self._lock:
+            self._conn.execute("UPDATE knowledge_bases SET generation = generation + 1 WHERE kb_id = ?", (kb_id,))
+            self._conn.commit()
+
+    def generation(self, kb_id: str):
+        """The generation of a knowledge base, None if it is unknown."""
+        with self._lock:
+            row = self._conn.execute("SELECT generation FROM knowledge_bases WHERE kb_id = ?", (kb_id,)).fetchone()
+        return row[0] if row else None
+
+    def get(self, kb_id: str):
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT {', '.join(COLUMNS)} FROM knowledge_bases WHERE kb_id = ?", (kb_id,)
+            ).fetchone()
+        return _entry(row) if row else None
+
+    def list(self):
+        """All the knowledge bases, the least recently used first."""
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT {', '.join(COLUMNS)} FROM knowledge_bases ORDER BY last_used_at"
+            ).fetchall()
+        return [_entry(row) for row in rows]
+
+    def remove(self, kb_id: str):
+        self._touched.pop(kb_id, None)
+        with self._lock:
+            self._conn.execute("DELETE FROM knowledge_bases WHERE kb_id = ?", (kb_id,))
+            self._conn.commit()
+
+
+def _entry(row):
+    entry = dict(zip(COLUMNS, row))
+    entry["search_params"] = json.loads(entry["search_params"] or "{}")
+    return entry
+
+
+def select_evictions(knowledge_bases: list, ttl: float = 0, budget_bytes: int = 0, now: float = None, protected=()):
+    """Choose the knowledge bases to evict, from a list sorted from the least recently used.
+
+    The knowledge bases unused for more than `ttl` seconds are evicted, then the least recently
+    used ones until the total footprint is within `budget_bytes`. A zero `ttl` or budget disables
+    the policy, and the `protected` knowledge bases, such as the ones being ingested, are kept.
+    """
+    now = now or time.time()
+    evicted = []
+    total = sum(kb["bytes"] for kb in knowledge_bases)
+    for kb in knowledge_bases:
+        if kb["kb_id"] in protected:
+            continue
+        if ttl > 0 and now - kb["last_used_at"] > ttl:
+            evicted.append(kb["kb_id"])
+            total -= kb["bytes"]
+        elif budget_bytes > 0 and total > budget_bytes:
+            evicted.append(kb["kb_id"])
+            total -= kb["bytes"]
+    return evicted
@@ -0,0 +1,494 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: Apache-2.0
+
+#
+
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import uuid
+from collections import namedtuple
+from typing import Iterable, List, Optional
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+from mmr import maximal_marginal_relevance
+
+# The index of the default knowledge base is LOCAL_VECTOR_DIR/INDEX_NAME, the index of an uploaded
+# knowledge base is in its persist folder.
+LOCAL_VECTOR_DIR = os.getenv("LOCAL_VECTOR_DIR", "./local_vectors")
+INDEX_NAME = os.getenv("INDEX_NAME", "rag-local")
+# The dtype of the vectors of the new indexes, float32 or float16
+LOCAL_VECTOR_DTYPE = os.getenv("LOCAL_VECTOR_DTYPE", "float32")
+# Indexes with at least LOCAL_IVF_MIN_VECTORS vectors are searched through an inverted file index,
+# in the LOCAL_IVF_NPROBE lists closest to the query, 0 always runs an exact search.
+LOCAL_IVF_MIN_VECTORS = int(os.getenv("LOCAL_IVF_MIN_VECTORS", 0))
+LOCAL_IVF_NPROBE = int(os.getenv("LOCAL_IVF_NPROBE", 8))
+
+VECTORS_FOLDER = "vectors"
+CHUNKS_FILE = "chunks.sqlite"
+VECTORS_FILE = "vectors.bin"
+IVF_CENTROIDS_FILE = "ivf_centroids.npy"
+IVF_LISTS_FILE = "ivf_lists.bin"
+SEARCH_BLOCK_ROWS = 65536
+
+# What a search reads, loaded again when the index changes
+_Snapshot = namedtuple("_Snapshot", ["version", "base", "vectors", "live", "centroids", "lists"])
+
+
+def index_folder(index_name: str, persist_dir: str = None):
+    """The folder of the index of a knowledge base, in its persist folder if it has one."""
+    if persist_dir:
+        return os.path.join(persist_dir, VECTORS_FOLDER)
+    return os.path.join(LOCAL_VECTOR_DIR, index_name)
+
+
+def index_version(folder: str):
+    """The version of the index in `folder`, changed by every write, without opening the index for writing."""
+    conn = sqlite3.connect(f"file:{os.path.join(os.path.abspath(folder), CHUNKS_FILE)}?mode=ro", uri=True)
+    try:
+        row = conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+    finally:
+        conn.close()
+    return int(row[0]) if row else 0
+
+
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+def _train_centroids(sample, nlist: int, iterations: int = 10, seed: int = 0):
+    """Spherical k-means of the normalized `sample`, returns `nlist` normalized centroids."""
+    rng = np.random.default_rng(seed)
+    centroids = sample[rng.choice(len(sample), nlist, replace=False)]
+    for _ in range(iterations):
+        assignments = np.argmax(sample @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, sample)
+        empty = np.bincount(assignments, minlength=nlist) == 0
+        # an empty list restarts from a random vector of the sample
+        sums[empty] = sample[rng.choice(len(sample), int(empty.sum()))]
+        centroids = _normalize(sums)
+    return centroids
+
+
+class LocalVectorStore(VectorStore):
+    """A vector store in a local folder, searched in process without a vector database server.
+
+    The normalized vectors are appended to a memory-mapped file, row after row, and the texts,
+    metadata and rows of the chunks are kept in a sqlite file, and the id of a chunk is returned
+    in the `_id` metadata of its documents. A search scores the query against
+    all the live rows with NumPy, so the similarity is the cosine, as in the Redis and Qdrant
+    indexes. Once the index holds `ivf_min_vectors` vectors, the vectors are clustered by k-means
+    into an inverted file index, and a search only scores the rows of the `nprobe` clusters
+    closest to the query. Deleted rows are skipped, and the files are compacted once most of
+    the rows are deleted. The folder can be shared by the worker processes of the service.
+
+    Row numbers are never reused: the row files hold the rows from `row_base` on, and a
+    compaction copies the live rows to new files, under new row numbers, published with the
+    metadata in a single transaction, so a search running on the previous snapshot never
+    returns the chunks of other rows. `close` releases the sqlite connection, which is opened
+    again if the store is still used, e.g. by a request that started before it was closed.
+    """
+
+    def __init__(
+        self,
+        folder: str,
+        embedding: Embeddings,
+        dtype: str = LOCAL_VECTOR_DTYPE,
+        ivf_min_vectors: int = LOCAL_IVF_MIN_VECTORS,
+        nprobe: int = LOCAL_IVF_NPROBE,
+    ):
+        self.folder = folder
+        self._embedding = embedding
+        self.ivf_min_vectors = ivf_min_vectors
+        self.nprobe = nprobe
+        os.makedirs(folder, exist_ok=True)
+        self._lock = threading.RLock()
+        self._snapshot = None
+        self._conn = None
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS chunks (id TEXT PRIMARY KEY, row INTEGER UNIQUE, text TEXT, metadata TEXT)"
+        )
+        self._db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        # the dtype is chosen when the index is created
+        self._db.execute("INSERT OR IGNORE INTO meta VALUES ('dtype', ?)", (np.dtype(dtype).name,))
+
+    @property
+    def _db(self):
+        """The sqlite connection, opened again if the store was closed."""
+        with self._lock:
+            if self._conn is None:
+                self._conn = sqlite3.connect(
+                    os.path.join(self.folder, CHUNKS_FILE), check_same_thread=False, isolation_level=None
+                )
+                self._conn.execute("PRAGMA journal_mode=WAL")
+            return self._conn
+
+    @property
+    def embeddings(self):
+        return self._embedding
+
+    @property
+    def dtype(self):
+        return np.dtype(self._meta("dtype"))
+
+    @property
+    def dim(self):
+        dim = self._meta("dim")
+        return int(dim) if dim else None
+
+    def _path(self, name: str):
+        return os.path.join(self.folder, name)
+
+    def _meta(self, key: str, default=None):
+        with self._lock:
+            row = self._db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def _set_meta(self, **values):
+        self._db.executemany("INSERT OR REPLACE INTO meta VALUES (?, ?)", [(k, str(v)) for k, v in values.items()])
+
+    def _bump_version(self):
+        self._set_meta(version=int(self._meta("version", 0)) + 1)
+
+    def _row_files(self):
+        """The first row of the row files, and the names of the vectors and inverted lists files."""
+        return (
+            int(self._meta("row_base", 0)),
+            self._meta("vectors_file", VECTORS_FILE),
+            self._meta("lists_file", IVF_LISTS_FILE),
+        )
+
+    def _write_rows(self, name: str, rows, values):
+        """Write `values` at the offsets `rows` of the row file `name`, consecutive rows in a single write."""
+        path = self._path(name)
+        row_bytes = values[0].nbytes
+        with open(path, "r+b" if os.path.exists(path) else "w+b") as f:
+            start = 0
+            for i in range(1, len(rows) + 1):
+                if i == len(rows) or rows[i] != rows[i - 1] + 1:
+                    f.seek(rows[start] * row_bytes)
+                    f.write(np.ascontiguousarray(values[start:i]).tobytes())
+                    start = i
+
+    def add_texts(self, texts: Iterable[str], metadatas: Optional[List[dict]] = None, ids=None, **kwargs):
+        texts = list(texts)
+        return self.add_vectors(texts, self._embedding.embed_documents(texts), metadatas, ids)
+
+    def add_vectors(self, texts: List[str], vectors, metadatas: Optional[List[dict]] = None, ids=None):
+        """Store the chunks with their vectors, a chunk with the id of a stored chunk replaces it."""
+        if not texts:
+            return []
+        metadatas = metadatas or [{} for _ in texts]
+        ids = [str(chunk_id) for chunk_id in ids] if ids else [str(uuid.uuid4()) for _ in texts]
+        vectors = _normalize(vectors)
+        with self._lock:
+            # an immediate transaction also serializes the writes of the other processes
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                dim = self.dim
+                if dim is None:
+                    self._set_meta(dim=vectors.shape[1])
+                elif dim != vectors.shape[1]:
+                    raise ValueError(f"The index stores vectors of dimension {dim}, not {vectors.shape[1]}")
+                existing = dict(self._select("SELECT id, row FROM chunks WHERE id IN ({})", ids))
+                base, vectors_file, lists_file = self._row_files()
+                next_row = int(self._meta("next_row", base))
+                rows = []
+                for chunk_id in ids:
+                    if chunk_id not in existing:
+                        existing[chunk_id] = next_row
+                        next_row += 1
+                    rows.append(existing[chunk_id])
+                order = np.argsort(rows)
+                sorted_rows = [rows[i] - base for i in order]
+                self._write_rows(vectors_file, sorted_rows, vectors[order].astype(self.dtype))
+                if os.path.exists(self._path(IVF_CENTROIDS_FILE)):
+                    centroids = np.load(self._path(IVF_CENTROIDS_FILE))
+                    lists = np.argmax(vectors[order] @ centroids.T, axis=1).astype(np.int32)
+                    self._write_rows(lists_file, sorted_rows, lists)
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO chunks VALUES (?, ?, ?, ?)",
+                    [(i, r, t, json.dumps(m)) for i, r, t, m in zip(ids, rows, texts, metadatas)],
+                )
+                self._set_meta(next_row=next_row)
+                self._bump_version()
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+        self._maybe_train_ivf()
+        return ids
+
+    def _select(self, sql: str, values: list):
+        """Run a query with an `IN ({})` clause on `values`, in batches within the host parameter limit."""
+        rows = []
+        for i in range(0, len(values), 500):
+            batch = list(values[i : i + 500])
+            rows.extend(self._db.execute(sql.format(",".join("?" * len(batch))), batch).fetchall())
+        return rows
+
+    def delete(self, ids: Optional[List[str]] = None, **kwargs):
+        if not ids:
+            return False
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                for i in range(0, len(ids), 500):
+                    batch = [str(chunk_id) for chunk_id in ids[i : i + 500]]
+                    self._db.execute(f"DELETE FROM chunks WHERE id IN ({','.join('?' * len(batch))})", batch)
+                self._bump_version()
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            live = self._db.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+            base = int(self._meta("row_base", 0))
+            if int(self._meta("next_row", base)) - base - live > max(live, 1024):
+                self.compact()
+        return True
+
+    def compact(self):
+        """Copy the live rows to new row files, numbered after the last row, and delete the old files."""
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            written = []
+            try:
+                dim, dtype = self.dim, self.dtype
+                rows = [row for (row,) in self._db.execute("SELECT row FROM chunks ORDER BY row")]
+                base, vectors_file, lists_file = self._row_files()
+                next_row = int(self._meta("next_row", base))
+                new_files = {}
+                for key, name, row_dtype, shape in [
+                    ("vectors_file", vectors_file, dtype, (next_row - base, dim)),
+                    ("lists_file", lists_file, np.int32, (next_row - base,)),
+                ]:
+                    # the new rows follow the last row, so the rows of a snapshot are never reused
+                    new_files[key] = "{}.{}.bin".format(name.split(".")[0], next_row)
+                    if not os.path.exists(self._path(name)) or next_row == base:
+                        continue
+                    values = np.memmap(self._path(name), dtype=row_dtype, mode="r", shape=shape)
+                    written.append(self._path(new_files[key]))
+                    with open(written[-1], "wb") as f:
+                        for i in range(0, len(rows), SEARCH_BLOCK_ROWS):
+                            offsets = [row - base for row in rows[i : i + SEARCH_BLOCK_ROWS]]
+                            f.write(np.ascontiguousarray(values[offsets]).tobytes())
+                    del values
+                self._db.executemany(
+                    "UPDATE chunks SET row = ? WHERE row = ?", [(next_row + new, old) for new, old in enumerate(rows)]
+                )
+                self._set_meta(row_base=next_row, next_row=next_row + len(rows), **new_files)
+                self._bump_version()
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                for path in written:
+                    os.remove(path)
+                raise
+            # the snapshots that mapped the old files keep reading them until they are released
+            for name in (vectors_file, lists_file):
+                if os.path.exists(self._path(name)):
+                    os.remove(self._path(name))
+        print(f"[rag - local vectorstore] compacted {self.folder} from {next_row - base} to {len(rows)} rows")
+
+    def _maybe_train_ivf(self):
+        if self.ivf_min_vectors <= 0:
+            return
+        live = self.count()
+        trained = int(self._meta("ivf_rows", 0))
+        # trained again once the index has doubled
+        if live >= self.ivf_min_vectors and live >= 2 * trained:
+            self.build_ivf()
+
+    def build_ivf(self, nlist: int = None, sample_size: int = 64):
+        """Cluster the vectors into `nlist` lists, by default the square root of the number of vectors."""
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                dim, dtype = self.dim, self.dtype
+                base, vectors_file, lists_file = self._row_files()
+                size = int(self._meta("next_row", base)) - base
+                rows = np.array([row for (row,) in self._db.execute("SELECT row FROM chunks")], dtype=np.int64)
+                nlist = min(nlist or max(int(np.sqrt(len(rows))), 1), len(rows))
+                vectors = np.memmap(self._path(vectors_file), dtype=dtype, mode="r", shape=(size, dim))
+                rng = np.random.default_rng(0)
+                sample_rows = np.sort(rng.choice(rows - base, min(len(rows), nlist * sample_size), replace=False))
+                centroids = _train_centroids(np.asarray(vectors[sample_rows], dtype=np.float32), nlist)
+                lists = np.empty(size, dtype=np.int32)
+                for i in range(0, size, SEARCH_BLOCK_ROWS):
+                    block = np.asarray(vectors[i : i + SEARCH_BLOCK_ROWS], dtype=np.float32)
+                    lists[i : i + SEARCH_BLOCK_ROWS] = np.argmax(block @ centroids.T, axis=1)
+                del vectors
+                fd, tmp_path = tempfile.mkstemp(dir=self.folder, suffix=".tmp")
+                with os.fdopen(fd, "wb") as f:
+                    f.write(lists.tobytes())
+                os.replace(tmp_path, self._path(lists_file))
+                fd, tmp_path = tempfile.mkstemp(dir=self.folder, suffix=".npy")
+                with os.fdopen(fd, "wb") as f:
+                    np.save(f, centroids)
+                os.replace(tmp_path, self._path(IVF_CENTROIDS_FILE))
+                self._set_meta(ivf_rows=len(rows))
+                self._bump_version()
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+        print(f"[rag - local vectorstore] built {nlist} inverted lists for {len(rows)} vectors of {self.folder}")
+
+    def _load(self):
+        """The current snapshot of the index, loaded again if another thread or process changed it."""
+        with self._lock:
+            try:
+                return self._read_snapshot()
+            except FileNotFoundError:
+                # the files were compacted by another process since the metadata was read
+                return self._read_snapshot()
+
+    def _read_snapshot(self):
+        # a read transaction, so that the metadata and the rows are read from the same commit
+        self._db.execute("BEGIN")
+        try:
+            version = self._meta("version", "0")
+            if self._snapshot is not None and self._snapshot.version == version:
+                return self._snapshot
+            base, vectors_file, lists_file = self._row_files()
+            size, dim = int(self._meta("next_row", base)) - base, self.dim
+            live = np.zeros(size, dtype=bool)
+            live[[row - base for (row,) in self._db.execute("SELECT row FROM chunks")]] = True
+            vectors = centroids = lists = None
+            if size:
+                vectors = np.memmap(self._path(vectors_file), dtype=self.dtype, mode="r", shape=(size, dim))
+            if size and os.path.exists(self._path(IVF_CENTROIDS_FILE)):
+                centroids = np.load(self._path(IVF_CENTROIDS_FILE))
+                lists = np.memmap(self._path(lists_file), dtype=np.int32, mode="r", shape=(size,))
+            self._snapshot = _Snapshot(version, base, vectors, live, centroids, lists)
+            return self._snapshot
+        finally:
+            self._db.execute("COMMIT")
+
+    def _top_rows(self, snapshot: _Snapshot, embedding: List[float], k: int):
+        """The offsets in `snapshot` of the `k` vectors closest to `embedding`, with their cosine similarity, best first."""
+        if snapshot.vectors is None or k <= 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        query = _normalize(embedding)
+        if snapshot.centroids is not None and self.nprobe < len(snapshot.centroids):
+            probes = np.argpartition(-(snapshot.centroids @ query), self.nprobe)[: self.nprobe]
+            candidates = np.flatnonzero(np.isin(snapshot.lists, probes) & snapshot.live)
+            scores = np.asarray(snapshot.vectors[candidates], dtype=np.float32) @ query
+        else:
+            candidates = np.flatnonzero(snapshot.live)
+            scores = np.empty(len(snapshot.live), dtype=np.float32)
+            # scored in blocks, so that a float16 index is never converted as a whole
+            for i in range(0, len(snapshot.live), SEARCH_BLOCK_ROWS):
+                block = np.asarray(snapshot.vectors[i : i + SEARCH_BLOCK_ROWS], dtype=np.float32)
+                scores[i : i + SEARCH_BLOCK_ROWS] = block @ query
+            scores = scores[candidates]
+        if len(candidates) > k:
+            top = np.argpartition(-scores, k)[:k]
+            candidates, scores = candidates[top], scores[top]
+        order = np.argsort(-scores, kind="stable")
+        return candidates[order], scores[order]
+
+    def _documents(self, rows):
+        """The documents stored at `rows`, in the same order, None for the rows deleted or compacted since the search."""
+        with self._lock:
+            found = {
+                row: Document(page_content=text, metadata={**json.loads(metadata), "_id": chunk_id})
+                for row, chunk_id, text, metadata in self._select(
+                    "SELECT row, id, text, metadata FROM chunks WHERE row IN ({})", [int(row) for row in rows]
+                )
+            }
+        return [found.get(int(row)) for row in rows]
+
+    def documents_by_ids(self, ids: List[str]):
+        """The documents stored with `ids`, in the same order, None for the ids that are not stored."""
+        with self._lock:
+            found = {
+                chunk_id: Document(page_content=text, metadata={**json.loads(metadata), "_id": chunk_id})
+                for chunk_id, text, metadata in self._select(
+                    "SELECT id, text, metadata FROM chunks WHERE id IN ({})", [str(chunk_id) for chunk_id in ids]
+                )
+            }
+        return [found.get(str(chunk_id)) for chunk_id in ids]
+
+    def similarity_search_with_score_by_vector(self, embedding: List[float], k: int = 4, **kwargs):
+        snapshot = self._load()
+        offsets, scores = self._top_rows(snapshot, embedding, k)
+        documents = self._documents(offsets + snapshot.base)
+        return [(doc, float(score)) for doc, score in zip(documents, scores) if doc is not None]
+
+    def similarity_search_with_score(self, query: str, k: int = 4, **kwargs):
+        return self.similarity_search_with_score_by_vector(self._embedding.embed_query(query), k, **kwargs)
+
+    def similarity_search_by_vector(self, embedding: List[float], k: int = 4, **kwargs):
+        return [doc for doc, _ in self.similarity_search_with_score_by_vector(embedding, k, **kwargs)]
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs):
+        return [doc for doc, _ in self.similarity_search_with_score(query, k, **kwargs)]
+
+    def _select_relevance_score_fn(self):
+        # the cosine similarity, from [-1, 1] to [0, 1]
+        return lambda score: (score + 1) / 2
+
+    def similarity_search_with_vectors(self, embedding: List[float], k: int = 4):
+        """The `k` documents closest to `embedding`, with their normalized vectors."""
+        snapshot = self._load()
+        offsets, _ = self._top_rows(snapshot, embedding, k)
+        documents = self._documents(offsets + snapshot.base)
+        kept = [i for i, doc in enumerate(documents) if doc is not None]
+        vectors = np.asarray(snapshot.vectors[offsets[kept]], dtype=np.float32) if kept else np.empty((0, 0))
+        return [documents[i] for i in kept], vectors
+
+    def max_marginal_relevance_search_by_vector(
+        self, embedding: List[float], k: int = 4, fetch_k: int = 20, lambda_mult: float = 0.5, **kwargs
+    ):
+        documents, vectors = self.similarity_search_with_vectors(embedding, fetch_k)
+        return [documents[i] for i in maximal_marginal_relevance(embedding, vectors, k, lambda_mult)]
+
+    def max_marginal_relevance_search(
+        self, query: str, k: int = 4, fetch_k: int = 20, lambda_mult: float = 0.5, **kwargs
+    ):
+        embedding = self._embedding.embed_query(query)
+        return self.max_marginal_relevance_search_by_vector(embedding, k, fetch_k, lambda_mult, **kwargs)
+
+    @classmethod
+    def from_texts(
+        cls,
+        texts: List[str],
+        embedding: Embeddings,
+        metadatas: Optional[List[dict]] = None,
+        ids=None,
+        folder: str = None,
+        index_name: str = INDEX_NAME,
+        **kwargs,
+    ):
+        vdb = cls(folder or index_folder(index_name), embedding, **kwargs)
+        vdb.add_texts(texts, metadatas, ids=ids)
+        return vdb
+
+    def count(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+
+    def close(self):
+        """Release the connection and the snapshot, a store that is still used opens them again."""
+        with self._lock:
+            self._snapshot = None
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def drop(self):
+        """Delete the index with all its files."""
+        self.close()
+        shutil.rmtree(self.folder, ignore_errors=True)
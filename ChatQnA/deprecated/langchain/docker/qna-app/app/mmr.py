@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: Apache-2.0
+
+#
+
+import os
+from typing import Any, List, Optional
+
+import numpy as np
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.runnables import ConfigurableField
+from langchain_core.vectorstores import VectorStore
+
+# Default MMR parameters of the retrievers: number of returned chunks, number of candidates fetched
+# from the vector store, and trade-off between relevance (1) and diversity (0).
+MMR_K = int(os.getenv("MMR_K", 4))
+MMR_FETCH_K = int(os.getenv("MMR_FETCH_K", 20))
+MMR_LAMBDA_MULT = float(os.getenv("MMR_LAMBDA_MULT", 0.5))
+
+
+def maximal_marginal_relevance(query_embedding, embeddings, k: int = 4, lambda_mult: float = 0.5) -> List[int]:
+    """The indices of the `k` embeddings selected by maximal marginal relevance, in order of selection.
+
+    Selects the same embeddings as `langchain_community.vectorstores.utils.maximal_marginal_relevance`,
+    but the similarities are computed with one matrix product per selected embedding, and the
+    redundancy of every candidate is updated incrementally instead of recomputed at every step.
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    k = min(k, len(embeddings))
+    if k <= 0:
+        return []
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    embeddings = embeddings / np.where(norms == 0, 1, norms)
+    query = np.asarray(query_embedding, dtype=np.float32).reshape(-1)
+    query = query / (np.linalg.norm(query) or 1)
+    similarity = embeddings @ query
+    relevance = lambda_mult * similarity
+    selected = [int(np.argmax(similarity))]
+    # the highest similarity of every candidate to the selected embeddings
+    redundancy = embeddings @ embeddings[selected[0]]
+    available = np.ones(len(embeddings), dtype=bool)
+    available[selected[0]] = False
+    while len(selected) < k:
+        scores = np.where(available, relevance - (1 - lambda_mult) * redundancy, -np.inf)
+        best = int(np.argmax(scores))
+        selected.append(best)
+        available[best] = False
+        np.maximum(redundancy, embeddings @ embeddings[best], out=redundancy)
+    return selected
+
+
+def search_with_vectors(vectorstore: VectorStore, embedding: List[float], k: int):
+    """The `k` chunks closest to `embedding` with their vectors, fetched in a single round trip."""
+    if hasattr(vectorstore, "similarity_search_with_vectors"):
+        return vectorstore.similarity_search_with_vectors(embedding, k)
+
+    from langchain_community.vectorstores import Qdrant, Redis
+
+    if isinstance(vectorstore, Redis):
+        documents = vectorstore.similarity_search_by_vector(embedding, k=k, return_metadata=True)
+        schema = vectorstore._schema
+        pipeline = vectorstore.client.pipeline(transaction=False)
+        for doc in documents:
+            pipeline.hget(doc.metadata["id"], schema.content_vector_key)
+        vectors = [np.frombuffer(vector, dtype=schema.vector_dtype) for vector in pipeline.execute()]
+        return documents, vectors
+
+    if isinstance(vectorstore, Qdrant):
+        query_vector = embedding if vectorstore.vector_name is None else (vectorstore.vector_name, embedding)
+        results = vectorstore.client.search(
+            collection_name=vectorstore.collection_name,
+            query_vector=query_vector,
+            limit=k,
+            with_payload=True,
+            with_vectors=True,
+        )
+        documents = [
+            vectorstore._document_from_scored_point(
+                result, vectorstore.collection_name, vectorstore.content_payload_key, vectorstore.metadata_payload_key
+            )
+            for result in results
+        ]
+        vectors = [
+            result.vector if vectorstore.vector_name is None else result.vector[vectorstore.vector_name]
+            for result in results
+        ]
+        return documents, vectors
+
+    raise ValueError(f"Unsupported vector store: {type(vectorstore).__name__}")
+
+
+def chunk_id(vectorstore: VectorStore, doc: Document):
+    """The id a chunk was stored with, as indexed by BM25."""
+    if "_id" in doc.metadata:
+        return str(doc.metadata["_id"])
+    # the Redis keys are the ids prefixed by the index name
+    prefix = vectorstore.key_prefix + ":"
+    key = doc.metadata["id"]
+    return key[len(prefix) :] if key.startswith(prefix) else key
+
+
+def _decode(value):
+    return value.decode("utf-8") if isinstance(value, bytes) else value
+
+
+def documents_by_ids(vectorstore: VectorStore, ids: List[str]):
+    """The chunks stored with `ids`, in the same order, None for the ids that are not stored."""
+    if hasattr(vectorstore, "documents_by_ids"):
+        return vectorstore.documents_by_ids(ids)
+
+    from langchain_community.vectorstores import Qdrant, Redis
+
+    if isinstance(vectorstore, Redis):
+        schema = vectorstore._schema
+        pipeline = vectorstore.client.pipeline(transaction=False)
+        for i in ids:
+            pipeline.hgetall(f"{vectorstore.key_prefix}:{i}")
+        documents = []
+        for i, fields in zip(ids, pipeline.execute()):
+            fields = {_decode(key): value for key, value in fields.items()}
+            if schema.content_key not in fields:
+                documents.append(None)
+                continue
+            metadata = {
+                key: _decode(value)
+                for key, value in fields.items()
+                if key not in (schema.content_key, schema.content_vector_key)
+            }
+            metadata["id"] = f"{vectorstore.key_prefix}:{i}"
+            documents.append(Document(page_content=_decode(fields[schema.content_key]), metadata=metadata))
+        return documents
+
+    if isinstance(vectorstore, Qdrant):
+        records = vectorstore.client.retrieve(vectorstore.collection_name, ids=ids, with_payload=True)
+        found = {
+            str(record.id): vectorstore._document_from_scored_point(
+                record, vectorstore.collection_name, vectorstore.content_payload_key, vectorstore.metadata_payload_key
+            )
+            for record in records
+        }
+        return [found.get(str(i)) for i in ids]
+
+    raise ValueError(f"Unsupported vector store: {type(vectorstore).__name__}")
+
+
+class MMRRetriever(BaseRetriever):
+    """Retrieve chunks by maximal marginal relevance among the `fetch_k` chunks closest to the query.
+
+    The candidates are fetched with their vectors in a single request to the vector store, and
+    the selection runs in process with `maximal_marginal_relevance`. With a `cache`, the ids of
+    the retrieved chunks are cached, and the chunks of a repeated query are fetched by id.
+    """
+
+    vectorstore: VectorStore
+    k: int = MMR_K
+    fetch_k: int = MMR_FETCH_K
+    lambda_mult: float = MMR_LAMBDA_MULT
+    # the results are cached by `cache`, a `RetrievalCache`, as those of the knowledge base `cache_scope`
+    cache: Optional[Any] = None
+    cache_scope: str = ""
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def _search(self, query: str):
+        """The retrieved chunks with their cosine similarity to the query."""
+        embedding = self.vectorstore.embeddings.embed_query(query)
+        documents, vectors = search_with_vectors(self.vectorstore, embedding, max(self.fetch_k, self.k))
+        selected = maximal_marginal_relevance(embedding, vectors, self.k, self.lambda_mult)
+        if not selected:
+            return []
+        vectors = np.asarray([vectors[i] for i in selected], dtype=np.float32)
+        query = np.asarray(embedding, dtype=np.float32)
+        scores = vectors @ query / np.maximum(np.linalg.norm(vectors, axis=1) * np.linalg.norm(query), 1e-12)
+        return [(documents[i], float(score)) for i, score in zip(selected, scores)]
+
+    def _search_params(self):
+        """The parameters the results of `_search` depend on, part of the key of the cached results."""
+        return (type(self).__name__, self.k, self.fetch_k, self.lambda_mult)
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        key = self.cache.key(self.cache_scope, query, self._search_params()) if self.cache is not None else None
+        results = self.cache.get(key) if key is not None else None
+        if results is not None:
+            documents = documents_by_ids(self.vectorstore, [i for i, _ in results])
+            if all(doc is not None for doc in documents):
+                return documents
+            self.cache.discard(key)
+        results = self._search(query)
+        if key is not None:
+            self.cache.put(key, [(chunk_id(self.vectorstore, doc), score) for doc, score in results])
+        return [doc for doc, _ in results]
+
+    def configurable(self):
+        """The retriever with its parameters set per request by the `k`, `fetch_k` and `lambda_mult` config keys."""
+        return self.configurable_fields(
+            k=ConfigurableField(id="k", name="k", description="Number of retrieved chunks"),
+            fetch_k=ConfigurableField(id="fetch_k", name="fetch_k", description="Number of MMR candidates"),
+            lambda_mult=ConfigurableField(
+                id="lambda_mult", name="lambda_mult", description="Relevance (1) to diversity (0) trade-off"
+            ),
+        )
+
+
+def parse_search_params(params: dict):
+    """The MMR and hybrid search parameters given in `params`, raises ValueError if one is invalid."""
+    search_params = {}
+    for name, cast in [("k", int), ("fetch_k", int), ("lambda_mult", float)]:
+        if params.get(name) is not None:
+            try:
+                search_params[name] = cast(params[name])
+            except (TypeError, ValueError):
+                raise ValueError(f"Invalid {name}: {params[name]}")
+    if params.get("hybrid") is not None:
+        hybrid = params["hybrid"]
+        if isinstance(hybrid, str) and hybrid.lower() in ["true", "1", "false", "0"]:
+            hybrid = hybrid.lower() in ["true", "1"]
+        if not isinstance(hybrid, bool):
+            raise ValueError(f"Invalid hybrid: {hybrid}")
+        search_params["hybrid"] = hybrid
+    if search_params.get("k", 1) < 1 or search_params.get("fetch_k", 1) < 1:
+        raise ValueError("k and fetch_k should be positive")
+    if not 0 <= search_params.get("lambda_mult", 0) <= 1:
+        raise ValueError("lambda_mult should be between 0 and 1")
+    return search_params
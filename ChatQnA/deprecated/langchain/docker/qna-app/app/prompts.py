@@ -55,3 +55,13 @@ qa_prompt = ChatPromptTemplate.from_messages(
         ("human", "{question}"),
     ]
 )
+
+
+# ========= chat history summary prompt =========
+summarize_history_template = """Summarize the following conversation between a user and an assistant \
+in a few sentences. Keep the facts, names and numbers that later questions may refer to.
+
+{conversation}
+
+Summary:"""
+summarize_history_prompt = ChatPromptTemplate.from_template(summarize_history_template)
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: Apache-2.0
+
+#
+
+import os
+import threading
+import time
+from collections import Counter, OrderedDict
+
+from embedding_cache import normalize_text
+
+# The chunks retrieved for the last RETRIEVAL_CACHE_SIZE queries are cached (0 disables it). The results
+# of a query expire RETRIEVAL_CACHE_TTL seconds after they were retrieved, however often they are hit.
+RETRIEVAL_CACHE_SIZE = int(os.getenv("RETRIEVAL_CACHE_SIZE", 10000))
+RETRIEVAL_CACHE_TTL = float(os.getenv("RETRIEVAL_CACHE_TTL", 3600))
+# The generation of the default knowledge base is read from its index at most every GENERATION_REFRESH
+# seconds, which bounds the time a process keeps returning the results cached before it was ingested.
+GENERATION_REFRESH = 1.0
+
+
+class IndexGeneration:
+    """The generation of an index changed outside of the server, read by `read` at most every `refresh` seconds."""
+
+    def __init__(self, read, refresh: float = GENERATION_REFRESH):
+        self.read = read
+        self.refresh = refresh
+        self._lock = threading.Lock()
+        self._cached = None
+
+    def __call__(self):
+        now = time.monotonic()
+        with self._lock:
+            cached = self._cached
+        if cached is not None and now - cached[1] < self.refresh:
+            return cached[0]
+        generation = self.read()
+        with self._lock:
+            self._cached = (generation, now)
+        return generation
+
+
+class RetrievalCache:
+    """The ids and scores of the chunks retrieved for the last `maxsize` queries, kept in process.
+
+    Results are keyed by knowledge base, by the generation of the knowledge base returned by
+    `generation(kb_id)`, by normalized query and by search parameters, and expire `ttl` seconds
+    after they were retrieved. A generation changes whenever the chunks of its knowledge base
+    change, so the results cached before are never returned again and age out of the LRU. The
+    chunks of a hit are fetched by id, and results whose chunks are gone are discarded.
+    """
+
+    def __init__(self, generation, maxsize: int = RETRIEVAL_CACHE_SIZE, ttl: float = RETRIEVAL_CACHE_TTL):
+        assert maxsize > 0, "maxsize should be positive"
+        self.generation = generation
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # key -> (results, expiry time), least recently used first
+        self._entries = OrderedDict()
+        self._stats = Counter()
+
+    def key(self, kb_id: str, query: str, search_params: tuple):
+        """The key of the results of `query` on the current generation of `kb_id`, None if it is unknown."""
+        try:
+            generation = self.generation(kb_id)
+        except Exception as e:
+            print(f"[rag - retrieval cache] generation lookup failed: {e}")
+            return None
+        if generation is None:
+            return None
+        return (kb_id, generation, normalize_text(query), search_params)
+
+    def get(self, key):
+        """The cached (chunk id, score) results of `key`, best first, None on a miss."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] < time.monotonic():
+                del self._entries[key]
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+            self._stats["hits" if entry is not None else "misses"] += 1
+        return entry[0] if entry is not None else None
+
+    def put(self, key, results):
+        with self._lock:
+            self._entries[key] = (tuple(results), time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def discard(self, key):
+        """Drop the results of `key` whose chunks could not all be fetched, they are retrieved again."""
+        with self._lock:
+            self._entries.pop(key, None)
+            self._stats["stale"] += 1
+
+    def stats(self):
+        """The number of lookups, of hits, and the hit rate since the cache was created."""
+        with self._lock:
+            hits, misses, stale = self._stats["hits"], self._stats["misses"], self._stats["stale"]
+            size = len(self._entries)
+        return {
+            "lookups": hits + misses,
+            "hits": hits - stale,
+            "misses": misses + stale,
+            "hit_rate": (hits - stale) / (hits + misses) if hits + misses else 0.0,
+            "size": size,
+        }
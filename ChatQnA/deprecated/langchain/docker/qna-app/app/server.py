@@ -7,50 +7,151 @@
 
 import argparse
 import os
-
-from fastapi import APIRouter, FastAPI, File, Request, UploadFile
+import shutil
+import threading
+import time
+from collections import namedtuple
+from typing import Optional
+
+from cache import LRUCache
+from embedding_cache import CachedEmbeddings, EmbeddingStore, QueryEmbeddingCache
+from fastapi import APIRouter, FastAPI, File, Form, Request, UploadFile
 from fastapi.responses import JSONResponse, RedirectResponse, StreamingResponse
-from guardrails import moderation_prompt_for_chat, unsafe_dict
+from guardrails import (
+    GuardrailViolation,
+    StreamingOutputModerator,
+    get_policy_violations,
+    moderation_prompt_for_chat,
+    speculative_call,
+    speculative_stream,
+)
+from history import create_chat_history_store
+from hybrid import HybridRetriever
+from ingest_job import IngestJob
+from jobs import JobManager, JobQueueFull
+from kb_registry import KnowledgeBaseRegistry, select_evictions
 from langchain_community.embeddings import HuggingFaceBgeEmbeddings, HuggingFaceHubEmbeddings
 from langchain_community.llms import HuggingFaceEndpoint
-from langchain_core.messages import HumanMessage
+from langchain_core.messages import AIMessage, HumanMessage
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.runnables import RunnablePassthrough
 from langserve import add_routes
-from prompts import contextualize_q_prompt, prompt, qa_prompt
+from mmr import MMRRetriever, parse_search_params
+from prompts import contextualize_q_prompt, prompt, qa_prompt, summarize_history_prompt
+from retrieval_cache import RETRIEVAL_CACHE_SIZE, RETRIEVAL_CACHE_TTL, IndexGeneration, RetrievalCache
+from sse import SSE_FORMATTERS, SSEEncoder, is_legacy_token
+from starlette.concurrency import run_in_threadpool
 from starlette.middleware.cors import CORSMiddleware
 from utils import (
     VECTOR_DATABASE,
     create_kb_folder,
     create_retriever_from_files,
     create_retriever_from_links,
+    delete_document,
+    drop_knowledge_base,
     get_current_beijing_time,
-    post_process_text,
-    reload_retriever,
+    get_document,
+    get_kb_folder,
+    index_generation,
+    knowledge_base_footprint,
+    list_documents,
+    release_vectorstore,
+    reload_vectorstore,
+    run_ingest_job,
 )
 
 if VECTOR_DATABASE == "REDIS":
-    from rag_redis.config import INDEX_NAME
+    from rag_redis.config import INDEX_NAME, REDIS_URL
 elif VECTOR_DATABASE == "QDRANT":
     from rag_qdrant.config import COLLECTION_NAME as INDEX_NAME
 
+    REDIS_URL = None
+elif VECTOR_DATABASE == "LOCAL":
+    from local_vectorstore import INDEX_NAME
+
+    REDIS_URL = None
+
 parser = argparse.ArgumentParser(description="Server Configuration")
 parser.add_argument("--chathistory", action="store_true", help="Enable debug mode")
+parser.add_argument("--workers", type=int, default=int(os.getenv("UVICORN_WORKERS", 1)), help="Number of workers")
 args = parser.parse_args()
 
-app = FastAPI()
-
-app.add_middleware(
-    CORSMiddleware, allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"]
+# "serial" checks the input before retrieval starts, "speculative" runs the check concurrently with
+# retrieval and generation, and discards the buffered answer if the input is flagged.
+SAFETY_GUARD_MODE = os.getenv("SAFETY_GUARD_MODE", "serial").lower()
+assert SAFETY_GUARD_MODE in ["serial", "speculative"], f"Invalid SAFETY_GUARD_MODE: {SAFETY_GUARD_MODE}"
+
+# The streamed answer is moderated in windows of about OUTPUT_GUARD_WINDOW characters, with at most
+# OUTPUT_GUARD_MAX_LAG windows sent to the client before their check completes.
+OUTPUT_GUARD_WINDOW = int(os.getenv("OUTPUT_GUARD_WINDOW", 256))
+OUTPUT_GUARD_MAX_LAG = int(os.getenv("OUTPUT_GUARD_MAX_LAG", 2))
+
+# Streamed tokens are coalesced into frames sent every SSE_FLUSH_INTERVAL_MS milliseconds or once
+# SSE_FLUSH_BYTES bytes are buffered, SSE_FLUSH_INTERVAL_MS=0 sends one frame per token.
+SSE_FLUSH_INTERVAL = float(os.getenv("SSE_FLUSH_INTERVAL_MS", 20)) / 1000
+SSE_FLUSH_BYTES = int(os.getenv("SSE_FLUSH_BYTES", 1024))
+SSE_FORMAT = os.getenv("SSE_FORMAT", "legacy").lower()
+assert SSE_FORMAT in SSE_FORMATTERS, f"Invalid SSE_FORMAT: {SSE_FORMAT}"
+
+# Content-addressed store of the chunk embeddings shared by all knowledge bases, empty to disable it
+EMBEDDING_CACHE = os.getenv(
+    "EMBEDDING_CACHE", os.path.join(os.getenv("RAG_UPLOAD_DIR", "./upload_dir"), "embedding_cache.sqlite")
 )
+# The store keeps the EMBEDDING_CACHE_MAX_ROWS most recently used embeddings, and deletes the embeddings
+# unused for EMBEDDING_CACHE_MAX_AGE seconds, 0 disables either limit.
+EMBEDDING_CACHE_MAX_ROWS = int(os.getenv("EMBEDDING_CACHE_MAX_ROWS", 1000000))
+EMBEDDING_CACHE_MAX_AGE = float(os.getenv("EMBEDDING_CACHE_MAX_AGE", 30 * 86400))
+
+# The embeddings of the last QUERY_EMBEDDING_CACHE_SIZE queries are kept in process (0 disables it), and
+# in the Redis of QUERY_EMBEDDING_CACHE_REDIS_URL for QUERY_EMBEDDING_CACHE_TTL seconds when it is set.
+QUERY_EMBEDDING_CACHE_SIZE = int(os.getenv("QUERY_EMBEDDING_CACHE_SIZE", 10000))
+QUERY_EMBEDDING_CACHE_REDIS_URL = os.getenv("QUERY_EMBEDDING_CACHE_REDIS_URL", "")
+QUERY_EMBEDDING_CACHE_TTL = int(os.getenv("QUERY_EMBEDDING_CACHE_TTL", 86400))
+
+# Knowledge bases are ingested by at most INGEST_WORKERS background jobs at once per worker process,
+# with at most INGEST_MAX_PENDING jobs waiting, and job statuses are kept for INGEST_JOB_TTL seconds.
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", 2))
+INGEST_MAX_PENDING = int(os.getenv("INGEST_MAX_PENDING", 100))
+INGEST_JOB_TTL = float(os.getenv("INGEST_JOB_TTL", 86400))
+UPLOAD_BLOCK_SIZE = 1024 * 1024
+
+# Knowledge bases unused for KB_EVICTION_TTL seconds are deleted, and the least recently used ones are
+# deleted while the estimated footprint of all knowledge bases exceeds KB_MEMORY_BUDGET_MB, the policies
+# are checked every KB_EVICTION_INTERVAL seconds and after every ingestion. 0 disables a policy.
+KB_EVICTION_TTL = float(os.getenv("KB_EVICTION_TTL", 0))
+KB_MEMORY_BUDGET = int(float(os.getenv("KB_MEMORY_BUDGET_MB", 0)) * 1024 * 1024)
+KB_EVICTION_INTERVAL = float(os.getenv("KB_EVICTION_INTERVAL", 300))
+
+KB_CACHE_SIZE = int(os.getenv("KB_CACHE_SIZE", 32))
+KB_CACHE_TTL = float(os.getenv("KB_CACHE_TTL", 600))
+
+# Per knowledge base state kept alive between requests: the vector store owns the pooled
+# client connection, the retriever and the compiled chain are built on top of it.
+KnowledgeBase = namedtuple("KnowledgeBase", ["vectorstore", "retriever", "llm_chain"])
+
+
+def input_violation_message(policy_violations: str):
+    return f"Violated policies: {policy_violations}, please check your input."
+
+
+def output_violation_message(policy_violations: str):
+    return policy_violations + " are found in the output"
+
+
+def get_index_name(kb_id: str):
+    if kb_id == "default":
+        return INDEX_NAME
+    return INDEX_NAME + kb_id
 
 
 class RAGAPIRouter(APIRouter):
-    def __init__(self, upload_dir, entrypoint, safety_guard_endpoint, tei_endpoint=None) -> None:
-        super().__init__()
+    """The routes of the service, and the models, caches and knowledge bases they use once `setup` was called."""
+
+    def setup(self, upload_dir, entrypoint, safety_guard_endpoint, tei_endpoint=None) -> None:
         self.upload_dir = upload_dir
         self.entrypoint = entrypoint
         self.safety_guard_endpoint = safety_guard_endpoint
+        self.speculative_guard = bool(safety_guard_endpoint) and SAFETY_GUARD_MODE == "speculative"
         print(
             f"[rag - router] Initializing API Router, params:\n \
                     upload_dir={upload_dir}, entrypoint={entrypoint}"
@@ -84,51 +185,195 @@ class RAGAPIRouter(APIRouter):
         if tei_endpoint:
             # create embeddings using TEI endpoint service
             self.embeddings = HuggingFaceHubEmbeddings(model=tei_endpoint)
+            embedding_model_id = os.getenv("EMBEDDING_MODEL_ID", tei_endpoint)
         else:
             # create embeddings using local embedding model
             EMBED_MODEL = os.getenv("EMBED_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
             self.embeddings = HuggingFaceBgeEmbeddings(model_name=EMBED_MODEL)
-
-        if VECTOR_DATABASE == "REDIS":
-            from langchain_community.vectorstores import Redis
-            from rag_redis.config import INDEX_SCHEMA, REDIS_URL
-
-            vdb = Redis.from_existing_index(
-                self.embeddings,
-                index_name=INDEX_NAME,
-                redis_url=REDIS_URL,
-                schema=INDEX_SCHEMA,
+            embedding_model_id = os.getenv("EMBEDDING_MODEL_ID", EMBED_MODEL)
+
+        # Reuse the embeddings of the chunks already ingested in any knowledge base, and of the repeated queries
+        self.embedding_store = None
+        if EMBEDDING_CACHE:
+            os.makedirs(os.path.dirname(os.path.abspath(EMBEDDING_CACHE)), exist_ok=True)
+            self.embedding_store = EmbeddingStore(EMBEDDING_CACHE, EMBEDDING_CACHE_MAX_ROWS, EMBEDDING_CACHE_MAX_AGE)
+            print(f"[rag - router] embedding cache: {EMBEDDING_CACHE}, model id: {embedding_model_id}")
+        self.query_cache = None
+        if QUERY_EMBEDDING_CACHE_SIZE > 0 or QUERY_EMBEDDING_CACHE_REDIS_URL:
+            redis_client = None
+            if QUERY_EMBEDDING_CACHE_REDIS_URL:
+                import redis
+
+                redis_client = redis.Redis.from_url(QUERY_EMBEDDING_CACHE_REDIS_URL)
+            self.query_cache = QueryEmbeddingCache(QUERY_EMBEDDING_CACHE_SIZE, redis_client, QUERY_EMBEDDING_CACHE_TTL)
+            print(
+                f"[rag - router] query embedding cache: {QUERY_EMBEDDING_CACHE_SIZE} queries, redis: {bool(redis_client)}"
             )
-        elif VECTOR_DATABASE == "QDRANT":
-            from langchain_community.vectorstores import Qdrant
-            from qdrant_client import QdrantClient
-            from rag_qdrant.config import QDRANT_HOST, QDRANT_PORT
-
-            client = QdrantClient(host=QDRANT_HOST, port=QDRANT_PORT)
-            vdb = Qdrant(
-                embeddings=self.embeddings,
-                collection_name=INDEX_NAME,
-                client=client,
+        if self.embedding_store is not None or self.query_cache is not None:
+            self.embeddings = CachedEmbeddings(
+                self.embeddings, self.embedding_store, embedding_model_id, self.query_cache
             )
-        retriever = vdb.as_retriever(search_type="mmr")
 
         # Define contextualize chain
         self.contextualize_q_chain = contextualize_q_prompt | self.llm | StrOutputParser()
 
+        # The chunks retrieved for the repeated queries on a knowledge base, until its chunks change
+        self.retrieval_cache = None
+        if RETRIEVAL_CACHE_SIZE > 0:
+            self.default_generation = IndexGeneration(lambda: index_generation(INDEX_NAME))
+            self.retrieval_cache = RetrievalCache(self.kb_generation, RETRIEVAL_CACHE_SIZE, RETRIEVAL_CACHE_TTL)
+            print(f"[rag - router] retrieval cache: {RETRIEVAL_CACHE_SIZE} queries")
+
+        # Cache of knowledge bases keyed by kb_id, so requests reuse connections and chains
+        self.kb_cache = LRUCache(
+            maxsize=KB_CACHE_SIZE,
+            ttl=KB_CACHE_TTL,
+            on_evict=lambda kb_id, kb: release_vectorstore(kb.vectorstore),
+        )
+
         # Define LLM chain
-        if args.chathistory:
-            self.llm_chain = (
-                RunnablePassthrough.assign(context=self.contextualized_question | retriever) | qa_prompt | self.llm
-            )
-        else:
-            self.llm_chain = (
-                RunnablePassthrough.assign(context=self.contextualized_question | retriever) | prompt | self.llm
-            )
+        self.llm_chain = self.get_knowledge_base("default").llm_chain
+
+        # Background ingestion of the uploaded files and links
+        self.jobs = JobManager(
+            os.path.join(upload_dir, "jobs"),
+            max_workers=INGEST_WORKERS,
+            max_pending=INGEST_MAX_PENDING,
+            ttl=INGEST_JOB_TTL,
+        )
+
+        # Footprint and last use of the knowledge bases, for their eviction
+        self.kb_registry = KnowledgeBaseRegistry(upload_dir)
+        self.register_existing_knowledge_bases()
+        self._eviction_lock = threading.Lock()
+        if KB_EVICTION_TTL > 0 or KB_MEMORY_BUDGET > 0:
+            threading.Thread(target=self.eviction_loop, name="rag-kb-eviction", daemon=True).start()
 
         print("[rag - router] LLM chain initialized.")
 
-        # Define chat history
-        self.chat_history = []
+        # Define chat history, stored per session outside of the router
+        self.chat_history = None
+        if args.chathistory:
+            summarizer = None
+            if os.getenv("CHAT_HISTORY_SUMMARIZE", "false").lower() in ["true", "1"]:
+                summarize_chain = summarize_history_prompt | self.llm | StrOutputParser()
+
+                def summarizer(conversation):
+                    return summarize_chain.invoke({"conversation": conversation})
+
+            self.chat_history = create_chat_history_store(REDIS_URL, summarizer=summarizer)
+
+    def kb_generation(self, kb_id: str):
+        """The generation of the chunks of a knowledge base, None for an unknown knowledge base."""
+        if kb_id == "default":
+            return self.default_generation()
+        return self.kb_registry.generation(kb_id)
+
+    def build_llm_chain(self, retriever):
+        if args.chathistory:
+            return RunnablePassthrough.assign(context=self.contextualized_question | retriever) | qa_prompt | self.llm
+        return RunnablePassthrough.assign(context=self.contextualized_question | retriever) | prompt | self.llm
+
+    def new_knowledge_base(self, kb_id: str, vdb):
+        # the MMR and hybrid search parameters are set per request, see `search_params`
+        kb_folder = get_kb_folder(self.upload_dir, kb_id) if kb_id != "default" else None
+        cache = {"cache": self.retrieval_cache, "cache_scope": kb_id}
+        if kb_folder:
+            retriever = HybridRetriever(vectorstore=vdb, persist_dir=kb_folder[1], **cache).configurable()
+        else:
+            retriever = MMRRetriever(vectorstore=vdb, **cache).configurable()
+        return KnowledgeBase(vdb, retriever, self.build_llm_chain(retriever))
+
+    def cache_knowledge_base(self, kb_id: str, vdb):
+        kb = self.new_knowledge_base(kb_id, vdb)
+        self.kb_cache.put(kb_id, kb)
+        return kb
+
+    def get_knowledge_base(self, kb_id: str):
+        """Return the cached knowledge base, connecting to its index on the first request."""
+        if kb_id != "default":
+            self.kb_registry.touch(kb_id)
+        return self.kb_cache.get_or_create(
+            kb_id, lambda: self.new_knowledge_base(kb_id, self.reload_vectorstore(kb_id))
+        )
+
+    def reload_vectorstore(self, kb_id: str):
+        kb_folder = get_kb_folder(self.upload_dir, kb_id) if kb_id != "default" else None
+        return reload_vectorstore(self.embeddings, get_index_name(kb_id), kb_folder[1] if kb_folder else None)
+
+    def invalidate_knowledge_base(self, kb_id: str):
+        if self.kb_cache.invalidate(kb_id):
+            print(f"[rag - router] knowledge base {kb_id} invalidated")
+
+    def search_params(self, kb_id: str, params: dict):
+        """The search parameters of a request: those of the request, then those of the knowledge base."""
+        search_params = parse_search_params(params)
+        kb = self.kb_registry.get(kb_id) if kb_id != "default" else None
+        return {**(kb["search_params"] if kb else {}), **search_params}
+
+    def knowledge_base_exists(self, kb_id: str):
+        if kb_id == "default":
+            return True
+        # the id names a folder of the upload folder
+        return kb_id.startswith("kb") and os.sep not in kb_id and get_kb_folder(self.upload_dir, kb_id) is not None
+
+    def register_existing_knowledge_bases(self):
+        """Register the knowledge bases created before the registry, with the age of their folder."""
+        if not os.path.isdir(self.upload_dir):
+            return
+        for kb_id in os.listdir(self.upload_dir):
+            kb_folder = get_kb_folder(self.upload_dir, kb_id)
+            if kb_id.startswith("kb_") and kb_folder and self.kb_registry.get(kb_id) is None:
+                self.kb_registry.register(kb_id, get_index_name(kb_id), os.path.getmtime(kb_folder[1]))
+                self.kb_registry.update_size(kb_id, *knowledge_base_footprint(kb_folder[1]))
+
+    def update_knowledge_base_size(self, kb_id: str):
+        kb_folder = get_kb_folder(self.upload_dir, kb_id)
+        if kb_folder:
+            self.kb_registry.update_size(kb_id, *knowledge_base_footprint(kb_folder[1]))
+
+    def evict_knowledge_base(self, kb_id: str):
+        """Delete a knowledge base: its chunks in the vector database, its folder and its registry entry."""
+        kb_folder = get_kb_folder(self.upload_dir, kb_id)
+        try:
+            if kb_folder:
+                try:
+                    vdb = self.reload_vectorstore(kb_id)
+                except ValueError as e:
+                    # an ingestion that failed before its first batch leaves no index to drop
+                    print(f"[rag - router] knowledge base {kb_id} has no index: {e}")
+                else:
+                    try:
+                        drop_knowledge_base(vdb, get_index_name(kb_id), kb_folder[1])
+                    finally:
+                        release_vectorstore(vdb)
+        finally:
+            if kb_folder:
+                shutil.rmtree(os.path.dirname(kb_folder[1]), ignore_errors=True)
+            self.invalidate_knowledge_base(kb_id)
+            self.kb_registry.remove(kb_id)
+        print(f"[rag - router] knowledge base {kb_id} evicted")
+
+    def enforce_eviction_policies(self):
+        """Evict the knowledge bases selected by the TTL and memory budget policies, returns their ids."""
+        with self._eviction_lock:
+            evicted = select_evictions(
+                self.kb_registry.list(),
+                ttl=KB_EVICTION_TTL,
+                budget_bytes=KB_MEMORY_BUDGET,
+                protected=self.jobs.active_knowledge_bases(),
+            )
+            for kb_id in evicted:
+                try:
+                    self.evict_knowledge_base(kb_id)
+                except Exception as e:
+                    print(f"[rag - router] failed to evict knowledge base {kb_id}: {e}")
+        return evicted
+
+    def eviction_loop(self):
+        while True:
+            time.sleep(KB_EVICTION_INTERVAL)
+            self.enforce_eviction_policies()
 
     def contextualized_question(self, input: dict):
         if input.get("chat_history"):
@@ -136,25 +381,64 @@ class RAGAPIRouter(APIRouter):
         else:
             return input["question"]
 
-    def handle_rag_chat(self, query: str):
-        response = self.llm_chain.invoke(
-            {"question": query, "chat_history": self.chat_history} if args.chathistory else {"question": query}
+    async def aget_knowledge_base(self, kb_id: str):
+        # connecting to a new index blocks, keep it off the event loop
+        return await run_in_threadpool(self.get_knowledge_base, kb_id)
+
+    async def check_guardrails(self, role: str, conversation: str):
+        """Return the policies violated by the `role` messages of `conversation`, None if it is safe."""
+        response_guard = await self.llm_guard.ainvoke(moderation_prompt_for_chat(role, conversation))
+        policy_violations = get_policy_violations(response_guard)
+        if policy_violations:
+            print(f"Violated policies: {policy_violations}")
+        return policy_violations
+
+    def check_input_guardrails(self, query: str):
+        return self.check_guardrails("User", f"User: {query}")
+
+    def check_output_guardrails(self, query: str, response: str):
+        return self.check_guardrails("Agent", f"User: {query}\n Agent: {response}")
+
+    def output_moderator(self, query: str):
+        return StreamingOutputModerator(
+            lambda response: self.check_output_guardrails(query, response),
+            window_size=OUTPUT_GUARD_WINDOW,
+            max_lag=OUTPUT_GUARD_MAX_LAG,
         )
-        result = response.split("</s>")[0]
+
+    async def chain_inputs(self, query: str, session_id: str):
+        if args.chathistory:
+            chat_history = await run_in_threadpool(self.chat_history.get, session_id)
+            return {"question": query, "chat_history": chat_history}
+        return {"question": query}
+
+    async def save_chat_history(self, session_id: str, query: str, response: str):
         if args.chathistory:
-            self.chat_history.extend([HumanMessage(content=query), response])
+            messages = [HumanMessage(content=query), AIMessage(content=response)]
+            await run_in_threadpool(self.chat_history.push, session_id, messages)
+
+    async def compact_chat_history(self, session_id: str):
+        if args.chathistory:
+            await run_in_threadpool(self.chat_history.compact, session_id)
+
+    async def handle_rag_chat(self, llm_chain, query: str, session_id: str):
+        inputs = await self.chain_inputs(query, session_id)
+        if self.speculative_guard:
+            policy_violations, response = await speculative_call(
+                self.check_input_guardrails(query), llm_chain.ainvoke(inputs)
+            )
+            if policy_violations:
+                return input_violation_message(policy_violations)
+        else:
+            response = await llm_chain.ainvoke(inputs)
+        result = response.split("</s>")[0]
+        await self.save_chat_history(session_id, query, result)
+        await self.compact_chat_history(session_id)
         # output guardrails
         if self.safety_guard_endpoint:
-            response_output_guard = self.llm_guard(
-                moderation_prompt_for_chat("Agent", f"User: {query}\n Agent: {response}")
-            )
-            if "unsafe" in response_output_guard:
-                policy_violation_level = response_output_guard.split("\n")[1].strip()
-                policy_violations = unsafe_dict[policy_violation_level]
-                print(f"Violated policies: {policy_violations}")
-                return policy_violations + " are found in the output"
-            else:
-                return result
+            policy_violations = await self.check_output_guardrails(query, result)
+            if policy_violations:
+                return output_violation_message(policy_violations)
         return result
 
 
@@ -162,7 +446,8 @@ upload_dir = os.getenv("RAG_UPLOAD_DIR", "./upload_dir")
 tgi_llm_endpoint = os.getenv("TGI_LLM_ENDPOINT", "http://localhost:8080")
 safety_guard_endpoint = os.getenv("SAFETY_GUARD_ENDPOINT")
 tei_embedding_endpoint = os.getenv("TEI_ENDPOINT")
-router = RAGAPIRouter(upload_dir, tgi_llm_endpoint, safety_guard_endpoint, tei_embedding_endpoint)
+# The routes are declared at import, the router is set up by `create_app` in the process that serves them
+router = RAGAPIRouter()
 
 
 @router.post("/v1/rag/chat")
@@ -171,42 +456,27 @@ async def rag_chat(request: Request):
     print(f"[rag - chat] POST request: /v1/rag/chat, params:{params}")
     query = params["query"]
     kb_id = params.get("knowledge_base_id", "default")
+    session_id = params.get("session_id", "default")
 
-    # prompt guardrails
-    if router.safety_guard_endpoint:
-        response_input_guard = router.llm_guard(moderation_prompt_for_chat("User", query))
-        if "unsafe" in response_input_guard:
-            policy_violation_level = response_input_guard.split("\n")[1].strip()
-            policy_violations = unsafe_dict[policy_violation_level]
-            print(f"Violated policies: {policy_violations}")
-            return f"Violated policies: {policy_violations}, please check your input."
+    # prompt guardrails, checked along with the generation in speculative mode
+    if router.safety_guard_endpoint and not router.speculative_guard:
+        policy_violations = await router.check_input_guardrails(query)
+        if policy_violations:
+            return input_violation_message(policy_violations)
 
     if kb_id == "default":
         print("[rag - chat] use default knowledge base")
-        retriever = reload_retriever(router.embeddings, INDEX_NAME)
-        if args.chathistory:
-            router.llm_chain = (
-                RunnablePassthrough.assign(context=router.contextualized_question | retriever) | qa_prompt | router.llm
-            )
-        else:
-            router.llm_chain = (
-                RunnablePassthrough.assign(context=router.contextualized_question | retriever) | prompt | router.llm
-            )
-    elif kb_id.startswith("kb"):
-        new_index_name = INDEX_NAME + kb_id
-        print(f"[rag - chat] use knowledge base {kb_id}, index name is {new_index_name}")
-        retriever = reload_retriever(router.embeddings, new_index_name)
-        if args.chathistory:
-            router.llm_chain = (
-                RunnablePassthrough.assign(context=router.contextualized_question | retriever) | qa_prompt | router.llm
-            )
-        else:
-            router.llm_chain = (
-                RunnablePassthrough.assign(context=router.contextualized_question | retriever) | prompt | router.llm
-            )
+        llm_chain = (await router.aget_knowledge_base(kb_id)).llm_chain
+    elif router.knowledge_base_exists(kb_id):
+        print(f"[rag - chat] use knowledge base {kb_id}, index name is {get_index_name(kb_id)}")
+        llm_chain = (await router.aget_knowledge_base(kb_id)).llm_chain
     else:
         return JSONResponse(status_code=400, content={"message": "Wrong knowledge base id."})
-    return router.handle_rag_chat(query=query)
+    try:
+        llm_chain = llm_chain.with_config(configurable=router.search_params(kb_id, params))
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"message": str(e)})
+    return await router.handle_rag_chat(llm_chain, query=query, session_id=session_id)
 
 
 @router.post("/v1/rag/chat_stream")
@@ -215,140 +485,349 @@ async def rag_chat_stream(request: Request):
     print(f"[rag - chat_stream] POST request: /v1/rag/chat_stream, params:{params}")
     query = params["query"]
     kb_id = params.get("knowledge_base_id", "default")
+    session_id = params.get("session_id", "default")
 
-    # prompt guardrails
-    if router.safety_guard_endpoint:
-        response_input_guard = router.llm_guard(moderation_prompt_for_chat("User", query))
-        if "unsafe" in response_input_guard:
-            policy_violation_level = response_input_guard.split("\n")[1].strip()
-            policy_violations = unsafe_dict[policy_violation_level]
-            print(f"Violated policies: {policy_violations}")
+    # prompt guardrails, checked along with the generation in speculative mode
+    if router.safety_guard_endpoint and not router.speculative_guard:
+        policy_violations = await router.check_input_guardrails(query)
+        if policy_violations:
 
             def generate_content():
-                content = f"Violated policies: {policy_violations}, please check your input."
+                content = input_violation_message(policy_violations)
                 yield f"data: {content}\n\n"
                 yield "data: [DONE]\n\n"
 
             return StreamingResponse(generate_content(), media_type="text/event-stream")
 
-    if kb_id == "default":
-        retriever = reload_retriever(router.embeddings, INDEX_NAME)
-        if args.chathistory:
-            router.llm_chain = (
-                RunnablePassthrough.assign(context=router.contextualized_question | retriever) | qa_prompt | router.llm
-            )
-        else:
-            router.llm_chain = (
-                RunnablePassthrough.assign(context=router.contextualized_question | retriever) | prompt | router.llm
-            )
-    elif kb_id.startswith("kb"):
-        new_index_name = INDEX_NAME + kb_id
-        retriever = reload_retriever(router.embeddings, new_index_name)
-        if args.chathistory:
-            router.llm_chain = (
-                RunnablePassthrough.assign(context=router.contextualized_question | retriever) | qa_prompt | router.llm
-            )
-        else:
-            router.llm_chain = (
-                RunnablePassthrough.assign(context=router.contextualized_question | retriever) | prompt | router.llm
-            )
+    if router.knowledge_base_exists(kb_id):
+        llm_chain = (await router.aget_knowledge_base(kb_id)).llm_chain
     else:
         return JSONResponse(status_code=400, content={"message": "Wrong knowledge base id."})
+    try:
+        llm_chain = llm_chain.with_config(configurable=router.search_params(kb_id, params))
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"message": str(e)})
 
-    def stream_generator():
+    async def stream_generator():
         chat_response = ""
-        for text in router.llm_chain.stream(
-            {"question": query, "chat_history": router.chat_history} if args.chathistory else {"question": query}
-        ):
-            chat_response += text
-            processed_text = post_process_text(text)
-            if text and processed_text:
-                yield processed_text
+        stream = llm_chain.astream(await router.chain_inputs(query, session_id))
+        if router.speculative_guard:
+            stream = speculative_stream(router.check_input_guardrails(query), stream)
+        # output guardrails, checked incrementally while the answer is streamed
+        if router.safety_guard_endpoint:
+            stream = router.output_moderator(query).moderate(stream)
+
+        async def collect(stream):
+            nonlocal chat_response
+            async for text in stream:
+                chat_response += text
+                # the legacy stream drops the tokens of only whitespace, as before the frames were coalesced
+                if SSE_FORMAT != "legacy" or is_legacy_token(text):
+                    yield text
+
+        encoder = SSEEncoder(SSE_FLUSH_INTERVAL, SSE_FLUSH_BYTES, SSE_FORMATTERS[SSE_FORMAT])
+        try:
+            async for frame in encoder.aencode(collect(stream)):
+                yield frame
+        except GuardrailViolation as e:
+            if e.role == "Agent":
+                content = output_violation_message(e.policy_violations)
+            else:
+                content = input_violation_message(e.policy_violations)
+            yield f"data: {content}\n\n"
+            yield "data: [DONE]\n\n"
+            return
         chat_response = chat_response.split("</s>")[0]
         print(f"[rag - chat_stream] stream response: {chat_response}")
-        if args.chathistory:
-            router.chat_history.extend([HumanMessage(content=query), chat_response])
+        # saved before the last frame, so that the turn is kept if the client disconnects on [DONE]
+        await router.save_chat_history(session_id, query, chat_response)
         yield "data: [DONE]\n\n"
+        # compacted after the last frame, so that trimming or summarizing the history does not delay it
+        await router.compact_chat_history(session_id)
 
     return StreamingResponse(stream_generator(), media_type="text/event-stream")
 
 
-@router.post("/v1/rag/create")
-async def rag_create(file: UploadFile = File(...)):
+def save_upload(file: UploadFile, path: str):
+    """Copy an upload to `path` in blocks, without reading the whole file in memory."""
+    with open(path, "wb") as fout:
+        shutil.copyfileobj(file.file, fout, UPLOAD_BLOCK_SIZE)
+
+
+def submit_job(kind: str, kb_id: str, ingest):
+    """Run `ingest(progress)` in the background, it returns the retriever of the knowledge base."""
+
+    def run(job):
+        def progress(done, total):
+            job.progress(done, total)
+            # a knowledge base being ingested is in use
+            router.kb_registry.touch(kb_id)
+
+        job.set_stage("ingesting")
+        try:
+            retriever = ingest(progress)
+        finally:
+            # the chunks stored before a failure are retrieved too
+            router.kb_registry.bump_generation(kb_id)
+        router.invalidate_knowledge_base(kb_id)
+        router.cache_knowledge_base(kb_id, retriever.vectorstore)
+        router.update_knowledge_base_size(kb_id)
+        print(f"[rag - {kind}] kb {kb_id} created successfully")
+        if KB_MEMORY_BUDGET > 0:
+            router.enforce_eviction_policies()
+
+    try:
+        job = router.jobs.submit(kind, kb_id, run)
+    except JobQueueFull as e:
+        print(f"[rag - {kind}] {e}")
+        return JSONResponse(status_code=503, content={"message": "Too many pending ingestion jobs, retry later."})
+    return {"knowledge_base_id": kb_id, "job_id": job.job_id}
+
+
+def save_document(file: UploadFile, user_upload_dir: str):
     filename = file.filename
     if "/" in filename:
         filename = filename.split("/")[-1]
-    print(f"[rag - create] POST request: /v1/rag/create, filename:{filename}")
-
-    kb_id, user_upload_dir, user_persist_dir = create_kb_folder(router.upload_dir)
     # save file to local path
     cur_time = get_current_beijing_time()
     save_file_name = str(user_upload_dir) + "/" + cur_time + "-" + filename
-    with open(save_file_name, "wb") as fout:
-        content = await file.read()
-        fout.write(content)
+    save_upload(file, save_file_name)
+    return filename, save_file_name
+
+
+def submit_file_job(kind: str, kb_id: str, save_file_name: str, user_persist_dir: str, source: str):
+    # the ingestion is checkpointed, and can be completed with /v1/rag/resume if it fails
+    index_name = INDEX_NAME + kb_id
+    return submit_job(
+        kind,
+        kb_id,
+        lambda progress: create_retriever_from_files(
+            save_file_name, router.embeddings, index_name, user_persist_dir, progress, source
+        ),
+    )
+
+
+@router.post("/v1/rag/create")
+async def rag_create(file: UploadFile = File(...)):
+    print(f"[rag - create] POST request: /v1/rag/create, filename:{file.filename}")
+    kb_id, user_upload_dir, user_persist_dir = create_kb_folder(router.upload_dir)
+    router.kb_registry.register(kb_id, get_index_name(kb_id))
+    filename, save_file_name = await run_in_threadpool(save_document, file, user_upload_dir)
     print(f"[rag - create] file saved to local path: {save_file_name}")
+    return submit_file_job("create", kb_id, save_file_name, user_persist_dir, filename)
+
+
+@router.post("/v1/rag/append")
+async def rag_append(
+    file: UploadFile = File(...), knowledge_base_id: str = Form(...), source: Optional[str] = Form(None)
+):
+    """Add a document to an existing knowledge base, it replaces the document with the same source."""
+    kb_id = knowledge_base_id
+    print(f"[rag - append] POST request: /v1/rag/append, filename:{file.filename}, kb id: {kb_id}, source: {source}")
+    kb_folder = get_kb_folder(router.upload_dir, kb_id)
+    if kb_folder is None:
+        return JSONResponse(status_code=400, content={"message": "Wrong knowledge base id."})
+    user_upload_dir, user_persist_dir = kb_folder
+    filename, save_file_name = await run_in_threadpool(save_document, file, user_upload_dir)
+    print(f"[rag - append] file saved to local path: {save_file_name}")
+    return submit_file_job("append", kb_id, save_file_name, user_persist_dir, source or filename)
+
+
+@router.post("/v1/rag/replace")
+async def rag_replace(file: UploadFile = File(...), knowledge_base_id: str = Form(...), source: str = Form(...)):
+    """Replace the document with the given source of a knowledge base."""
+    kb_id = knowledge_base_id
+    print(f"[rag - replace] POST request: /v1/rag/replace, filename:{file.filename}, kb id: {kb_id}, source: {source}")
+    kb_folder = get_kb_folder(router.upload_dir, kb_id)
+    if kb_folder is None:
+        return JSONResponse(status_code=400, content={"message": "Wrong knowledge base id."})
+    user_upload_dir, user_persist_dir = kb_folder
+    if get_document(user_persist_dir, source) is None:
+        return JSONResponse(status_code=404, content={"message": "Document not found."})
+    filename, save_file_name = await run_in_threadpool(save_document, file, user_upload_dir)
+    print(f"[rag - replace] file saved to local path: {save_file_name}")
+    return submit_file_job("replace", kb_id, save_file_name, user_persist_dir, source)
 
-    # create new retriever
-    try:
-        # get retrieval instance and reload db with new knowledge base
-        print("[rag - create] starting to create local db...")
-        index_name = INDEX_NAME + kb_id
-        retriever = create_retriever_from_files(save_file_name, router.embeddings, index_name)
-        if args.chathistory:
-            router.llm_chain = (
-                RunnablePassthrough.assign(context=router.contextualized_question | retriever) | qa_prompt | router.llm
-            )
-        else:
-            router.llm_chain = (
-                RunnablePassthrough.assign(context=router.contextualized_question | retriever) | prompt | router.llm
+
+@router.post("/v1/rag/delete")
+async def rag_delete(request: Request):
+    params = await request.json()
+    kb_id = params["knowledge_base_id"]
+    source = params["source"]
+    print(f"[rag - delete] POST request: /v1/rag/delete, kb id: {kb_id}, source: {source}")
+    kb_folder = get_kb_folder(router.upload_dir, kb_id)
+    if kb_folder is None:
+        return JSONResponse(status_code=400, content={"message": "Wrong knowledge base id."})
+    kb = await router.aget_knowledge_base(kb_id)
+    if not await run_in_threadpool(delete_document, kb.vectorstore, kb_folder[1], source):
+        return JSONResponse(status_code=404, content={"message": "Document not found."})
+    await run_in_threadpool(router.kb_registry.bump_generation, kb_id)
+    await run_in_threadpool(router.update_knowledge_base_size, kb_id)
+    return {"knowledge_base_id": kb_id, "source": source}
+
+
+@router.get("/v1/rag/documents/{kb_id}")
+async def rag_documents(kb_id: str):
+    kb_folder = get_kb_folder(router.upload_dir, kb_id)
+    if kb_folder is None:
+        return JSONResponse(status_code=400, content={"message": "Wrong knowledge base id."})
+    return {"knowledge_base_id": kb_id, "documents": await run_in_threadpool(list_documents, kb_folder[1])}
+
+
+@router.post("/v1/rag/resume")
+async def rag_resume(request: Request):
+    params = await request.json()
+    kb_id = params["knowledge_base_id"]
+    print(f"[rag - resume] POST request: /v1/rag/resume, kb id: {kb_id}")
+
+    kb_folder = get_kb_folder(router.upload_dir, kb_id)
+    if kb_folder is None:
+        return JSONResponse(status_code=400, content={"message": "Wrong knowledge base id."})
+    jobs = IngestJob.unfinished(kb_folder[1])
+    if not jobs:
+        return JSONResponse(status_code=400, content={"message": "No ingestion to resume for this knowledge base."})
+
+    def resume(progress):
+        for job in jobs:
+            print(
+                f"[rag - resume] resuming {job.state['source']}, {job.state['committed']}/{job.state['total']} stored"
             )
-        print("[rag - create] kb created successfully")
-    except Exception as e:
-        print(f"[rag - create] create knowledge base failed! {e}")
-        return JSONResponse(status_code=500, content={"message": "Fail to create new knowledge base."})
-    return {"knowledge_base_id": kb_id}
+            retriever = run_ingest_job(job, router.embeddings, progress)
+        return retriever
+
+    return submit_job("resume", kb_id, resume)
 
 
 @router.post("/v1/rag/upload_link")
 async def rag_upload_link(request: Request):
     params = await request.json()
     link_list = params["link_list"]
-    print(f"[rag - upload_link] POST request: /v1/rag/upload_link, link list:{link_list}")
+    max_depth = int(params.get("max_depth", 0))
+    kb_id = params.get("knowledge_base_id")
+    print(f"[rag - upload_link] POST request: /v1/rag/upload_link, link list:{link_list}, kb id: {kb_id}")
+
+    if kb_id:
+        # re-ingest into an existing knowledge base, only the changed pages are embedded again
+        kb_folder = get_kb_folder(router.upload_dir, kb_id)
+        if kb_folder is None:
+            return JSONResponse(status_code=400, content={"message": "Wrong knowledge base id."})
+        user_upload_dir, user_persist_dir = kb_folder
+    else:
+        kb_id, user_upload_dir, user_persist_dir = create_kb_folder(router.upload_dir)
+        router.kb_registry.register(kb_id, get_index_name(kb_id))
+
+    # create new retriever in the background
+    index_name = INDEX_NAME + kb_id
+    return submit_job(
+        "upload_link",
+        kb_id,
+        lambda progress: create_retriever_from_links(
+            router.embeddings, link_list, index_name, max_depth, user_persist_dir, progress
+        ),
+    )
+
+
+@router.post("/v1/rag/search_params")
+async def rag_search_params(request: Request):
+    """Set the search parameters of a knowledge base, the parameters of a chat request take precedence."""
+    params = await request.json()
+    kb_id = params.get("knowledge_base_id")
+    print(f"[rag - search_params] POST request: /v1/rag/search_params, params:{params}")
+    if not kb_id or kb_id == "default" or not router.knowledge_base_exists(kb_id):
+        return JSONResponse(status_code=400, content={"message": "Wrong knowledge base id."})
+    try:
+        search_params = parse_search_params(params)
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"message": str(e)})
+    search_params = router.kb_registry.set_search_params(kb_id, search_params)
+    if search_params is None:
+        return JSONResponse(status_code=400, content={"message": "Wrong knowledge base id."})
+    return {"knowledge_base_id": kb_id, "search_params": search_params}
 
-    kb_id, user_upload_dir, user_persist_dir = create_kb_folder(router.upload_dir)
 
-    # create new retriever
-    try:
-        print("[rag - upload_link] starting to create local db...")
-        index_name = INDEX_NAME + kb_id
-        retriever = create_retriever_from_links(router.embeddings, link_list, index_name)
-        if args.chathistory:
-            router.llm_chain = (
-                RunnablePassthrough.assign(context=router.contextualized_question | retriever) | qa_prompt | router.llm
-            )
-        else:
-            router.llm_chain = (
-                RunnablePassthrough.assign(context=router.contextualized_question | retriever) | prompt | router.llm
-            )
-        print("[rag - upload_link] kb created successfully")
-    except Exception as e:
-        print(f"[rag - upload_link] create knowledge base failed! {e}")
-        return JSONResponse(status_code=500, content={"message": "Fail to create new knowledge base."})
-    return {"knowledge_base_id": kb_id}
+@router.get("/v1/rag/admin/knowledge_bases")
+async def rag_admin_knowledge_bases():
+    knowledge_bases = await run_in_threadpool(router.kb_registry.list)
+    return {
+        "knowledge_bases": knowledge_bases,
+        "total_bytes": sum(kb["bytes"] for kb in knowledge_bases),
+        "budget_bytes": KB_MEMORY_BUDGET,
+        "eviction_ttl": KB_EVICTION_TTL,
+    }
+
+
+@router.post("/v1/rag/admin/evict")
+async def rag_admin_evict(request: Request):
+    """Evict the given knowledge base, or the ones selected by the eviction policies if no id is given."""
+    params = await request.json()
+    kb_id = params.get("knowledge_base_id")
+    print(f"[rag - admin] POST request: /v1/rag/admin/evict, kb id: {kb_id}")
+    if kb_id is None:
+        return {"evicted": await run_in_threadpool(router.enforce_eviction_policies)}
+    if kb_id == "default" or not router.knowledge_base_exists(kb_id):
+        return JSONResponse(status_code=400, content={"message": "Wrong knowledge base id."})
+    if kb_id in await run_in_threadpool(router.jobs.active_knowledge_bases):
+        return JSONResponse(status_code=409, content={"message": "The knowledge base is being ingested."})
+    await run_in_threadpool(router.evict_knowledge_base, kb_id)
+    return {"evicted": [kb_id]}
 
 
-app.include_router(router)
+@router.get("/v1/rag/admin/embedding_cache")
+async def rag_admin_embedding_cache():
+    """The hit rate of the query embedding cache, and the number of chunk embeddings stored."""
+    return {
+        "queries": router.query_cache.stats() if router.query_cache is not None else None,
+        "stored_chunks": (
+            await run_in_threadpool(len, router.embedding_store) if router.embedding_store is not None else 0
+        ),
+    }
 
 
-@app.get("/")
+@router.get("/v1/rag/admin/retrieval_cache")
+async def rag_admin_retrieval_cache():
+    """The hit rate of the retrieval cache."""
+    return {"retrieval": router.retrieval_cache.stats() if router.retrieval_cache is not None else None}
+
+
+@router.get("/v1/rag/jobs/{job_id}")
+async def rag_job_status(job_id: str):
+    status = router.jobs.get(job_id)
+    if status is None:
+        return JSONResponse(status_code=404, content={"message": "Job not found."})
+    return status
+
+
+@router.get("/")
 async def redirect_root_to_docs():
     return RedirectResponse("/docs")
 
 
-add_routes(app, router.llm_chain, path="/rag-redis")
+def create_app():
+    """Set up the router and build the app, in the process that serves the requests."""
+    router.setup(upload_dir, tgi_llm_endpoint, safety_guard_endpoint, tei_embedding_endpoint)
+    app = FastAPI()
+    app.add_middleware(
+        CORSMiddleware, allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"]
+    )
+    app.include_router(router)
+    add_routes(app, router.llm_chain, path="/rag-redis")
+    return app
+
+
+def __getattr__(name):
+    # `server:app` builds the app on first use, so that importing the module does not set up the router
+    global app
+    if name == "app":
+        app = create_app()
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 
 if __name__ == "__main__":
     import uvicorn
 
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    if args.workers > 1:
+        # every worker process builds its own router, the parent process only supervises them
+        uvicorn.run("server:create_app", factory=True, host="0.0.0.0", port=8000, workers=args.workers)
+    else:
+        uvicorn.run(create_app(), host="0.0.0.0", port=8000)
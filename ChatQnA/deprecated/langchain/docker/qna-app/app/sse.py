@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: Apache-2.0
+
+# The same module is copied in the ChatQnA qna-app, the SearchQnA qna-app and the CodeTrans codetrans-app,
+# since the Docker image of every app only copies its own folder. Keep the copies identical.
+
+import asyncio
+import json
+import time
+
+
+def format_legacy(text: str):
+    """The wire format of the UIs: spaces are sent as `@#$` and line breaks as `<br/>`."""
+    return text.replace("\r", "").replace("\n", "<br/>").replace(" ", "@#$")
+
+
+def is_legacy_token(token: str):
+    """Whether the ChatQnA UI is sent `token`: the tokens of only whitespace are dropped, except a space or a line break."""
+    return token in (" ", "\n") or not token.isspace()
+
+
+def format_json(text: str):
+    return json.dumps(text, ensure_ascii=False)
+
+
+def format_bytes_repr(text: str):
+    """The wire format of the CodeTrans UI: the python repr of the utf-8 encoded text."""
+    return repr(text.encode("utf-8"))
+
+
+SSE_FORMATTERS = {"legacy": format_legacy, "json": format_json, "bytes_repr": format_bytes_repr}
+
+
+class SSEEncoder:
+    """Coalesce streamed LLM tokens into server-sent event frames.
+
+    Instead of one `data:` frame per token, tokens are buffered and sent together once
+    `flush_interval` seconds have passed since the last frame or the buffer holds
+    `flush_bytes` bytes. The first token is always sent immediately so that the time to
+    first token is unchanged. `flush_interval=0` gives one frame per token. An encoder holds
+    the state of a single stream, so create one per response.
+    """
+
+    def __init__(self, flush_interval: float = 0.02, flush_bytes: int = 1024, formatter=format_legacy):
+        self.flush_interval = flush_interval
+        self.flush_bytes = flush_bytes
+        self.formatter = formatter
+        self._buffer = []
+        self._buffered_bytes = 0
+        self._last_flush = None
+
+    def _frame(self, text: str):
+        return f"data: {self.formatter(text)}\n\n"
+
+    def _due(self, now: float):
+        return (
+            self._last_flush is None
+            or now - self._last_flush >= self.flush_interval
+            or self._buffered_bytes >= self.flush_bytes
+        )
+
+    def feed(self, token: str):
+        """Buffer a token, return the frame to send if a flush is due, otherwise None."""
+        if not token:
+            return None
+        self._buffer.append(token)
+        self._buffered_bytes += len(token.encode("utf-8"))
+        if self._due(time.monotonic()):
+            return self.flush()
+        return None
+
+    def flush(self):
+        """Return a frame with all the buffered tokens, None if the buffer is empty."""
+        self._last_flush = time.monotonic()
+        if not self._buffer:
+            return None
+        text = "".join(self._buffer)
+        self._buffer.clear()
+        self._buffered_bytes = 0
+        return self._frame(text)
+
+    def time_to_flush(self):
+        """Seconds until the buffered tokens must be sent, None if nothing is buffered."""
+        if not self._buffer:
+            return None
+        return max(self.flush_interval - (time.monotonic() - self._last_flush), 0)
+
+    def encode(self, tokens):
+        """Encode an iterable of tokens, buffered tokens are flushed when the next token arrives."""
+        for token in tokens:
+            frame = self.feed(token)
+            if frame:
+                yield frame
+        frame = self.flush()
+        if frame:
+            yield frame
+
+    async def aencode(self, tokens):
+        """Encode an async iterable of tokens, buffered tokens are flushed on time even if the stream stalls."""
+        iterator = tokens.__aiter__()
+        pending = None
+        try:
+            while True:
+                timeout = self.time_to_flush()
+                if timeout is None and pending is None:
+                    # nothing buffered, wait for the next token without a timer
+                    try:
+                        token = await iterator.__anext__()
+                    except StopAsyncIteration:
+                        break
+                else:
+                    if pending is None:
+                        pending = asyncio.ensure_future(iterator.__anext__())
+                    done, _ = await asyncio.wait({pending}, timeout=timeout)
+                    if not done:
+                        frame = self.flush()
+                        if frame:
+                            yield frame
+                        continue
+                    task, pending = pending, None
+                    try:
+                        token = task.result()
+                    except StopAsyncIteration:
+                        break
+                frame = self.feed(token)
+                if frame:
+                    yield frame
+            frame = self.flush()
+            if frame:
+                yield frame
+        finally:
+            if pending is not None and not pending.done():
+                pending.cancel()
+                await asyncio.gather(pending, return_exceptions=True)
+            if hasattr(iterator, "aclose"):
+                await iterator.aclose()
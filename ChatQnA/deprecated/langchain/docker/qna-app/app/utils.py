@@ -5,27 +5,43 @@
 
 #
 
-import multiprocessing
+import json
 import os
 import re
 import unicodedata
 import uuid
 from datetime import datetime, timedelta, timezone
 from pathlib import Path
-from urllib.parse import urlparse, urlunparse
 
-import requests
-from bs4 import BeautifulSoup
+from bm25 import update_index
+from crawler import crawl
+from documents import DocumentRegistry
+from embedding_cache import CachedEmbeddings
+from http_cache import HttpCache
+from ingest_job import IngestJob
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_community.document_loaders import UnstructuredFileLoader
 from langchain_core.documents import Document
+from lxml import etree
+from mmr import MMRRetriever, documents_by_ids
 
-SUPPORTED_VECTOR_DATABASES = ["REDIS", "QDRANT"]
+SUPPORTED_VECTOR_DATABASES = ["REDIS", "QDRANT", "LOCAL"]
 
 VECTOR_DATABASE = str(os.getenv("VECTOR_DATABASE", "redis")).upper()
 
 assert VECTOR_DATABASE in SUPPORTED_VECTOR_DATABASES, f"Invalid VECTOR_DATABASE: {VECTOR_DATABASE}"
 
+CRAWLER_CONFIG = {
+    "max_pages": int(os.getenv("CRAWLER_MAX_PAGES", 1000)),
+    "max_connections": int(os.getenv("CRAWLER_MAX_CONNECTIONS", 64)),
+    "per_host": int(os.getenv("CRAWLER_PER_HOST", 8)),
+    "timeout": float(os.getenv("CRAWLER_TIMEOUT", 30)),
+    "max_bytes": int(os.getenv("CRAWLER_MAX_BYTES", 5 * 1024 * 1024)),
+}
+
+# Chunks stored between two checkpoints of an ingestion job
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", 128))
+
 
 def get_current_beijing_time():
     SHA_TZ = timezone(timedelta(hours=8), name="Asia/Shanghai")
@@ -50,182 +66,125 @@ def create_kb_folder(upload_dir):
     return kb_id, str(user_upload_dir), str(user_persist_dir)
 
 
-class Crawler:
-    def __init__(self, pool=None):
-        if pool:
-            assert isinstance(pool, (str, list, tuple)), "url pool should be str, list or tuple"
-        self.pool = pool
-        self.headers = {
-            "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng, \
-            */*;q=0.8,application/signed-exchange;v=b3;q=0.7",
-            "Accept-Encoding": "gzip, deflate, br",
-            "Accept-Language": "en-US,en;q=0.9,zh-CN;q=0.8,zh;q=0.7",
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, \
-            like Gecko) Chrome/113.0.0.0 Safari/537.36",
-        }
-        self.fetched_pool = set()
-
-    def get_sublinks(self, soup):
-        sublinks = []
-        for links in soup.find_all("a"):
-            sublinks.append(str(links.get("href")))
-        return sublinks
-
-    def get_hyperlink(self, soup, base_url):
-        sublinks = []
-        for links in soup.find_all("a"):
-            link = str(links.get("href"))
-            if link.startswith("#") or link is None or link == "None":
-                continue
-            suffix = link.split("/")[-1]
-            if "." in suffix and suffix.split(".")[-1] not in ["html", "htmld"]:
-                continue
-            link_parse = urlparse(link)
-            base_url_parse = urlparse(base_url)
-            if link_parse.path == "":
-                continue
-            if link_parse.netloc != "":
-                # keep crawler works in the same domain
-                if link_parse.netloc != base_url_parse.netloc:
-                    continue
-                sublinks.append(link)
-            else:
-                sublinks.append(
-                    urlunparse(
-                        (
-                            base_url_parse.scheme,
-                            base_url_parse.netloc,
-                            link_parse.path,
-                            link_parse.params,
-                            link_parse.query,
-                            link_parse.fragment,
-                        )
-                    )
-                )
-        return sublinks
-
-    def fetch(self, url, headers=None, max_times=5):
-        if not headers:
-            headers = self.headers
-        while max_times:
-            if not url.startswith("http") or not url.startswith("https"):
-                url = "http://" + url
-            print("start fetch %s...", url)
-            try:
-                response = requests.get(url, headers=headers, verify=True)
-                if response.status_code != 200:
-                    print("fail to fetch %s, response status code: %s", url, response.status_code)
-                else:
-                    return response
-            except Exception as e:
-                print("fail to fetch %s, caused by %s", url, e)
-                raise Exception(e)
-            max_times -= 1
+def get_kb_folder(upload_dir, kb_id):
+    """Return the local folders of an existing knowledge base, None if it has no folder."""
+    user_upload_dir = Path(upload_dir) / f"{kb_id}/upload_dir"
+    user_persist_dir = Path(upload_dir) / f"{kb_id}/persist_dir"
+    if not user_persist_dir.is_dir():
         return None
+    return str(user_upload_dir), str(user_persist_dir)
 
-    def process_work(self, sub_url, work):
-        response = self.fetch(sub_url)
-        if response is None:
-            return []
-        self.fetched_pool.add(sub_url)
-        soup = self.parse(response.text)
-        base_url = self.get_base_url(sub_url)
-        sublinks = self.get_hyperlink(soup, base_url)
-        if work:
-            work(sub_url, soup)
-        return sublinks
-
-    def crawl(self, pool, work=None, max_depth=10, workers=10):
-        url_pool = set()
-        for url in pool:
-            base_url = self.get_base_url(url)
-            response = self.fetch(url)
-            soup = self.parse(response.text)
-            sublinks = self.get_hyperlink(soup, base_url)
-            self.fetched_pool.add(url)
-            url_pool.update(sublinks)
-            depth = 0
-            while len(url_pool) > 0 and depth < max_depth:
-                print("current depth %s...", depth)
-                mp = multiprocessing.Pool(processes=workers)
-                results = []
-                for sub_url in url_pool:
-                    if sub_url not in self.fetched_pool:
-                        results.append(mp.apply_async(self.process_work, (sub_url, work)))
-                mp.close()
-                mp.join()
-                url_pool = set()
-                for result in results:
-                    sublinks = result.get()
-                    url_pool.update(sublinks)
-                depth += 1
-
-    def parse(self, html_doc):
-        soup = BeautifulSoup(html_doc, "lxml")
-        return soup
-
-    def download(self, url, file_name):
-        print("download %s into %s...", url, file_name)
-        try:
-            r = requests.get(url, stream=True, headers=self.headers, verify=True)
-            f = open(file_name, "wb")
-            for chunk in r.iter_content(chunk_size=512):
-                if chunk:
-                    f.write(chunk)
-        except Exception as e:
-            print("fail to download %s, caused by %s", url, e)
-
-    def get_base_url(self, url):
-        result = urlparse(url)
-        return urlunparse((result.scheme, result.netloc, "", "", "", ""))
-
-    def clean_text(self, text):
-        text = text.strip().replace("\r", "\n")
-        text = re.sub(" +", " ", text)
-        text = re.sub("\n+", "\n", text)
-        text = text.split("\n")
-        return "\n".join([i for i in text if i and i != " "])
+
+class _UniProTable(dict):
+    """Translation table keeping ASCII and non-spacing marks, filled lazily for the characters seen."""
+
+    def __missing__(self, code):
+        value = code if code < 128 or unicodedata.category(chr(code)) == "Mn" else None
+        self[code] = value
+        return value
+
+
+_UNI_PRO_TABLE = _UniProTable()
+_XPATH_BY_CLASS = {
+    name: etree.XPath(f"//*[contains(concat(' ', normalize-space(@class), ' '), ' {name} ')]")
+    for name in ["main", "container"]
+}
+_XPATH_BY_ID = {name: etree.XPath(f"//*[@id='{name}']") for name in ["main", "container"]}
+# like BeautifulSoup's `.text`, the content of these elements is not part of the text
+_SKIPPED_TAGS = {"script", "style", "template"}
+_PRESERVE_WHITESPACE_TAGS = {"pre", "textarea"}
+_ASCII_SPACES = " \n\t\f\r"
 
 
 def uni_pro(text):
     """Check if the character is ASCII or falls in the category of non-spacing marks."""
-    normalized_text = unicodedata.normalize("NFKD", text)
-    filtered_text = ""
-    for char in normalized_text:
-        if ord(char) < 128 or unicodedata.category(char) == "Mn":
-            filtered_text += char
-    return filtered_text
-
-
-def load_html_data(url):
-    crawler = Crawler()
-    res = crawler.fetch(url)
-    if res is None:
-        return None
-    soup = crawler.parse(res.text)
-    all_text = crawler.clean_text(soup.select_one("body").text)
+    if text.isascii():
+        return text
+    return unicodedata.normalize("NFKD", text).translate(_UNI_PRO_TABLE)
+
+
+def _text_node(text, preserve):
+    # like BeautifulSoup, a text node of ASCII whitespaces is reduced to a line break or a space
+    if preserve or not text.isspace() or text.strip(_ASCII_SPACES):
+        return text
+    return "\n" if "\n" in text else " "
+
+
+def iter_text(element, excluded=()):
+    """Yield the text of an lxml element and its descendants, in document order.
+
+    The text of the `excluded` descendants is skipped, their tail is kept.
+    """
+    preserve = element.tag in _PRESERVE_WHITESPACE_TAGS
+    preserve = preserve or next(element.iterancestors(*_PRESERVE_WHITESPACE_TAGS), None) is not None
+    if element.text:
+        yield _text_node(element.text, preserve)
+    stack = [(element, iter(element), preserve)]
+    while stack:
+        node, children, preserve = stack[-1]
+        child = next(children, None)
+        if child is None:
+            stack.pop()
+            if stack and node.tail:
+                yield _text_node(node.tail, stack[-1][2])
+        elif isinstance(child.tag, str) and child.tag not in _SKIPPED_TAGS and child not in excluded:
+            child_preserve = preserve or child.tag in _PRESERVE_WHITESPACE_TAGS
+            if child.text:
+                yield _text_node(child.text, child_preserve)
+            stack.append((child, iter(child), child_preserve))
+        elif child.tail:
+            # comments, processing instructions and skipped elements only contribute their tail
+            yield _text_node(child.tail, preserve)
+
+
+def html_tree(html: str):
+    """Parse an HTML document into an lxml tree, None if it is empty."""
+    return etree.fromstring(html.encode("utf-8"), etree.HTMLParser(encoding="utf-8"))
+
+
+def clean_lines(text):
+    """Strip a text, collapse its runs of spaces, and drop its blank lines."""
+    lines = re.sub(" +", " ", text.strip().replace("\r", "\n")).split("\n")
+    return "\n".join(line for line in lines if line and line != " ")
+
+
+def extract_main_content(root):
+    """Extract the text of the main blocks of a page from its lxml tree.
+
+    The blocks are the elements with the "main" class, or else the "main" id, followed by the
+    "container" ones. A block whose cleaned text is already part of the extracted text, such
+    as a block nested in an extracted block, is skipped. The repeated blocks are found by hash,
+    the other ones by a substring search. The lines of the blocks are joined, and the text is
+    reduced to ASCII and single spaces.
+    """
+    if root is None:
+        return ""
     main_content = ""
+    seen_blocks = set()
     for element_name in ["main", "container"]:
-        main_block = None
-        if soup.select(f".{element_name}"):
-            main_block = soup.select(f".{element_name}")
-        elif soup.select(f"#{element_name}"):
-            main_block = soup.select(f"#{element_name}")
-        if main_block:
-            for element in main_block:
-                text = crawler.clean_text(element.text)
-                if text not in main_content:
-                    main_content += f"\n{text}"
-            main_content = crawler.clean_text(main_content)
+        main_block = _XPATH_BY_CLASS[element_name](root) or _XPATH_BY_ID[element_name](root)
+        if not main_block:
+            continue
+        for element in main_block:
+            text = clean_lines("".join(iter_text(element)))
+            # the repeated blocks are found by hash, without searching the extracted text
+            if text in seen_blocks or text in main_content:
+                continue
+            seen_blocks.add(text)
+            main_content += f"\n{text}"
+        main_content = clean_lines(main_content)
 
-    main_content = main_content.replace("\n", "")
-    main_content = main_content.replace("\n\n", "")
-    main_content = uni_pro(main_content)
-    main_content = re.sub(r"\s+", " ", main_content)
+    return collapse_whitespaces(uni_pro(main_content.replace("\n", "")))
 
-    # {'text': all_text, 'main_content': main_content}
 
-    return main_content
+def collapse_whitespaces(text):
+    r"""Replace every run of whitespaces by a single space, like `re.sub(r"\s+", " ", text)`."""
+    collapsed = " ".join(text.split())
+    if text[:1].isspace():
+        collapsed = " " + collapsed
+    if text[-1:].isspace() and collapsed != " ":
+        collapsed += " "
+    return collapsed
 
 
 def get_chuck_data(content, max_length, min_length, input):
@@ -252,19 +211,24 @@ def get_chuck_data(content, max_length, min_length, input):
     return paragraphs
 
 
-def parse_html(input):
-    """Parse the uploaded file."""
-    chucks = []
+def parse_html(input, max_depth=0, cache=None):
+    """Parse the uploaded links, and the pages they link to up to `max_depth` hops.
+
+    With an `HttpCache`, only the pages that changed since they were cached are returned.
+    """
+    links = []
     for link in input:
         if re.match(r"^https?:/{2}\w.+$", link):
-            content = load_html_data(link)
-            if content is None:
-                continue
-            chuck = [[content.strip(), link]]
-            chucks += chuck
+            links.append(link)
         else:
             print("The given link/str {} cannot be parsed.".format(link))
+    if not links:
+        return []
 
+    chucks = []
+    for page in crawl(links, max_depth=max_depth, cache=cache, **CRAWLER_CONFIG):
+        content = extract_main_content(page.root)
+        chucks.append([content.strip(), page.url])
     return chucks
 
 
@@ -279,51 +243,265 @@ def document_transfer(data_collection):
     return documents
 
 
-def create_retriever_from_files(doc, embeddings, index_name: str):
+def create_retriever_from_files(doc, embeddings, index_name: str, persist_dir: str, progress=None, source=None):
+    """Ingest the file `doc` into `index_name`, as an `IngestJob` checkpointed in `persist_dir`.
+
+    The chunks are tagged with the `source` of the document, by default the name of the file,
+    and the document replaces the previous document of the knowledge base with the same
+    source, if any. A failed ingestion can be completed by `run_ingest_job`, from the last
+    stored batch. `progress(done, total)` is called with the number of stored chunks after
+    every batch.
+    """
     print(f"[rag - create retriever] create with index: {index_name}")
+    source = source or os.path.basename(doc)
+    identify_id = str(uuid.uuid4())
     text_splitter = RecursiveCharacterTextSplitter(chunk_size=1500, chunk_overlap=100, add_start_index=True)
     loader = UnstructuredFileLoader(doc, mode="single", strategy="fast")
     chunks = loader.load_and_split(text_splitter)
+    for chunk in chunks:
+        chunk.metadata.update(source=source, identify_id=identify_id)
+    job = IngestJob(persist_dir, f"ingest_{identify_id}")
+    job.save_chunks(
+        index_name,
+        source,
+        [chunk.page_content for chunk in chunks],
+        [chunk.metadata for chunk in chunks],
+        identify_id=identify_id,
+    )
+    return run_ingest_job(job, embeddings, progress)
+
+
+def run_ingest_job(job: IngestJob, embeddings, progress=None):
+    """Store the chunks of a parsed `IngestJob` from its last checkpoint on, returns the retriever of its index.
+
+    Once all the chunks are stored, the document is recorded in the `DocumentRegistry` of the
+    knowledge base and its chunks are indexed by BM25, and the chunks of the document it
+    replaces are deleted.
+    """
+    index_name = job.state["index_name"]
+    vdb = None
+
+    def write_batch(texts, metadatas, ids):
+        nonlocal vdb
+        if vdb is not None:
+            vdb.add_texts(texts, metadatas, ids=ids)
+
+        elif VECTOR_DATABASE == "REDIS":
+            from langchain_community.vectorstores import Redis
+            from rag_redis.config import INDEX_SCHEMA, REDIS_URL
+
+            vdb = Redis.from_texts(
+                texts=texts,
+                metadatas=metadatas,
+                embedding=embeddings,
+                index_name=index_name,
+                redis_url=REDIS_URL,
+                index_schema=INDEX_SCHEMA,
+                keys=ids,
+            )
+
+        elif VECTOR_DATABASE == "QDRANT":
+            from langchain_community.vectorstores import Qdrant
+            from rag_qdrant.config import COLLECTION_NAME, QDRANT_HOST, QDRANT_PORT
+
+            vdb = Qdrant.from_texts(
+                texts=texts,
+                metadatas=metadatas,
+                embedding=embeddings,
+                collection_name=COLLECTION_NAME,
+                host=QDRANT_HOST,
+                port=QDRANT_PORT,
+                ids=ids,
+            )
+
+        elif VECTOR_DATABASE == "LOCAL":
+            from local_vectorstore import LocalVectorStore, index_folder
+
+            vdb = LocalVectorStore.from_texts(
+                texts=texts,
+                metadatas=metadatas,
+                embedding=embeddings,
+                folder=index_folder(index_name, job.persist_dir),
+                ids=ids,
+            )
+
+    ids, size_bytes = job.run(write_batch, INGEST_BATCH_SIZE, progress)
+    if vdb is None:
+        vdb = reload_vectorstore(embeddings, index_name, job.persist_dir)
+    size_bytes += len(ids) * vector_size(vdb)
+    documents = {job.state["source"]: (job.state.get("identify_id", ""), ids, size_bytes)}
+    register_documents(vdb, job.persist_dir, documents, dict(zip(ids, job.load_chunks()[0])))
+    job.finish()
+    retriever = MMRRetriever(vectorstore=vdb)
+    return retriever
+
 
+def register_documents(vdb, persist_dir: str, documents: dict, texts: dict = None):
+    """Record the stored documents, a dict of source to (identify_id, chunk ids, bytes), and delete the replaced ones.
+
+    The `texts` of the stored chunks, a dict of chunk id to text, are indexed by BM25.
+    """
+    registry = DocumentRegistry(persist_dir)
+    removed = []
+    try:
+        for source, (identify_id, ids, size_bytes) in documents.items():
+            replaced = registry.put(source, identify_id, ids, size_bytes)
+            if replaced:
+                delete_chunks(vdb, replaced["ids"])
+                removed.extend(replaced["ids"])
+                print(f"[rag - documents] replaced {len(replaced['ids'])} chunks of {source}")
+    finally:
+        registry.close()
+    if texts or removed:
+        update_index(persist_dir, texts, removed)
+
+
+def delete_document(vdb, persist_dir: str, source: str):
+    """Delete the chunks of a document from the knowledge base, returns False if it has no such document."""
+    registry = DocumentRegistry(persist_dir)
+    try:
+        document = registry.get(source)
+        if document is None:
+            return False
+        forget_embeddings(vdb, document["ids"])
+        delete_chunks(vdb, document["ids"])
+        registry.remove(source)
+        update_index(persist_dir, removed=document["ids"])
+        print(f"[rag - documents] deleted {len(document['ids'])} chunks of {source}")
+        return True
+    finally:
+        registry.close()
+
+
+def get_document(persist_dir: str, source: str):
+    registry = DocumentRegistry(persist_dir)
+    try:
+        return registry.get(source)
+    finally:
+        registry.close()
+
+
+def list_documents(persist_dir: str):
+    registry = DocumentRegistry(persist_dir)
+    try:
+        return registry.list()
+    finally:
+        registry.close()
+
+
+def knowledge_base_footprint(persist_dir: str):
+    """The number of documents, chunks and the estimated bytes stored by a knowledge base."""
+    documents = list_documents(persist_dir)
+    return len(documents), sum(doc["chunks"] for doc in documents), sum(doc["bytes"] for doc in documents)
+
+
+def vector_size(vdb):
+    """The size in bytes of a vector of the vector store, 0 if it cannot be found."""
+    try:
+        if VECTOR_DATABASE == "REDIS":
+            return vdb._schema.content_vector.dims * 4
+        elif VECTOR_DATABASE == "QDRANT":
+            return vdb.client.get_collection(vdb.collection_name).config.params.vectors.size * 4
+        elif VECTOR_DATABASE == "LOCAL":
+            return (vdb.dim or 0) * vdb.dtype.itemsize
+    except Exception as e:
+        print(f"[rag - documents] failed to read the vector size: {e}")
+    return 0
+
+
+def forget_embeddings(vdb, ids: list):
+    """Delete the chunks `ids` of `vdb` from the embedding store, before the chunks are deleted.
+
+    The store is shared by the knowledge bases, a chunk also stored in another knowledge base
+    is only embedded again if it is uploaded again.
+    """
+    if isinstance(vdb.embeddings, CachedEmbeddings) and vdb.embeddings.store is not None:
+        texts = [doc.page_content for doc in documents_by_ids(vdb, ids) if doc is not None]
+        vdb.embeddings.forget(texts)
+
+
+def drop_knowledge_base(vdb, index_name: str, persist_dir: str):
+    """Delete all the chunks of a knowledge base from the vector database, and their stored embeddings."""
+    registry = DocumentRegistry(persist_dir)
+    try:
+        forget_embeddings(vdb, registry.all_ids())
+    finally:
+        registry.close()
     if VECTOR_DATABASE == "REDIS":
         from langchain_community.vectorstores import Redis
-        from rag_redis.config import INDEX_SCHEMA, REDIS_URL
+        from rag_redis.config import REDIS_URL
 
-        vdb = Redis.from_texts(
-            texts=[chunk.page_content for chunk in chunks],
-            metadatas=[chunk.metadata for chunk in chunks],
-            embedding=embeddings,
-            index_name=index_name,
-            redis_url=REDIS_URL,
-            index_schema=INDEX_SCHEMA,
-        )
+        Redis.drop_index(index_name, delete_documents=True, redis_url=REDIS_URL)
 
     elif VECTOR_DATABASE == "QDRANT":
-        from langchain_community.vectorstores import Qdrant
-        from rag_qdrant.config import COLLECTION_NAME, QDRANT_HOST, QDRANT_PORT
+        # the knowledge bases share the collection, their chunks are deleted by id
+        registry = DocumentRegistry(persist_dir)
+        try:
+            delete_chunks(vdb, registry.all_ids())
+        finally:
+            registry.close()
 
-        vdb = Qdrant.from_texts(
-            texts=[chunk.page_content for chunk in chunks],
-            metadatas=[chunk.metadata for chunk in chunks],
-            embedding=embeddings,
-            collection_name=COLLECTION_NAME,
-            host=QDRANT_HOST,
-            port=QDRANT_PORT,
-        )
+    elif VECTOR_DATABASE == "LOCAL":
+        # the index of the knowledge base is a folder of its own
+        vdb.drop()
 
-    retriever = vdb.as_retriever(search_type="mmr")
+
+def delete_chunks(vdb, ids: list, batch_size: int = 1000):
+    if VECTOR_DATABASE == "REDIS":
+        # the keys of the chunks are prefixed by the index
+        prefix = vdb.key_prefix + ":"
+        keys = [key if key.startswith(prefix) else prefix + key for key in ids]
+        for i in range(0, len(keys), batch_size):
+            vdb.client.delete(*keys[i : i + batch_size])
+
+    elif VECTOR_DATABASE in ["QDRANT", "LOCAL"]:
+        for i in range(0, len(ids), batch_size):
+            vdb.delete(ids[i : i + batch_size])
+
+
+def create_retriever_from_links(embeddings, link_list: list, index_name, max_depth=0, persist_dir=None, progress=None):
+    """Ingest the pages of `link_list` into `index_name`.
+
+    If `persist_dir` is given, the crawled pages are recorded in an `HttpCache` in this folder,
+    and re-ingesting the same links into the same index only embeds the pages that changed.
+    Every page is a document of the `DocumentRegistry` with its url as source, so the chunks of
+    the previous version of a changed page are deleted. `progress(done, total)` is called once
+    the pages are crawled and once they are stored.
+    """
+    cache = HttpCache(os.path.join(persist_dir, "http_cache.sqlite")) if persist_dir else None
+    try:
+        retriever = _create_retriever_from_links(
+            embeddings, link_list, index_name, max_depth, cache, persist_dir, progress
+        )
+        if cache:
+            cache.commit()
+    finally:
+        if cache:
+            cache.close()
     return retriever
 
 
-def create_retriever_from_links(embeddings, link_list: list, index_name):
-    data_collection = parse_html(link_list)
+def _create_retriever_from_links(embeddings, link_list, index_name, max_depth, cache, persist_dir, progress=None):
+    data_collection = parse_html(link_list, max_depth, cache)
+    if progress:
+        progress(0, len(data_collection))
+    if not data_collection and cache:
+        print(f"[rag - create retriever] no new or changed page, reuse index: {index_name}")
+        return MMRRetriever(vectorstore=reload_vectorstore(embeddings, index_name, persist_dir))
     texts = []
     metadatas = []
+    ids = []
+    documents = {}
     for data, meta in data_collection:
-        doc_id = str(uuid.uuid4())
-        metadata = {"source": meta, "identify_id": doc_id}
+        if meta not in documents:
+            documents[meta] = [str(uuid.uuid4()), [], 0]
+        document = documents[meta]
+        metadata = {"source": meta, "identify_id": document[0]}
         texts.append(data)
         metadatas.append(metadata)
+        ids.append(str(uuid.uuid4()))
+        document[1].append(ids[-1])
+        document[2] += len(data.encode("utf-8")) + len(json.dumps(metadata))
 
     if VECTOR_DATABASE == "REDIS":
         from langchain_community.vectorstores import Redis
@@ -336,6 +514,7 @@ def create_retriever_from_links(embeddings, link_list: list, index_name):
             index_name=index_name,
             redis_url=REDIS_URL,
             index_schema=INDEX_SCHEMA,
+            keys=ids,
         )
 
     elif VECTOR_DATABASE == "QDRANT":
@@ -349,14 +528,77 @@ def create_retriever_from_links(embeddings, link_list: list, index_name):
             collection_name=COLLECTION_NAME,
             host=QDRANT_HOST,
             port=QDRANT_PORT,
+            ids=ids,
+        )
+
+    elif VECTOR_DATABASE == "LOCAL":
+        from local_vectorstore import LocalVectorStore, index_folder
+
+        vdb = LocalVectorStore.from_texts(
+            texts=texts,
+            metadatas=metadatas,
+            embedding=embeddings,
+            folder=index_folder(index_name, persist_dir),
+            ids=ids,
         )
 
-    retriever = vdb.as_retriever(search_type="mmr")
+    if persist_dir:
+        vector_bytes = vector_size(vdb)
+        for document in documents.values():
+            document[2] += len(document[1]) * vector_bytes
+        register_documents(vdb, persist_dir, documents, dict(zip(ids, texts)))
+    if progress:
+        progress(len(texts), len(texts))
+    retriever = MMRRetriever(vectorstore=vdb)
     return retriever
 
 
-def reload_retriever(embeddings, index_name):
-    print(f"[rag - reload retriever] reload with index: {index_name}")
+_qdrant_client = None
+
+
+def get_qdrant_client():
+    """Return the process-wide Qdrant client, its connection pool is shared by all knowledge bases."""
+    global _qdrant_client
+    if _qdrant_client is None:
+        from qdrant_client import QdrantClient
+        from rag_qdrant.config import QDRANT_HOST, QDRANT_PORT
+
+        _qdrant_client = QdrantClient(host=QDRANT_HOST, port=QDRANT_PORT)
+    return _qdrant_client
+
+
+_redis_client = None
+
+
+def index_generation(index_name: str):
+    """The generation of the index of the default knowledge base, which changes with its chunks.
+
+    The default knowledge base is ingested outside of the server, its generation is the counter
+    that `invalidate_answers` increments after a Redis ingestion, the generation that
+    `QdrantBulkLoader` bumps after a Qdrant ingestion, or the version of the local index.
+    """
+    global _redis_client
+    if VECTOR_DATABASE == "REDIS":
+        from rag_redis.response_cache import generation_key
+
+        if _redis_client is None:
+            import redis
+            from rag_redis.config import REDIS_URL
+
+            _redis_client = redis.Redis.from_url(REDIS_URL)
+        return int(_redis_client.get(generation_key(index_name)) or 0)
+    if VECTOR_DATABASE == "QDRANT":
+        from rag_qdrant.retrieval_cache import read_generation
+
+        return read_generation(get_qdrant_client(), index_name)
+    from local_vectorstore import index_folder, index_version
+
+    return index_version(index_folder(index_name))
+
+
+def reload_vectorstore(embeddings, index_name, persist_dir=None):
+    """Connect to the index of a knowledge base, a LOCAL index is in the `persist_dir` of the knowledge base."""
+    print(f"[rag - reload vectorstore] reload with index: {index_name}")
 
     if VECTOR_DATABASE == "REDIS":
         from langchain_community.vectorstores import Redis
@@ -371,26 +613,34 @@ def reload_retriever(embeddings, index_name):
 
     elif VECTOR_DATABASE == "QDRANT":
         from langchain_community.vectorstores import Qdrant
-        from qdrant_client import QdrantClient
-        from rag_qdrant.config import COLLECTION_NAME, QDRANT_HOST, QDRANT_PORT
+        from rag_qdrant.config import COLLECTION_NAME
 
-        client = QdrantClient(host=QDRANT_HOST, port=QDRANT_PORT)
         vdb = Qdrant(
             embeddings=embeddings,
             collection_name=COLLECTION_NAME,
-            client=client,
+            client=get_qdrant_client(),
         )
 
-    retriever = vdb.as_retriever(search_type="mmr")
-    return retriever
+    elif VECTOR_DATABASE == "LOCAL":
+        from local_vectorstore import LocalVectorStore, index_folder
 
+        vdb = LocalVectorStore(index_folder(index_name, persist_dir), embeddings)
 
-def post_process_text(text: str):
-    if text == " ":
-        return "data: @#$\n\n"
-    if text == "\n":
-        return "data: <br/>\n\n"
-    if text.isspace():
-        return None
-    new_text = text.replace(" ", "@#$")
-    return f"data: {new_text}\n\n"
+    return vdb
+
+
+def release_vectorstore(vdb):
+    """Close the connections owned by a vector store, the shared Qdrant client is kept open.
+
+    The requests that still hold the vector store open its connections again.
+    """
+    if VECTOR_DATABASE == "REDIS":
+        vdb.client.close()
+    elif VECTOR_DATABASE == "LOCAL":
+        vdb.close()
+
+
+def reload_retriever(embeddings, index_name, persist_dir=None):
+    vdb = reload_vectorstore(embeddings, index_name, persist_dir)
+    retriever = MMRRetriever(vectorstore=vdb)
+    return retriever
@@ -0,0 +1,8 @@
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: Apache-2.0
+
+import os
+import sys
+
+# the modules of the app import each other by their name, as when the server runs from the app folder
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
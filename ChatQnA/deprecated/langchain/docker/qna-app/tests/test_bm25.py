@@ -0,0 +1,43 @@
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: Apache-2.0
+
+import os
+
+import bm25
+from bm25 import DELTA_FILE, INDEX_FILE, load_index, update_index
+
+
+def ids(index, query):
+    return [chunk_id for chunk_id, _ in index.search(query)]
+
+
+def test_changes_are_appended_without_rewriting_the_index(tmp_path, monkeypatch):
+    monkeypatch.setattr(bm25, "MERGE_BYTES", 0)
+    update_index(str(tmp_path), {"a": "the i7-12700k processor", "b": "a gpu accelerator"})
+    # the first change is merged into the empty index
+    assert not (tmp_path / DELTA_FILE).exists()
+    mtime = os.stat(tmp_path / INDEX_FILE).st_mtime_ns
+    monkeypatch.setattr(bm25, "MERGE_BYTES", 1 << 20)
+    update_index(str(tmp_path), {"b": "a network adapter", "c": "another processor"}, removed=["a"])
+    assert os.stat(tmp_path / INDEX_FILE).st_mtime_ns == mtime
+    index = load_index(str(tmp_path))
+    assert ids(index, "12700k") == []
+    assert ids(index, "gpu") == []
+    assert ids(index, "network") == ["b"]
+    assert ids(index, "processor") == ["c"]
+    assert load_index(str(tmp_path)) is index
+
+
+def test_merged_index_is_unchanged_by_the_delta(tmp_path, monkeypatch):
+    update_index(str(tmp_path), {"a": "alpha", "b": "beta"})
+    update_index(str(tmp_path), {"c": "gamma"}, removed=["a"])
+    update_index(str(tmp_path), {"a": "delta"}, removed=["b"])
+    update_index(str(tmp_path), removed=["a"])
+    delta = (tmp_path / DELTA_FILE).read_bytes()
+    monkeypatch.setattr(bm25, "MERGE_BYTES", 0)
+    update_index(str(tmp_path), removed=["unknown"])
+    assert not (tmp_path / DELTA_FILE).exists()
+    # a reader that read the delta being merged applies it again to the merged index
+    (tmp_path / DELTA_FILE).write_bytes(delta)
+    for index in [load_index(str(tmp_path)), bm25.BM25Index.load(str(tmp_path / INDEX_FILE))]:
+        assert [ids(index, term) for term in ["alpha", "beta", "gamma", "delta"]] == [[], [], ["c"], []]
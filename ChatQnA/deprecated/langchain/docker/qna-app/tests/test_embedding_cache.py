@@ -0,0 +1,82 @@
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: Apache-2.0
+
+import sqlite3
+
+import embedding_cache
+import utils
+from documents import DocumentRegistry
+from embedding_cache import CachedEmbeddings, EmbeddingStore, content_key
+from langchain_core.embeddings import Embeddings
+from local_vectorstore import LocalVectorStore
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class CountingEmbeddings(Embeddings):
+    def __init__(self):
+        self.embedded = 0
+
+    def embed_documents(self, texts):
+        self.embedded += len(texts)
+        return [[float(len(text)), 1.0] for text in texts]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+def test_least_recently_used_embeddings_are_pruned(tmp_path, monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(embedding_cache.time, "time", clock)
+    store = EmbeddingStore(str(tmp_path / "embeddings.sqlite"), max_rows=2)
+    store.put_many([("a", [1.0]), ("b", [2.0])])
+    clock.now += 1
+    assert list(store.get_many(["a"])) == ["a"]
+    clock.now += 1
+    store.put_many([("c", [3.0])])
+    assert sorted(store.get_many(["a", "b", "c"])) == ["a", "c"]
+
+
+def test_embeddings_unused_for_max_age_are_pruned(tmp_path, monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(embedding_cache.time, "time", clock)
+    store = EmbeddingStore(str(tmp_path / "embeddings.sqlite"), max_age=60)
+    store.put_many([("a", [1.0]), ("b", [2.0])])
+    clock.now += 50
+    store.get_many(["a"])
+    clock.now += 20
+    store.put_many([("c", [3.0])])
+    assert sorted(store.get_many(["a", "b", "c"])) == ["a", "c"]
+
+
+def test_store_created_before_pruning_is_migrated(tmp_path):
+    path = str(tmp_path / "embeddings.sqlite")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE embeddings (key TEXT PRIMARY KEY, vector BLOB, created_at REAL)")
+    conn.execute("INSERT INTO embeddings VALUES ('a', ?, 1.0)", (b"\0\0\x80?",))
+    conn.commit()
+    conn.close()
+    store = EmbeddingStore(path, max_rows=1)
+    store.put_many([("b", [2.0])])
+    assert store.get_many(["a", "b"]) == {"b": [2.0]}
+
+
+def test_deleted_document_is_deleted_from_the_store(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils, "VECTOR_DATABASE", "LOCAL")
+    store = EmbeddingStore(str(tmp_path / "embeddings.sqlite"))
+    embeddings = CachedEmbeddings(CountingEmbeddings(), store, "model")
+    vdb = LocalVectorStore(str(tmp_path / "vectors"), embeddings)
+    vdb.add_texts(["kept chunk", "deleted chunk"], ids=["1", "2"])
+    registry = DocumentRegistry(str(tmp_path))
+    registry.put("kept.txt", "k", ["1"])
+    registry.put("deleted.txt", "d", ["2"])
+    registry.close()
+    assert utils.delete_document(vdb, str(tmp_path), "deleted.txt")
+    keys = [content_key(text, "model") for text in ["kept chunk", "deleted chunk"]]
+    assert list(store.get_many(keys)) == [keys[0]]
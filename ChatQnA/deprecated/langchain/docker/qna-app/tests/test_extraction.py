@@ -0,0 +1,35 @@
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: Apache-2.0
+
+import pytest
+from utils import extract_main_content, html_tree
+
+
+def extract(*blocks, element_name="main"):
+    divs = "".join(f'<div class="{element_name}">{block}</div>' for block in blocks)
+    return extract_main_content(html_tree(f"<html><body>{divs}</body></html>"))
+
+
+@pytest.mark.parametrize(
+    "blocks, expected",
+    [
+        # a block contained in the extracted text is skipped, not only a repeated one
+        (["one", "on"], "one"),
+        (["abc", "abcdef", "b"], "abcabcdef"),
+        (["abc", "abc", "def"], "abcdef"),
+    ],
+)
+def test_blocks_contained_in_the_extracted_text_are_skipped(blocks, expected):
+    assert extract(*blocks) == expected
+
+
+def test_container_of_an_extracted_block_is_extracted_whole():
+    # only the blocks contained in the extracted text are skipped, not the blocks that contain it,
+    # so the text of the main block is repeated in its container, as before the substring dedup
+    html = '<html><body><div class="container"><div class="main">inner</div> outer</div></body></html>'
+    assert extract_main_content(html_tree(html)) == "innerinner outer"
+
+
+def test_block_nested_in_an_extracted_block_is_skipped():
+    html = '<html><body><div class="main">outer <div class="main">inner</div></div></body></html>'
+    assert extract_main_content(html_tree(html)) == "outer inner"
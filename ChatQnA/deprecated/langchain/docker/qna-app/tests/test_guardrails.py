@@ -0,0 +1,42 @@
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: Apache-2.0
+
+import asyncio
+
+import pytest
+from guardrails import GuardrailViolation, StreamingOutputModerator
+
+
+async def tokens(texts):
+    for text in texts:
+        yield text
+
+
+async def check(text):
+    # the check of the flagged window is the slowest
+    await asyncio.sleep(0.05 if "BAD" in text else 0)
+    return ["S1"] if "BAD" in text else None
+
+
+async def received(moderator, texts):
+    sent = []
+    with pytest.raises(GuardrailViolation):
+        async for text in moderator.moderate(tokens(texts)):
+            sent.append(text)
+    return sent
+
+
+@pytest.mark.parametrize("max_lag", [1, 2, 3])
+def test_flagged_window_is_at_most_max_lag_windows_ahead(max_lag):
+    # every token closes a window
+    texts = ["ok.", "BAD.", "w3.", "w4.", "w5.", "w6."]
+    moderator = StreamingOutputModerator(check, window_size=3, max_lag=max_lag)
+    sent = asyncio.run(received(moderator, texts))
+    # the flagged window and the windows after it, all unchecked
+    assert sent == texts[: 1 + max_lag]
+
+
+def test_open_window_counts_as_unchecked():
+    texts = ["BAD.", "w2 ", "w2 ", "w2."]
+    moderator = StreamingOutputModerator(check, window_size=3, max_lag=1)
+    assert asyncio.run(received(moderator, texts)) == ["BAD."]
@@ -0,0 +1,51 @@
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: Apache-2.0
+
+import numpy as np
+import pytest
+from langchain_core.embeddings import Embeddings
+from local_vectorstore import LocalVectorStore
+
+
+class OneHotEmbeddings(Embeddings):
+    """Text "i" is embedded as the i-th unit vector."""
+
+    dim = 4096
+
+    def embed_documents(self, texts):
+        return [self.embed_query(text) for text in texts]
+
+    def embed_query(self, text):
+        vector = np.zeros(self.dim, dtype=np.float32)
+        vector[int(text)] = 1
+        return vector.tolist()
+
+
+@pytest.fixture
+def store(tmp_path):
+    texts = [str(i) for i in range(3000)]
+    vdb = LocalVectorStore(str(tmp_path / "vectors"), OneHotEmbeddings(), ivf_min_vectors=0)
+    vdb.add_texts(texts, [{} for _ in texts], ids=texts)
+    return vdb
+
+
+def test_search_on_a_snapshot_taken_before_compaction(store):
+    snapshot = store._load()
+    # deleting most of the rows compacts the index
+    store.delete([str(i) for i in range(200, 2700)])
+    assert store._row_files()[0] == 3000
+    offsets, _ = store._top_rows(snapshot, OneHotEmbeddings().embed_query("250"), 1)
+    # the rows of the snapshot are not found anymore, never the chunks compacted in their place
+    assert store._documents(offsets + snapshot.base) == [None]
+    assert snapshot.vectors[offsets[0], 250] == 1
+    assert [doc.page_content for doc in store.similarity_search("2750", k=1)] == ["2750"]
+    assert [doc.page_content for doc in store.similarity_search("150", k=1)] == ["150"]
+
+
+def test_search_after_close(store):
+    store.close()
+    assert [doc.page_content for doc in store.similarity_search("7", k=1)] == ["7"]
+    store.close()
+    documents, vectors = store.similarity_search_with_vectors(OneHotEmbeddings().embed_query("12"), k=1)
+    assert [doc.page_content for doc in documents] == ["12"]
+    assert vectors.shape == (1, OneHotEmbeddings.dim)
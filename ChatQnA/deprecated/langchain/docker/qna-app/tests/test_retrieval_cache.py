@@ -0,0 +1,50 @@
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: Apache-2.0
+
+import retrieval_cache
+from retrieval_cache import IndexGeneration, RetrievalCache
+
+PARAMS = ("MMRRetriever", 4, 20, 0.5)
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_bumped_generation_is_a_miss():
+    generations = {"kb": 1}
+    cache = RetrievalCache(generations.get, maxsize=8, ttl=60)
+    cache.put(cache.key("kb", "What is  OPEA?", PARAMS), [("id-1", 0.9)])
+    assert cache.get(cache.key("kb", "What is OPEA?", PARAMS)) == (("id-1", 0.9),)
+    generations["kb"] += 1
+    assert cache.get(cache.key("kb", "What is OPEA?", PARAMS)) is None
+    assert cache.key("unknown", "What is OPEA?", PARAMS) is None
+
+
+def test_results_expire_even_when_hit(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(retrieval_cache.time, "monotonic", clock)
+    cache = RetrievalCache(lambda kb_id: 0, maxsize=8, ttl=60)
+    key = cache.key("default", "What is OPEA?", PARAMS)
+    cache.put(key, [("id-1", 0.9)])
+    # a hit does not extend the expiry of the results
+    for _ in range(5):
+        clock.now += 10
+        assert cache.get(key) is not None
+    clock.now += 11
+    assert cache.get(key) is None
+    assert cache.stats()["size"] == 0
+
+
+def test_index_generation_is_read_again_after_refresh(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(retrieval_cache.time, "monotonic", clock)
+    versions = iter(range(10))
+    generation = IndexGeneration(lambda: next(versions), refresh=1.0)
+    assert generation() == generation() == 0
+    clock.now += 1
+    assert generation() == 1
@@ -0,0 +1,16 @@
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: Apache-2.0
+
+from sse import SSEEncoder, is_legacy_token
+
+
+def test_legacy_stream_drops_whitespace_only_tokens():
+    tokens = ["Hello", " ", "\n", "\n\n", "  ", "\t", "world", " again"]
+    frames = SSEEncoder(flush_interval=0).encode(token for token in tokens if is_legacy_token(token))
+    assert list(frames) == [
+        "data: Hello\n\n",
+        "data: @#$\n\n",
+        "data: <br/>\n\n",
+        "data: world\n\n",
+        "data: @#$again\n\n",
+    ]
@@ -3,52 +3,16 @@
 # Copyright (C) 2024 Intel Corporation
 # SPDX-License-Identifier: Apache-2.0
 
-import io
 import os
 
-import numpy as np
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_community.embeddings import HuggingFaceBgeEmbeddings, HuggingFaceHubEmbeddings
-from langchain_community.vectorstores import Qdrant
-from PIL import Image
-from rag_qdrant.config import COLLECTION_NAME, EMBED_MODEL, QDRANT_HOST, QDRANT_PORT, TEI_EMBEDDING_ENDPOINT
+from rag_qdrant.bulk_loader import QdrantBulkLoader
+from rag_qdrant.config import COLLECTION_NAME, EMBED_MODEL, TEI_EMBEDDING_ENDPOINT
+from rag_qdrant.pdf_loader import pdf_loader
 
-
-def pdf_loader(file_path):
-    try:
-        import easyocr
-        import fitz
-    except ImportError:
-        raise ImportError(
-            "`PyMuPDF` or 'easyocr' package is not found, please install it with "
-            "`pip install pymupdf or pip install easyocr.`"
-        )
-
-    doc = fitz.open(file_path)
-    reader = easyocr.Reader(["en"])
-    result = ""
-    for i in range(doc.page_count):
-        page = doc.load_page(i)
-        pagetext = page.get_text().strip()
-        if pagetext:
-            result = result + pagetext
-        if len(doc.get_page_images(i)) > 0:
-            for img in doc.get_page_images(i):
-                if img:
-                    pageimg = ""
-                    xref = img[0]
-                    img_data = doc.extract_image(xref)
-                    img_bytes = img_data["image"]
-                    pil_image = Image.open(io.BytesIO(img_bytes))
-                    img = np.array(pil_image)
-                    img_result = reader.readtext(img, paragraph=True, detail=0)
-                    pageimg = pageimg + ", ".join(img_result).strip()
-                    if pageimg.endswith("!") or pageimg.endswith("?") or pageimg.endswith("."):
-                        pass
-                    else:
-                        pageimg = pageimg + "."
-                result = result + pageimg
-    return result
+# the default checkpoint is specific to the script and the collection, so that two ingestions never resume each other
+ingest_checkpoint = os.getenv("INGEST_CHECKPOINT", f".ingest-{COLLECTION_NAME}.json")
 
 
 def ingest_documents():
@@ -74,21 +38,11 @@ def ingest_documents():
         # create embeddings using local embedding model
         embedder = HuggingFaceBgeEmbeddings(model_name=EMBED_MODEL)
 
-    # Batch size
-    batch_size = 32
-    num_chunks = len(chunks)
-    for i in range(0, num_chunks, batch_size):
-        batch_chunks = chunks[i : i + batch_size]
-        batch_texts = [f"Company: {company_name}. " + chunk for chunk in batch_chunks]
-
-        _ = Qdrant.from_texts(
-            texts=batch_texts,
-            embedding=embedder,
-            collection_name=COLLECTION_NAME,
-            host=QDRANT_HOST,
-            port=QDRANT_PORT,
-        )
-        print(f"Processed batch {i//batch_size + 1}/{(num_chunks-1)//batch_size + 1}")
+    # Embed the next batch while the previous one is written
+    texts = [f"Company: {company_name}. " + chunk for chunk in chunks]
+    loader = QdrantBulkLoader(embedder, batch_size=32)
+    # an interrupted ingestion resumes after the last stored batch when run again
+    loader.load(texts, checkpoint=ingest_checkpoint or None)
 
 
 if __name__ == "__main__":
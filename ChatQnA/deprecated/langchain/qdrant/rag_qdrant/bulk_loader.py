@@ -0,0 +1,162 @@
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: Apache-2.0
+
+import hashlib
+import json
+import os
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from langchain_community.vectorstores import Qdrant
+from qdrant_client import QdrantClient
+from qdrant_client.http import models as rest
+from rag_qdrant.config import COLLECTION_NAME, QDRANT_HOST, QDRANT_PORT
+from rag_qdrant.retrieval_cache import bump_generation
+
+
+def stable_ids(texts: list):
+    """Ids derived from the position and content of every text, identical when the same texts are loaded again."""
+    return [
+        str(uuid.uuid5(uuid.NAMESPACE_OID, f"{i}:{hashlib.sha256(text.encode('utf-8')).hexdigest()}"))
+        for i, text in enumerate(texts)
+    ]
+
+
+def _read_checkpoint(path: str, fingerprint: str):
+    """The number of texts already stored by an interrupted load of the same texts."""
+    try:
+        with open(path, encoding="utf-8") as f:
+            checkpoint = json.load(f)
+    except FileNotFoundError:
+        return 0
+    if checkpoint.get("fingerprint") != fingerprint:
+        print(f"Ignoring the checkpoint {path}, it was written for other texts")
+        return 0
+    return checkpoint["committed"]
+
+
+def _write_checkpoint(path: str, fingerprint: str, committed: int):
+    # written to a temporary file first, so that an interrupted load never leaves a truncated checkpoint
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        json.dump({"fingerprint": fingerprint, "committed": committed}, f)
+    os.replace(tmp_path, path)
+
+
+class QdrantBulkLoader:
+    """Load large numbers of texts into a Qdrant collection.
+
+    Texts are embedded in batches of `batch_size`, and every batch is upserted while the next
+    batch is being embedded. The client (and its connection pool) is created once, and the
+    collection is created once, if it does not exist, before the first write.
+    """
+
+    def __init__(
+        self,
+        embedding,
+        collection_name: str = COLLECTION_NAME,
+        host: str = QDRANT_HOST,
+        port: int = QDRANT_PORT,
+        batch_size: int = 32,
+        client: QdrantClient = None,
+    ):
+        self.embedding = embedding
+        self.collection_name = collection_name
+        self.batch_size = batch_size
+        self.client = client or QdrantClient(host=host, port=port)
+        self.vectorstore = Qdrant(client=self.client, collection_name=collection_name, embeddings=embedding)
+        self._collection_ready = False
+
+    def _ensure_collection(self, dim: int):
+        if self._collection_ready:
+            return
+        if self.client.collection_exists(self.collection_name):
+            vectors = self.client.get_collection(self.collection_name).config.params.vectors
+            if vectors.size != dim:
+                raise ValueError(
+                    f"Existing Qdrant collection {self.collection_name} is configured for vectors with "
+                    f"{vectors.size} dimensions, the embeddings are {dim}-dimensional."
+                )
+        else:
+            self.client.create_collection(
+                collection_name=self.collection_name,
+                vectors_config=rest.VectorParams(size=dim, distance=rest.Distance.COSINE),
+            )
+        self._collection_ready = True
+
+    def _write(self, texts, metadatas, embeddings, ids):
+        points = [
+            rest.PointStruct(
+                id=point_id,
+                vector=embedding,
+                payload={Qdrant.CONTENT_KEY: text, Qdrant.METADATA_KEY: metadata},
+            )
+            for text, metadata, embedding, point_id in zip(texts, metadatas, embeddings, ids)
+        ]
+        self.client.upsert(collection_name=self.collection_name, points=points, wait=True)
+
+    def load(self, texts: list, metadatas: list = None, ids: list = None, checkpoint: str = None):
+        """Embed and store `texts`, returns their point ids.
+
+        With a `checkpoint` file, the number of stored texts is recorded after every batch, and
+        a load of the same texts that was interrupted resumes after its last stored batch. The
+        ids default to `stable_ids(texts)` then, so that a batch stored again is overwritten
+        instead of duplicated. The checkpoint is removed once all the texts are stored.
+
+        The generation of the collection is bumped once the texts are stored, which drops the
+        retrievals cached on the previous points, see `RetrievalCache`.
+        """
+        texts = list(texts)
+        metadatas = metadatas or [None for _ in texts]
+        assert len(metadatas) == len(texts), "Number of metadatas must match number of texts"
+        if ids is None:
+            ids = stable_ids(texts) if checkpoint else [uuid.uuid4().hex for _ in texts]
+
+        committed = 0
+        if checkpoint:
+            fingerprint = hashlib.sha256("\n".join(ids).encode("utf-8")).hexdigest()
+            committed = _read_checkpoint(checkpoint, fingerprint)
+            if committed:
+                print(f"Resuming from {checkpoint}, {committed}/{len(texts)} chunks already stored")
+
+        def write(*args, end):
+            self._write(*args)
+            if checkpoint:
+                _write_checkpoint(checkpoint, fingerprint, end)
+
+        num_batches = (len(texts) - 1) // self.batch_size + 1 if texts else 0
+        start = time.perf_counter()
+        # a single writer, so that at most one batch is written while the next one is embedded
+        with ThreadPoolExecutor(max_workers=1) as writer:
+            pending = None
+            for batch, i in enumerate(range(0, len(texts), self.batch_size)):
+                if i + self.batch_size <= committed:
+                    continue
+                batch_texts = texts[i : i + self.batch_size]
+                embeddings = self.embedding.embed_documents(batch_texts)
+                self._ensure_collection(len(embeddings[0]))
+                if pending is not None:
+                    pending.result()
+                pending = writer.submit(
+                    write,
+                    batch_texts,
+                    metadatas[i : i + self.batch_size],
+                    embeddings,
+                    ids[i : i + self.batch_size],
+                    end=i + len(batch_texts),
+                )
+                elapsed = time.perf_counter() - start
+                loaded = i + len(batch_texts) - committed
+                print(f"Processed batch {batch + 1}/{num_batches}, {loaded / elapsed:.1f} chunks/s")
+            if pending is not None:
+                pending.result()
+        if checkpoint and os.path.exists(checkpoint):
+            os.remove(checkpoint)
+        bump_generation(self.client, self.collection_name)
+        elapsed = time.perf_counter() - start
+        print(f"Loaded {len(texts)} chunks into {self.collection_name} in {elapsed:.1f}s")
+        if elapsed > 0:
+            print(f"Throughput: {(len(texts) - committed) / elapsed:.1f} chunks/s")
+        return ids
@@ -11,7 +11,16 @@ from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.pydantic_v1 import BaseModel
 from langchain_core.runnables import RunnableParallel, RunnablePassthrough
 from qdrant_client import QdrantClient
-from rag_qdrant.config import COLLECTION_NAME, EMBED_MODEL, QDRANT_HOST, QDRANT_PORT, TGI_LLM_ENDPOINT
+from rag_qdrant.config import (
+    COLLECTION_NAME,
+    EMBED_MODEL,
+    QDRANT_HOST,
+    QDRANT_PORT,
+    RETRIEVAL_CACHE_SIZE,
+    TGI_LLM_ENDPOINT,
+)
+from rag_qdrant.mmr import MMRRetriever
+from rag_qdrant.retrieval_cache import RetrievalCache
 
 
 # Make this look better in the docs.
@@ -28,8 +37,10 @@ embedder = HuggingFaceEmbeddings(model_name=EMBED_MODEL)
 client = QdrantClient(host=QDRANT_HOST, port=QDRANT_PORT)
 vectorstore = Qdrant(embeddings=embedder, collection_name=COLLECTION_NAME, client=client)
 
-# TODO allow user to change parameters
-retriever = vectorstore.as_retriever(search_type="mmr")
+# k, fetch_k and lambda_mult can be changed per request in the config, the chunks retrieved for
+# the repeated queries are fetched by id until chunks are loaded into the collection, see `RetrievalCache`
+retrieval_cache = RetrievalCache(client) if RETRIEVAL_CACHE_SIZE > 0 else None
+retriever = MMRRetriever(vectorstore=vectorstore, cache=retrieval_cache).configurable()
 
 # Define our prompt
 template = """
@@ -15,3 +15,14 @@ COLLECTION_NAME = os.getenv("COLLECTION_NAME", "rag-qdrant")
 TGI_LLM_ENDPOINT = os.getenv("TGI_LLM_ENDPOINT", "http://localhost:8080")
 TGI_LLM_ENDPOINT_NO_RAG = os.getenv("TGI_LLM_ENDPOINT_NO_RAG", "http://localhost:8081")
 TEI_EMBEDDING_ENDPOINT = os.getenv("TEI_ENDPOINT")
+
+# MMR retrieval: number of returned chunks, number of candidates fetched from the vector store,
+# and trade-off between relevance (1) and diversity (0), also set per request in the config.
+MMR_K = int(os.getenv("MMR_K", 4))
+MMR_FETCH_K = int(os.getenv("MMR_FETCH_K", 20))
+MMR_LAMBDA_MULT = float(os.getenv("MMR_LAMBDA_MULT", 0.5))
+
+# The chunks retrieved for the last RETRIEVAL_CACHE_SIZE queries are cached in process (0 disables it),
+# for at most RETRIEVAL_CACHE_TTL seconds, and until chunks are loaded into the collection.
+RETRIEVAL_CACHE_SIZE = int(os.getenv("RETRIEVAL_CACHE_SIZE", 10000))
+RETRIEVAL_CACHE_TTL = float(os.getenv("RETRIEVAL_CACHE_TTL", 3600))
@@ -0,0 +1,129 @@
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: Apache-2.0
+
+import threading
+import time
+import unicodedata
+from collections import Counter, OrderedDict
+
+from qdrant_client.http import models as rest
+from rag_qdrant.config import RETRIEVAL_CACHE_SIZE, RETRIEVAL_CACHE_TTL
+
+# The generation of a collection is read from Qdrant at most every GENERATION_REFRESH seconds, which
+# bounds the time a process keeps retrieving from the cached results of a collection that changed.
+GENERATION_REFRESH = 1.0
+GENERATION_POINT_ID = 0
+
+
+def generation_collection(collection_name: str):
+    """The collection holding the generation of `collection_name`, a single point without a meaningful vector."""
+    return f"{collection_name}-generation"
+
+
+def read_generation(client, collection_name: str):
+    """The generation of `collection_name`, 0 until the first `bump_generation`."""
+    name = generation_collection(collection_name)
+    if not client.collection_exists(name):
+        return 0
+    points = client.retrieve(name, ids=[GENERATION_POINT_ID], with_payload=True, with_vectors=False)
+    return points[0].payload["generation"] if points else 0
+
+
+def bump_generation(client, collection_name: str):
+    """Give `collection_name` a new generation, after its points changed.
+
+    The generation is the time of the change in nanoseconds rather than an incremented counter,
+    so two loaders bumping it at the same time still leave a generation never read before.
+    """
+    name = generation_collection(collection_name)
+    if not client.collection_exists(name):
+        client.create_collection(name, vectors_config=rest.VectorParams(size=1, distance=rest.Distance.DOT))
+    generation = max(time.time_ns(), read_generation(client, collection_name) + 1)
+    point = rest.PointStruct(id=GENERATION_POINT_ID, vector=[0.0], payload={"generation": generation})
+    client.upsert(name, points=[point], wait=True)
+    return generation
+
+
+def normalize_text(text: str):
+    """The form of a text used for its key: NFC, whitespace runs collapsed, surrounding spaces stripped."""
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+class RetrievalCache:
+    """The ids and scores of the chunks retrieved for the last `maxsize` queries, kept in process.
+
+    Results are keyed by collection, by the generation of the collection, by normalized query and
+    by search parameters, and expire after `ttl` seconds. The generation of a collection is read
+    at most every GENERATION_REFRESH seconds, and `QdrantBulkLoader` bumps it after every load, so
+    the results cached before a load are never returned again and age out of the LRU. The chunks
+    of a hit are fetched by id, and results whose chunks are gone are discarded.
+    """
+
+    def __init__(self, client, maxsize: int = RETRIEVAL_CACHE_SIZE, ttl: float = RETRIEVAL_CACHE_TTL):
+        assert maxsize > 0, "maxsize should be positive"
+        self.client = client
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # key -> (results, expiry time), least recently used first
+        self._entries = OrderedDict()
+        self._generations = {}
+        self._stats = Counter()
+
+    def _generation(self, collection_name: str):
+        now = time.monotonic()
+        with self._lock:
+            cached = self._generations.get(collection_name)
+        if cached is not None and now - cached[1] < GENERATION_REFRESH:
+            return cached[0]
+        generation = read_generation(self.client, collection_name)
+        with self._lock:
+            self._generations[collection_name] = (generation, now)
+        return generation
+
+    def key(self, collection_name: str, query: str, search_params: tuple):
+        """The key of the results of `query` on the current generation of `collection_name`, None if it is unknown."""
+        try:
+            generation = self._generation(collection_name)
+        except Exception as e:
+            print(f"[rag - retrieval cache] generation lookup failed: {e}")
+            return None
+        return (collection_name, generation, normalize_text(query), search_params)
+
+    def get(self, key):
+        """The cached (chunk id, score) results of `key`, best first, None on a miss."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] < time.monotonic():
+                del self._entries[key]
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+            self._stats["hits" if entry is not None else "misses"] += 1
+        return entry[0] if entry is not None else None
+
+    def put(self, key, results):
+        with self._lock:
+            self._entries[key] = (tuple(results), time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def discard(self, key):
+        """Drop the results of `key` whose chunks could not all be fetched, they are retrieved again."""
+        with self._lock:
+            self._entries.pop(key, None)
+            self._stats["stale"] += 1
+
+    def stats(self):
+        """The number of lookups, of hits, and the hit rate since the cache was created."""
+        with self._lock:
+            hits, misses, stale = self._stats["hits"], self._stats["misses"], self._stats["stale"]
+            size = len(self._entries)
+        return {
+            "lookups": hits + misses,
+            "hits": hits - stale,
+            "misses": misses + stale,
+            "hit_rate": (hits - stale) / (hits + misses) if hits + misses else 0.0,
+            "size": size,
+        }
@@ -0,0 +1,38 @@
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: Apache-2.0
+
+from langchain_core.embeddings import Embeddings
+from qdrant_client import QdrantClient
+from rag_qdrant import retrieval_cache
+from rag_qdrant.bulk_loader import QdrantBulkLoader
+from rag_qdrant.retrieval_cache import RetrievalCache
+
+PARAMS = ("mmr", 4, 20, 0.5)
+
+
+class LengthEmbeddings(Embeddings):
+    def embed_documents(self, texts):
+        return [self.embed_query(text) for text in texts]
+
+    def embed_query(self, text):
+        return [float(len(text)), 1.0]
+
+
+def test_replacing_the_points_changes_the_generation(monkeypatch):
+    monkeypatch.setattr(retrieval_cache, "GENERATION_REFRESH", 0)
+    client = QdrantClient(":memory:")
+    loader = QdrantBulkLoader(LengthEmbeddings(), collection_name="kb", client=client)
+    cache = RetrievalCache(client, maxsize=8, ttl=60)
+    ids = ["00000000-0000-0000-0000-000000000001", "00000000-0000-0000-0000-000000000002"]
+    loader.load(["first", "second"], ids=ids)
+    key = cache.key("kb", "What is  OPEA?", PARAMS)
+    cache.put(key, [(ids[0], 0.9)])
+    assert cache.get(cache.key("kb", "What is OPEA?", PARAMS)) == ((ids[0], 0.9),)
+    # the same number of points, with other contents
+    loader.load(["third", "fourth"], ids=ids)
+    assert client.get_collection("kb").points_count == 2
+    assert cache.get(cache.key("kb", "What is OPEA?", PARAMS)) is None
+
+
+def test_generation_of_a_collection_never_loaded_is_zero():
+    assert retrieval_cache.read_generation(QdrantClient(":memory:"), "kb") == 0
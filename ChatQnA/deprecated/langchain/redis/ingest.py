@@ -5,54 +5,19 @@
 
 #
 
-import io
 import os
 
-import numpy as np
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_community.embeddings import HuggingFaceBgeEmbeddings, HuggingFaceEmbeddings, HuggingFaceHubEmbeddings
-from langchain_community.vectorstores import Redis
-from PIL import Image
-from rag_redis.config import EMBED_MODEL, INDEX_NAME, INDEX_SCHEMA, REDIS_URL
+from rag_redis.bulk_loader import RedisBulkLoader
+from rag_redis.config import EMBED_MODEL, INDEX_NAME
+from rag_redis.embedding_cache import cached_embeddings
+from rag_redis.pdf_loader import pdf_loader
+from rag_redis.response_cache import invalidate_answers
 
 tei_embedding_endpoint = os.getenv("TEI_ENDPOINT")
-
-
-def pdf_loader(file_path):
-    try:
-        import easyocr
-        import fitz
-    except ImportError:
-        raise ImportError(
-            "`PyMuPDF` or 'easyocr' package is not found, please install it with "
-            "`pip install pymupdf or pip install easyocr.`"
-        )
-
-    doc = fitz.open(file_path)
-    reader = easyocr.Reader(["en"])
-    result = ""
-    for i in range(doc.page_count):
-        page = doc.load_page(i)
-        pagetext = page.get_text().strip()
-        if pagetext:
-            result = result + pagetext
-        if len(doc.get_page_images(i)) > 0:
-            for img in doc.get_page_images(i):
-                if img:
-                    pageimg = ""
-                    xref = img[0]
-                    img_data = doc.extract_image(xref)
-                    img_bytes = img_data["image"]
-                    pil_image = Image.open(io.BytesIO(img_bytes))
-                    img = np.array(pil_image)
-                    img_result = reader.readtext(img, paragraph=True, detail=0)
-                    pageimg = pageimg + ", ".join(img_result).strip()
-                    if pageimg.endswith("!") or pageimg.endswith("?") or pageimg.endswith("."):
-                        pass
-                    else:
-                        pageimg = pageimg + "."
-                result = result + pageimg
-    return result
+# the default checkpoint is specific to the script and the index, so that two ingestions never resume each other
+ingest_checkpoint = os.getenv("INGEST_CHECKPOINT", f".ingest-{INDEX_NAME}.json")
 
 
 def ingest_documents():
@@ -77,22 +42,18 @@ def ingest_documents():
     else:
         # create embeddings using local embedding model
         embedder = HuggingFaceBgeEmbeddings(model_name=EMBED_MODEL)
-
-    # Batch size
-    batch_size = 32
-    num_chunks = len(chunks)
-    for i in range(0, num_chunks, batch_size):
-        batch_chunks = chunks[i : i + batch_size]
-        batch_texts = [f"Company: {company_name}. " + chunk for chunk in batch_chunks]
-
-        _ = Redis.from_texts(
-            texts=batch_texts,
-            embedding=embedder,
-            index_name=INDEX_NAME,
-            index_schema=INDEX_SCHEMA,
-            redis_url=REDIS_URL,
-        )
-        print(f"Processed batch {i//batch_size + 1}/{(num_chunks-1)//batch_size + 1}")
+    # the chunks already embedded by this model are reused
+    embedder = cached_embeddings(embedder, tei_embedding_endpoint or EMBED_MODEL)
+
+    # Embed the next batch while the previous one is written
+    texts = [f"Company: {company_name}. " + chunk for chunk in chunks]
+    loader = RedisBulkLoader(embedder, batch_size=32)
+    # an interrupted ingestion resumes after the last stored batch when run again
+    loader.load(texts, checkpoint=ingest_checkpoint or None)
+    # the answers cached on the previous chunks are out of date
+    invalidate_answers(loader.vectorstore.client, loader.vectorstore.index_name)
+    if hasattr(embedder, "stats"):
+        print("Embedding cache:", embedder.stats())
 
 
 if __name__ == "__main__":
@@ -5,32 +5,149 @@
 
 #
 
+import argparse
+import glob
+import hashlib
+import json
+import os
+import tempfile
+
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_community.document_loaders import DirectoryLoader, TextLoader, UnstructuredFileLoader
+from langchain_community.document_loaders import TextLoader
 from langchain_community.embeddings import HuggingFaceEmbeddings
-from langchain_community.vectorstores import Redis
-from rag_redis.config import EMBED_MODEL, INDEX_NAME, INDEX_SCHEMA, REDIS_URL
-
-loader = DirectoryLoader(
-    "/ws/txt_files", glob="**/*.txt", show_progress=True, use_multithreading=True, loader_cls=TextLoader
-)
-
-text_splitter = RecursiveCharacterTextSplitter(chunk_size=1500, chunk_overlap=100, add_start_index=True)
-
-chunks = loader.load_and_split(text_splitter)
-print("Done preprocessing. Created", len(chunks), "chunks of the original data")
-
-# Create vectorstore
-embedder = HuggingFaceEmbeddings(model_name=EMBED_MODEL)
-
-company_name = "Intel"
-_ = Redis.from_texts(
-    # appending this little bit can sometimes help with semantic retrieval
-    # especially with multiple companies
-    texts=[f"Company: {company_name}. " + chunk.page_content for chunk in chunks],
-    metadatas=[chunk.metadata for chunk in chunks],
-    embedding=embedder,
-    index_name=INDEX_NAME,
-    index_schema=INDEX_SCHEMA,
-    redis_url=REDIS_URL,
-)
+from rag_redis.bulk_loader import RedisBulkLoader
+from rag_redis.config import EMBED_MODEL, INDEX_NAME
+from rag_redis.embedding_cache import cached_embeddings
+from rag_redis.response_cache import invalidate_answers
+
+MANIFEST_VERSION = 1
+
+
+def load_manifest(path):
+    """The files ingested by the previous runs, by path relative to the ingested directory."""
+    try:
+        with open(path, encoding="utf-8") as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return {}
+    if manifest.get("version") != MANIFEST_VERSION or manifest.get("index_name") != INDEX_NAME:
+        print(f"Ignoring the manifest {path}, it was written for another version or index")
+        return {}
+    return manifest["files"]
+
+
+def save_manifest(path, files):
+    # written to a temporary file first, so that an interrupted run never leaves a truncated manifest
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        json.dump({"version": MANIFEST_VERSION, "index_name": INDEX_NAME, "files": files}, f)
+    os.replace(tmp_path, path)
+
+
+def file_hash(path):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def scan(data_dir, manifest, full=False):
+    """Compare the files of `data_dir` with the manifest.
+
+    Returns the new or changed files, as a dict of their relative path to their new manifest
+    entry, and the relative paths of the removed files. A file whose mtime and size did not
+    change is not read, a file whose content hash did not change only has its entry refreshed.
+    With `full`, every file is returned as changed.
+    """
+    changed = {}
+    for path in sorted(glob.glob(os.path.join(data_dir, "**", "*.txt"), recursive=True)):
+        rel_path = os.path.relpath(path, data_dir)
+        stat = os.stat(path)
+        entry = manifest.get(rel_path)
+        if not full and entry and entry["mtime"] == stat.st_mtime and entry["size"] == stat.st_size:
+            continue
+        content_hash = file_hash(path)
+        if not full and entry and entry["sha256"] == content_hash:
+            entry.update(mtime=stat.st_mtime, size=stat.st_size)
+            continue
+        changed[rel_path] = {"mtime": stat.st_mtime, "size": stat.st_size, "sha256": content_hash, "keys": []}
+    removed = [rel_path for rel_path in manifest if not os.path.isfile(os.path.join(data_dir, rel_path))]
+    return changed, removed
+
+
+def ingest_documents(data_dir, manifest_path, full=False, files_per_batch=100):
+    """Ingest the text files of `data_dir` into Redis.
+
+    Only the files that are new or changed since the last run are split and embedded, the
+    chunks of the changed and removed files are deleted, and the manifest is updated after
+    every batch of files. The chunk keys are derived from the path and content of the file,
+    so a run interrupted before the manifest is saved is completed by the next one without
+    duplicating chunks.
+    """
+    manifest = load_manifest(manifest_path)
+    changed, removed = scan(data_dir, manifest, full=full)
+    print(f"{len(changed)} new or changed files, {len(removed)} removed files, {len(manifest)} files in the manifest")
+    if not changed and not removed:
+        save_manifest(manifest_path, manifest)
+        return
+
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=1500, chunk_overlap=100, add_start_index=True)
+    # the unchanged chunks of a changed file are reused from the embedding cache
+    embedder = cached_embeddings(HuggingFaceEmbeddings(model_name=EMBED_MODEL), EMBED_MODEL)
+    loader = RedisBulkLoader(embedder, batch_size=32)
+    key_prefix = loader.vectorstore.key_prefix
+
+    company_name = "Intel"
+    rel_paths = list(changed)
+    for i in range(0, len(rel_paths), files_per_batch):
+        batch = rel_paths[i : i + files_per_batch]
+        texts, metadatas, keys = [], [], []
+        for rel_path in batch:
+            entry = changed[rel_path]
+            documents = TextLoader(os.path.join(data_dir, rel_path)).load()
+            chunks = text_splitter.split_documents(documents)
+            path_hash = hashlib.sha256(rel_path.encode("utf-8")).hexdigest()[:16]
+            entry["keys"] = [f"{key_prefix}:{path_hash}:{entry['sha256'][:16]}:{n}" for n in range(len(chunks))]
+            # appending this little bit can sometimes help with semantic retrieval
+            # especially with multiple companies
+            texts.extend(f"Company: {company_name}. " + chunk.page_content for chunk in chunks)
+            metadatas.extend(chunk.metadata for chunk in chunks)
+            keys.extend(entry["keys"])
+        print(f"Ingesting files {i + 1}-{i + len(batch)}/{len(rel_paths)}, {len(texts)} chunks")
+        loader.load(texts, metadatas, keys)
+        # the new chunks are stored before the chunks of the previous versions are deleted
+        new_keys = set(keys)
+        stale = [key for rel_path in batch for key in manifest.get(rel_path, {}).get("keys", []) if key not in new_keys]
+        if stale:
+            print(f"Deleted {loader.delete(stale)} chunks of the previous versions")
+        manifest.update((rel_path, changed[rel_path]) for rel_path in batch)
+        save_manifest(manifest_path, manifest)
+
+    if removed:
+        stale = [key for rel_path in removed for key in manifest[rel_path]["keys"]]
+        print(f"Deleted {loader.delete(stale)} chunks of {len(removed)} removed files")
+        for rel_path in removed:
+            del manifest[rel_path]
+    save_manifest(manifest_path, manifest)
+    print(f"Manifest {manifest_path} lists {len(manifest)} files")
+    # the answers cached on the previous chunks are out of date
+    invalidate_answers(loader.vectorstore.client, loader.vectorstore.index_name)
+    if hasattr(embedder, "stats"):
+        print("Embedding cache:", embedder.stats())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Incrementally ingest the text files of a directory into Redis")
+    parser.add_argument("--data_dir", type=str, default="/ws/txt_files", help="Directory of the **/*.txt files")
+    parser.add_argument(
+        "--manifest",
+        type=str,
+        default=os.getenv("INGEST_MANIFEST", "/ws/txt_files_manifest.json"),
+        help="Manifest of the ingested files, chunk keys and content hashes",
+    )
+    parser.add_argument("--full", action="store_true", help="Ingest every file, even the unchanged ones")
+    parser.add_argument("--files_per_batch", type=int, default=100, help="Files ingested between manifest updates")
+    args = parser.parse_args()
+    ingest_documents(args.data_dir, args.manifest, full=args.full, files_per_batch=args.files_per_batch)
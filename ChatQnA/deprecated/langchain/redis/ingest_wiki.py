@@ -12,12 +12,16 @@ import numpy as np
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_community.document_loaders import ConfluenceLoader
 from langchain_community.embeddings import HuggingFaceBgeEmbeddings, HuggingFaceEmbeddings, HuggingFaceHubEmbeddings
-from langchain_community.vectorstores import Redis
 
 # from PIL import Image
-from rag_redis.config import EMBED_MODEL, INDEX_NAME, INDEX_SCHEMA, REDIS_URL
+from rag_redis.bulk_loader import RedisBulkLoader
+from rag_redis.config import EMBED_MODEL, INDEX_NAME
+from rag_redis.embedding_cache import cached_embeddings
+from rag_redis.response_cache import invalidate_answers
 
 tei_embedding_endpoint = os.getenv("TEI_ENDPOINT")
+# the default checkpoint is specific to the script and the index, so that two ingestions never resume each other
+ingest_checkpoint = os.getenv("INGEST_CHECKPOINT", f".ingest_wiki-{INDEX_NAME}.json")
 confluence_access_token = os.getenv("CONFLUENCE_ACCESS_TOKEN")
 
 
@@ -56,22 +60,18 @@ def ingest_documents(wiki_url, page_ids):
     else:
         # create embeddings using local embedding model
         embedder = HuggingFaceBgeEmbeddings(model_name=EMBED_MODEL)
-
-    # Batch size
-    batch_size = 2
-    num_chunks = len(chunks)
-    for i in range(0, num_chunks, batch_size):
-        batch_chunks = chunks[i : i + batch_size]
-        batch_texts = [f"Company: {company_name}. " + chunk for chunk in batch_chunks]
-
-        _ = Redis.from_texts(
-            texts=batch_texts,
-            embedding=embedder,
-            index_name=INDEX_NAME,
-            index_schema=INDEX_SCHEMA,
-            redis_url=REDIS_URL,
-        )
-        print(f"Processed batch {i//batch_size + 1}/{(num_chunks-1)//batch_size + 1}")
+    # the chunks already embedded by this model are reused
+    embedder = cached_embeddings(embedder, tei_embedding_endpoint or EMBED_MODEL)
+
+    # Embed the next batch while the previous one is written
+    texts = [f"Company: {company_name}. " + chunk for chunk in chunks]
+    loader = RedisBulkLoader(embedder, batch_size=2)
+    # an interrupted ingestion resumes after the last stored batch when run again
+    loader.load(texts, checkpoint=ingest_checkpoint or None)
+    # the answers cached on the previous chunks are out of date
+    invalidate_answers(loader.vectorstore.client, loader.vectorstore.index_name)
+    if hasattr(embedder, "stats"):
+        print("Embedding cache:", embedder.stats())
 
 
 if __name__ == "__main__":
@@ -0,0 +1,158 @@
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: Apache-2.0
+
+import hashlib
+import json
+import os
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from langchain_community.vectorstores import Redis
+from langchain_community.vectorstores.redis.base import _array_to_buffer, _prepare_metadata
+from rag_redis.config import INDEX_NAME, INDEX_SCHEMA, REDIS_URL
+
+
+def stable_ids(texts: list):
+    """Ids derived from the position and content of every text, identical when the same texts are loaded again."""
+    return [
+        str(uuid.uuid5(uuid.NAMESPACE_OID, f"{i}:{hashlib.sha256(text.encode('utf-8')).hexdigest()}"))
+        for i, text in enumerate(texts)
+    ]
+
+
+def _read_checkpoint(path: str, fingerprint: str):
+    """The number of texts already stored by an interrupted load of the same texts."""
+    try:
+        with open(path, encoding="utf-8") as f:
+            checkpoint = json.load(f)
+    except FileNotFoundError:
+        return 0
+    if checkpoint.get("fingerprint") != fingerprint:
+        print(f"Ignoring the checkpoint {path}, it was written for other texts")
+        return 0
+    return checkpoint["committed"]
+
+
+def _write_checkpoint(path: str, fingerprint: str, committed: int):
+    # written to a temporary file first, so that an interrupted load never leaves a truncated checkpoint
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        json.dump({"fingerprint": fingerprint, "committed": committed}, f)
+    os.replace(tmp_path, path)
+
+
+class RedisBulkLoader:
+    """Load large numbers of texts into a Redis vector index.
+
+    Texts are embedded in batches of `batch_size`, and every batch is written with a single
+    pipelined round trip while the next batch is being embedded. The Redis client (and its
+    connection pool) is created once, and the index is created once, if it does not exist,
+    before the first write.
+    """
+
+    def __init__(
+        self,
+        embedding,
+        index_name: str = INDEX_NAME,
+        index_schema=INDEX_SCHEMA,
+        redis_url: str = REDIS_URL,
+        batch_size: int = 32,
+        key_prefix: str = None,
+    ):
+        self.embedding = embedding
+        self.batch_size = batch_size
+        self.vectorstore = Redis(redis_url, index_name, embedding, index_schema=index_schema, key_prefix=key_prefix)
+        self._index_ready = False
+
+    def _ensure_index(self, dim: int):
+        if not self._index_ready:
+            self.vectorstore._create_index_if_not_exist(dim=dim)
+            self._index_ready = True
+
+    def _write(self, texts, metadatas, embeddings, keys):
+        schema = self.vectorstore._schema
+        pipeline = self.vectorstore.client.pipeline(transaction=False)
+        for text, metadata, embedding, key in zip(texts, metadatas, embeddings, keys):
+            pipeline.hset(
+                key,
+                mapping={
+                    schema.content_key: text,
+                    schema.content_vector_key: _array_to_buffer(embedding, schema.vector_dtype),
+                    **_prepare_metadata(metadata),
+                },
+            )
+        pipeline.execute()
+
+    def load(self, texts: list, metadatas: list = None, keys: list = None, checkpoint: str = None):
+        """Embed and store `texts`, returns their keys.
+
+        With a `checkpoint` file, the number of stored texts is recorded after every batch, and
+        a load of the same texts that was interrupted resumes after its last stored batch. The
+        keys default to `stable_ids(texts)` then, so that a batch stored again is overwritten
+        instead of duplicated. The checkpoint is removed once all the texts are stored.
+        """
+        texts = list(texts)
+        metadatas = metadatas or [{} for _ in texts]
+        assert len(metadatas) == len(texts), "Number of metadatas must match number of texts"
+        if keys is None:
+            keys = stable_ids(texts) if checkpoint else [uuid.uuid4().hex for _ in texts]
+        prefix = self.vectorstore.key_prefix + ":"
+        keys = [key if key.startswith(prefix) else prefix + key for key in keys]
+
+        committed = 0
+        if checkpoint:
+            fingerprint = hashlib.sha256("\n".join(keys).encode("utf-8")).hexdigest()
+            committed = _read_checkpoint(checkpoint, fingerprint)
+            if committed:
+                print(f"Resuming from {checkpoint}, {committed}/{len(texts)} chunks already stored")
+
+        def write(*args, end):
+            self._write(*args)
+            if checkpoint:
+                _write_checkpoint(checkpoint, fingerprint, end)
+
+        num_batches = (len(texts) - 1) // self.batch_size + 1 if texts else 0
+        start = time.perf_counter()
+        # a single writer, so that at most one batch is written while the next one is embedded
+        with ThreadPoolExecutor(max_workers=1) as writer:
+            pending = None
+            for batch, i in enumerate(range(0, len(texts), self.batch_size)):
+                if i + self.batch_size <= committed:
+                    continue
+                batch_texts = texts[i : i + self.batch_size]
+                embeddings = self.embedding.embed_documents(batch_texts)
+                self._ensure_index(len(embeddings[0]))
+                if pending is not None:
+                    pending.result()
+                pending = writer.submit(
+                    write,
+                    batch_texts,
+                    metadatas[i : i + self.batch_size],
+                    embeddings,
+                    keys[i : i + self.batch_size],
+                    end=i + len(batch_texts),
+                )
+                elapsed = time.perf_counter() - start
+                loaded = i + len(batch_texts) - committed
+                print(f"Processed batch {batch + 1}/{num_batches}, {loaded / elapsed:.1f} chunks/s")
+            if pending is not None:
+                pending.result()
+        if checkpoint and os.path.exists(checkpoint):
+            os.remove(checkpoint)
+        elapsed = time.perf_counter() - start
+        print(f"Loaded {len(texts)} chunks into {self.vectorstore.index_name} in {elapsed:.1f}s")
+        if elapsed > 0:
+            print(f"Throughput: {(len(texts) - committed) / elapsed:.1f} chunks/s")
+        return keys
+
+    def delete(self, keys: list):
+        """Delete the chunks stored under `keys`, returns the number of deleted chunks."""
+        deleted = 0
+        for i in range(0, len(keys), self.batch_size):
+            pipeline = self.vectorstore.client.pipeline(transaction=False)
+            for key in keys[i : i + self.batch_size]:
+                pipeline.delete(key)
+            deleted += sum(pipeline.execute())
+        return deleted
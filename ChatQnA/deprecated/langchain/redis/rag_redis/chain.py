@@ -12,7 +12,19 @@ from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.pydantic_v1 import BaseModel
 from langchain_core.runnables import RunnableParallel, RunnablePassthrough
-from rag_redis.config import EMBED_MODEL, INDEX_NAME, INDEX_SCHEMA, REDIS_URL, TGI_LLM_ENDPOINT
+from rag_redis.config import (
+    EMBED_MODEL,
+    INDEX_NAME,
+    INDEX_SCHEMA,
+    LLM_CACHE,
+    REDIS_URL,
+    RETRIEVAL_CACHE_SIZE,
+    TGI_LLM_ENDPOINT,
+)
+from rag_redis.embedding_cache import cached_embeddings
+from rag_redis.mmr import MMRRetriever
+from rag_redis.response_cache import SemanticResponseCache
+from rag_redis.retrieval_cache import RetrievalCache
 
 
 # Make this look better in the docs.
@@ -20,14 +32,8 @@ class Question(BaseModel):
     __root__: str
 
 
-# Init Embeddings
-embedder = HuggingFaceEmbeddings(model_name=EMBED_MODEL)
-
-# Setup semantic cache for LLM
-from langchain.cache import RedisSemanticCache
-from langchain.globals import set_llm_cache
-
-set_llm_cache(RedisSemanticCache(embedding=embedder, redis_url=REDIS_URL))
+# Init Embeddings, repeated queries are embedded once
+embedder = cached_embeddings(HuggingFaceEmbeddings(model_name=EMBED_MODEL), EMBED_MODEL)
 
 # Connect to pre-loaded vectorstore
 # run the ingest.py script to populate this
@@ -35,8 +41,10 @@ vectorstore = Redis.from_existing_index(
     embedding=embedder, index_name=INDEX_NAME, schema=INDEX_SCHEMA, redis_url=REDIS_URL
 )
 
-# TODO allow user to change parameters
-retriever = vectorstore.as_retriever(search_type="mmr")
+# k, fetch_k and lambda_mult can be changed per request in the config, the chunks retrieved for
+# the repeated queries are read by key until the index is ingested again, see `RetrievalCache`
+retrieval_cache = RetrievalCache(vectorstore.client) if RETRIEVAL_CACHE_SIZE > 0 else None
+retriever = MMRRetriever(vectorstore=vectorstore, cache=retrieval_cache).configurable()
 
 # Define our prompt
 template = """
@@ -71,6 +79,13 @@ model = HuggingFaceEndpoint(
     truncate=1024,
 )
 
-chain = (
-    RunnableParallel({"context": retriever, "question": RunnablePassthrough()}) | prompt | model | StrOutputParser()
-).with_types(input_type=Question)
+chain = RunnableParallel({"context": retriever, "question": RunnablePassthrough()}) | prompt | model | StrOutputParser()
+
+# Answer the questions already asked, or close enough, from the cache, see `SemanticResponseCache`
+if LLM_CACHE:
+    import redis
+
+    response_cache = SemanticResponseCache(embedder, redis.Redis.from_url(REDIS_URL))
+    chain = response_cache.cached(chain, INDEX_NAME)
+
+chain = chain.with_types(input_type=Question)
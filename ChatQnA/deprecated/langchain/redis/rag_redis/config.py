@@ -86,3 +86,29 @@ schema_path = os.path.join(parent_dir, REDIS_SCHEMA)
 INDEX_SCHEMA = schema_path
 TGI_LLM_ENDPOINT = os.getenv("TGI_LLM_ENDPOINT", "http://localhost:8080")
 TGI_LLM_ENDPOINT_NO_RAG = os.getenv("TGI_LLM_ENDPOINT_NO_RAG", "http://localhost:8081")
+
+# MMR retrieval: number of returned chunks, number of candidates fetched from the vector store,
+# and trade-off between relevance (1) and diversity (0), also set per request in the config.
+MMR_K = int(os.getenv("MMR_K", 4))
+MMR_FETCH_K = int(os.getenv("MMR_FETCH_K", 20))
+MMR_LAMBDA_MULT = float(os.getenv("MMR_LAMBDA_MULT", 0.5))
+
+# Embeddings of the queries and chunks are cached by model id and normalized text: the last
+# EMBEDDING_CACHE_SIZE in process (0 disables), and with EMBEDDING_CACHE_REDIS in Redis for
+# EMBEDDING_CACHE_TTL seconds, shared by all the processes using the same Redis.
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", 10000))
+EMBEDDING_CACHE_REDIS = get_boolean_env_var("EMBEDDING_CACHE_REDIS", False)
+EMBEDDING_CACHE_TTL = int(os.getenv("EMBEDDING_CACHE_TTL", 7 * 86400))
+
+# Answers of the chain are cached per index, disabled with LLM_CACHE=false: a question whose embedding
+# has a cosine similarity of at least LLM_CACHE_THRESHOLD with a cached question gets its answer. The
+# last LLM_CACHE_L1_SIZE answers are kept in process, and all of them in Redis for LLM_CACHE_TTL seconds.
+LLM_CACHE = get_boolean_env_var("LLM_CACHE", True)
+LLM_CACHE_THRESHOLD = float(os.getenv("LLM_CACHE_THRESHOLD", 0.95))
+LLM_CACHE_L1_SIZE = int(os.getenv("LLM_CACHE_L1_SIZE", 1000))
+LLM_CACHE_TTL = int(os.getenv("LLM_CACHE_TTL", 3600))
+
+# The chunks retrieved for the last RETRIEVAL_CACHE_SIZE queries are cached in process (0 disables it),
+# for at most RETRIEVAL_CACHE_TTL seconds, and until the index is ingested again.
+RETRIEVAL_CACHE_SIZE = int(os.getenv("RETRIEVAL_CACHE_SIZE", 10000))
+RETRIEVAL_CACHE_TTL = float(os.getenv("RETRIEVAL_CACHE_TTL", 3600))
@@ -0,0 +1,147 @@
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: Apache-2.0
+
+import hashlib
+import threading
+import unicodedata
+from collections import Counter, OrderedDict
+from typing import List
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from rag_redis.config import EMBEDDING_CACHE_REDIS, EMBEDDING_CACHE_SIZE, EMBEDDING_CACHE_TTL, REDIS_URL
+
+
+def normalize_text(text: str):
+    """The form of a text used for its key: NFC, whitespace runs collapsed, surrounding spaces stripped."""
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+class EmbeddingCache:
+    """Two-tier cache of embeddings: an in-process LRU, then an optional Redis shared by all processes.
+
+    The vectors are keyed by the hash of the model id, of the kind of text (query or document,
+    which some models embed differently) and of the normalized text. A vector found in Redis is
+    copied to the LRU, and a computed vector is stored in both tiers, in Redis as float32 bytes
+    expiring after `ttl` seconds. Redis errors are reported and the lookups count as misses.
+    """
+
+    def __init__(self, model_id: str, maxsize: int = 10000, redis_client=None, ttl: int = 7 * 86400):
+        self.model_id = model_id
+        self.maxsize = maxsize
+        self.redis = redis_client
+        self.ttl = ttl
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = Counter()
+
+    def key(self, text: str, kind: str):
+        digest = hashlib.sha256(f"{self.model_id}\x00{kind}\x00{normalize_text(text)}".encode("utf-8")).hexdigest()
+        return f"embedding:{digest}"
+
+    def _put_lru(self, items):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            for key, vector in items:
+                self._lru[key] = vector
+                self._lru.move_to_end(key)
+            while len(self._lru) > self.maxsize:
+                self._lru.popitem(last=False)
+
+    def get_many(self, keys: List[str]):
+        """Return a dict of the cached vectors of the distinct `keys`, the missing keys are left out."""
+        found = {}
+        with self._lock:
+            for key in keys:
+                vector = self._lru.get(key)
+                if vector is not None:
+                    self._lru.move_to_end(key)
+                    found[key] = vector
+        lru_hits = len(found)
+        missing = [key for key in keys if key not in found]
+        if missing and self.redis is not None:
+            try:
+                values = self.redis.mget(missing)
+            except Exception as e:
+                print(f"[rag - embedding cache] Redis lookup failed: {e}")
+                values = []
+            from_redis = {key: np.frombuffer(value, dtype=np.float32) for key, value in zip(missing, values) if value}
+            self._put_lru(from_redis.items())
+            found.update(from_redis)
+        with self._lock:
+            self._stats.update(lookups=len(keys), lru_hits=lru_hits, redis_hits=len(found) - lru_hits)
+        return {key: vector.tolist() for key, vector in found.items()}
+
+    def put_many(self, items):
+        items = [(key, np.asarray(vector, dtype=np.float32)) for key, vector in items]
+        self._put_lru(items)
+        if self.redis is not None and items:
+            try:
+                pipeline = self.redis.pipeline(transaction=False)
+                for key, vector in items:
+                    pipeline.set(key, vector.tobytes(), ex=self.ttl or None)
+                pipeline.execute()
+            except Exception as e:
+                print(f"[rag - embedding cache] Redis store failed: {e}")
+
+    def stats(self):
+        """The number of lookups, of hits in every tier, and the hit rate since the cache was created."""
+        with self._lock:
+            stats = dict(self._stats, size=len(self._lru))
+        lookups = stats.get("lookups", 0)
+        hits = stats.get("lru_hits", 0) + stats.get("redis_hits", 0)
+        return {
+            "lookups": lookups,
+            "lru_hits": stats.get("lru_hits", 0),
+            "redis_hits": stats.get("redis_hits", 0),
+            "misses": lookups - hits,
+            "hit_rate": hits / lookups if lookups else 0.0,
+            "size": stats["size"],
+        }
+
+
+class CachedEmbeddings(Embeddings):
+    """Embeddings that only compute the texts missing from an `EmbeddingCache`.
+
+    Repeated texts of a batch are embedded once, and queries and documents are cached apart.
+    """
+
+    def __init__(self, embeddings: Embeddings, cache: EmbeddingCache):
+        self.embeddings = embeddings
+        self.cache = cache
+
+    def _embed(self, texts: List[str], kind: str, embed):
+        keys = [self.cache.key(text, kind) for text in texts]
+        vectors = self.cache.get_many(list(dict.fromkeys(keys)))
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in vectors:
+                missing.setdefault(key, text)
+        if missing:
+            new_vectors = dict(zip(missing, embed(list(missing.values()))))
+            self.cache.put_many(new_vectors.items())
+            vectors.update(new_vectors)
+        return [vectors[key] for key in keys]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._embed(texts, "document", self.embeddings.embed_documents)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed([text], "query", lambda texts: [self.embeddings.embed_query(texts[0])])[0]
+
+    def stats(self):
+        return self.cache.stats()
+
+
+def cached_embeddings(embeddings: Embeddings, model_id: str):
+    """Wrap `embeddings` with the cache set by EMBEDDING_CACHE_SIZE and EMBEDDING_CACHE_REDIS, if any."""
+    if EMBEDDING_CACHE_SIZE <= 0 and not EMBEDDING_CACHE_REDIS:
+        return embeddings
+    redis_client = None
+    if EMBEDDING_CACHE_REDIS:
+        import redis
+
+        redis_client = redis.Redis.from_url(REDIS_URL)
+    cache = EmbeddingCache(model_id, EMBEDDING_CACHE_SIZE, redis_client, EMBEDDING_CACHE_TTL)
+    return CachedEmbeddings(embeddings, cache)
@@ -0,0 +1,136 @@
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: Apache-2.0
+
+from typing import Any, List, Optional
+
+import numpy as np
+from langchain_community.vectorstores import Redis
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.runnables import ConfigurableField
+from rag_redis.config import MMR_FETCH_K, MMR_K, MMR_LAMBDA_MULT
+
+
+def maximal_marginal_relevance(query_embedding, embeddings, k: int = 4, lambda_mult: float = 0.5) -> List[int]:
+    """The indices of the `k` embeddings selected by maximal marginal relevance, in order of selection.
+
+    Selects the same embeddings as `langchain_community.vectorstores.utils.maximal_marginal_relevance`,
+    but the similarities are computed with one matrix product per selected embedding, and the
+    redundancy of every candidate is updated incrementally instead of recomputed at every step.
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    k = min(k, len(embeddings))
+    if k <= 0:
+        return []
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    embeddings = embeddings / np.where(norms == 0, 1, norms)
+    query = np.asarray(query_embedding, dtype=np.float32).reshape(-1)
+    query = query / (np.linalg.norm(query) or 1)
+    similarity = embeddings @ query
+    relevance = lambda_mult * similarity
+    selected = [int(np.argmax(similarity))]
+    # the highest similarity of every candidate to the selected embeddings
+    redundancy = embeddings @ embeddings[selected[0]]
+    available = np.ones(len(embeddings), dtype=bool)
+    available[selected[0]] = False
+    while len(selected) < k:
+        scores = np.where(available, relevance - (1 - lambda_mult) * redundancy, -np.inf)
+        best = int(np.argmax(scores))
+        selected.append(best)
+        available[best] = False
+        np.maximum(redundancy, embeddings @ embeddings[best], out=redundancy)
+    return selected
+
+
+def search_with_vectors(vectorstore: Redis, embedding: List[float], k: int):
+    """The `k` chunks closest to `embedding` with their vectors, read back in a single pipelined round trip."""
+    documents = vectorstore.similarity_search_by_vector(embedding, k=k, return_metadata=True)
+    schema = vectorstore._schema
+    pipeline = vectorstore.client.pipeline(transaction=False)
+    for doc in documents:
+        pipeline.hget(doc.metadata["id"], schema.content_vector_key)
+    vectors = [np.frombuffer(vector, dtype=schema.vector_dtype) for vector in pipeline.execute()]
+    return documents, vectors
+
+
+def _decode(value):
+    return value.decode("utf-8") if isinstance(value, bytes) else value
+
+
+def documents_by_keys(vectorstore: Redis, keys: List[str]):
+    """The chunks stored at `keys`, read in a single pipelined round trip, None for the keys that are gone."""
+    schema = vectorstore._schema
+    pipeline = vectorstore.client.pipeline(transaction=False)
+    for key in keys:
+        pipeline.hgetall(key)
+    documents = []
+    for key, fields in zip(keys, pipeline.execute()):
+        fields = {_decode(name): value for name, value in fields.items()}
+        if schema.content_key not in fields:
+            documents.append(None)
+            continue
+        metadata = {
+            name: _decode(value)
+            for name, value in fields.items()
+            if name not in (schema.content_key, schema.content_vector_key)
+        }
+        metadata["id"] = key
+        documents.append(Document(page_content=_decode(fields[schema.content_key]), metadata=metadata))
+    return documents
+
+
+class MMRRetriever(BaseRetriever):
+    """Retrieve chunks by maximal marginal relevance among the `fetch_k` chunks closest to the query.
+
+    The candidates are fetched with their vectors in a single request to the vector store, and
+    the selection runs in process with `maximal_marginal_relevance`. With a `cache`, the keys of
+    the retrieved chunks are cached, and the chunks of a repeated query are read by key.
+    """
+
+    vectorstore: Redis
+    k: int = MMR_K
+    fetch_k: int = MMR_FETCH_K
+    lambda_mult: float = MMR_LAMBDA_MULT
+    # a `RetrievalCache` of the results
+    cache: Optional[Any] = None
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def _search(self, query: str):
+        """The retrieved chunks with their cosine similarity to the query."""
+        embedding = self.vectorstore.embeddings.embed_query(query)
+        documents, vectors = search_with_vectors(self.vectorstore, embedding, max(self.fetch_k, self.k))
+        selected = maximal_marginal_relevance(embedding, vectors, self.k, self.lambda_mult)
+        if not selected:
+            return []
+        vectors = np.asarray([vectors[i] for i in selected], dtype=np.float32)
+        query = np.asarray(embedding, dtype=np.float32)
+        scores = vectors @ query / np.maximum(np.linalg.norm(vectors, axis=1) * np.linalg.norm(query), 1e-12)
+        return [(documents[i], float(score)) for i, score in zip(selected, scores)]
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        key = None
+        if self.cache is not None:
+            key = self.cache.key(self.vectorstore.index_name, query, (self.k, self.fetch_k, self.lambda_mult))
+        results = self.cache.get(key) if key is not None else None
+        if results is not None:
+            documents = documents_by_keys(self.vectorstore, [i for i, _ in results])
+            if all(doc is not None for doc in documents):
+                return documents
+            self.cache.discard(key)
+        results = self._search(query)
+        if key is not None:
+            self.cache.put(key, [(doc.metadata["id"], score) for doc, score in results])
+        return [doc for doc, _ in results]
+
+    def configurable(self):
+        """The retriever with its parameters set per request by the `k`, `fetch_k` and `lambda_mult` config keys."""
+        return self.configurable_fields(
+            k=ConfigurableField(id="k", name="k", description="Number of retrieved chunks"),
+            fetch_k=ConfigurableField(id="fetch_k", name="fetch_k", description="Number of MMR candidates"),
+            lambda_mult=ConfigurableField(
+                id="lambda_mult", name="lambda_mult", description="Relevance (1) to diversity (0) trade-off"
+            ),
+        )
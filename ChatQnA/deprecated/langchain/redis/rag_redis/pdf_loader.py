@@ -0,0 +1,210 @@
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: Apache-2.0
+
+import hashlib
+import io
+import os
+import tempfile
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+from PIL import Image
+
+# each worker that meets an image loads its own copy of the OCR model, so the default stays small
+PDF_LOADER_WORKERS = int(os.getenv("PDF_LOADER_WORKERS", min(4, os.cpu_count() or 1)))
+# OCR results are cached by image content in this directory, set it to an empty string to disable the cache
+OCR_CACHE_DIR = os.getenv("OCR_CACHE_DIR", ".ocr_cache")
+# images smaller than this on either side, or with a lower entropy (in bits), are not OCR'd
+OCR_MIN_IMAGE_SIZE = int(os.getenv("OCR_MIN_IMAGE_SIZE", 32))
+OCR_MIN_ENTROPY = float(os.getenv("OCR_MIN_ENTROPY", 0.5))
+OCR_LANGUAGES = ["en"]
+
+# state of a worker process, the document is opened once and the OCR model loaded on the first image to read
+_doc = None
+_reader = None
+_cache = None
+_first_page = None
+_stats = Counter()
+
+
+def _import_fitz():
+    try:
+        import fitz
+    except ImportError:
+        raise ImportError("`PyMuPDF` package is not found, please install it with `pip install pymupdf`.")
+    return fitz
+
+
+def _import_easyocr():
+    try:
+        import easyocr
+    except ImportError:
+        raise ImportError("`easyocr` package is not found, please install it with `pip install easyocr`.")
+    return easyocr
+
+
+class OCRCache:
+    """Persistent OCR results keyed by the hash of the image content, one file per image."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: str):
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key: str):
+        try:
+            with open(self._path(key), encoding="utf-8") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, key: str, text: str):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # written to a temporary file first, so that concurrent workers never read a partial result
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+
+
+def _init_worker(file_path, num_threads=None, cache_dir=None):
+    global _doc, _reader, _cache, _first_page
+    _doc = _import_fitz().open(file_path)
+    _reader = None
+    _cache = OCRCache(cache_dir) if cache_dir else None
+    _stats.clear()
+    # an image used on several pages, such as a logo, is only read on the first one
+    _first_page = {}
+    for i in range(_doc.page_count):
+        for img in _doc.get_page_images(i):
+            _first_page.setdefault(img[0], i)
+    if num_threads:
+        try:
+            import torch
+
+            # the workers share the cores, keep torch from oversubscribing them
+            torch.set_num_threads(num_threads)
+        except ImportError:
+            pass
+
+
+def _get_reader():
+    global _reader
+    if _reader is None:
+        _reader = _import_easyocr().Reader(OCR_LANGUAGES)
+    return _reader
+
+
+def _worth_reading(pil_image):
+    """Cheap triage of the images that cannot hold readable text, such as blank areas and rules."""
+    thumbnail = pil_image.convert("L")
+    thumbnail.thumbnail((256, 256))
+    if thumbnail.entropy() < OCR_MIN_ENTROPY:
+        _stats["skipped_low_entropy"] += 1
+        return False
+    return True
+
+
+def _ocr_image(xref):
+    img_data = _doc.extract_image(xref)
+    if min(img_data["width"], img_data["height"]) < OCR_MIN_IMAGE_SIZE:
+        # icons and decorations
+        _stats["skipped_small"] += 1
+        return ""
+    img_bytes = img_data["image"]
+    key = hashlib.sha256(",".join(OCR_LANGUAGES).encode() + b":" + img_bytes).hexdigest()
+    text = _cache.get(key) if _cache else None
+    if text is not None:
+        _stats["cache_hits"] += 1
+    else:
+        pil_image = Image.open(io.BytesIO(img_bytes))
+        if not _worth_reading(pil_image):
+            return ""
+        img_result = _get_reader().readtext(np.array(pil_image), paragraph=True, detail=0)
+        text = ", ".join(img_result).strip()
+        _stats["ocr"] += 1
+        if _cache:
+            _cache.put(key, text)
+    if not (text.endswith("!") or text.endswith("?") or text.endswith(".")):
+        text = text + "."
+    return text
+
+
+def _parse_page(i):
+    parts = []
+    pagetext = _doc.load_page(i).get_text().strip()
+    if pagetext:
+        parts.append(pagetext)
+    for img in _doc.get_page_images(i):
+        if not img:
+            continue
+        if _first_page.get(img[0]) != i:
+            _stats["duplicate_xrefs"] += 1
+            continue
+        # a page listing the same image twice only reads it once
+        _first_page[img[0]] = None
+        parts.append(_ocr_image(img[0]))
+    return "".join(parts)
+
+
+def _parse_pages(start, end):
+    _stats.clear()
+    return start, [_parse_page(i) for i in range(start, end)], Counter(_stats)
+
+
+def pdf_loader(file_path, workers: int = None, pages_per_task: int = None, cache_dir: str = OCR_CACHE_DIR):
+    """Extract the text of a PDF, with the text recognized in its images.
+
+    Pages are parsed in parallel by `workers` processes (`PDF_LOADER_WORKERS`, by default up to
+    4), each one opening the document once. The OCR model is only loaded by the workers that
+    meet an image to read, so text-only documents never load it. Pages are sent to the workers
+    in ranges of `pages_per_task` pages and joined back in page order.
+
+    The images repeated in the document are read once, tiny or nearly uniform images are
+    skipped, and the OCR results are cached in `cache_dir` by image content, so re-ingesting a
+    document does not run the OCR model again.
+    """
+    with _import_fitz().open(file_path) as doc:
+        page_count = doc.page_count
+    workers = max(1, min(workers or PDF_LOADER_WORKERS, page_count))
+    pages_per_task = pages_per_task or max(1, min(16, page_count // (workers * 4)))
+    tasks = [(start, min(start + pages_per_task, page_count)) for start in range(0, page_count, pages_per_task)]
+    print(f"Parsing {page_count} pages of {file_path} with {workers} workers")
+
+    pages = [None] * page_count
+    stats = Counter()
+    done = 0
+    start_time = time.perf_counter()
+
+    def report(start, results, task_stats):
+        nonlocal done
+        pages[start : start + len(results)] = results
+        stats.update(task_stats)
+        done += len(results)
+        elapsed = time.perf_counter() - start_time
+        print(f"Parsed {done}/{page_count} pages, {done / elapsed:.1f} pages/s")
+
+    if workers == 1:
+        _init_worker(file_path, cache_dir=cache_dir)
+        try:
+            for task in tasks:
+                report(*_parse_pages(*task))
+        finally:
+            _doc.close()
+    else:
+        num_threads = max(1, (os.cpu_count() or 1) // workers)
+        initargs = (file_path, num_threads, cache_dir)
+        with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=initargs) as executor:
+            futures = [executor.submit(_parse_pages, *task) for task in tasks]
+            for future in as_completed(futures):
+                report(*future.result())
+    print(
+        f"Images: {stats['ocr']} read, {stats['cache_hits']} from the OCR cache, {stats['duplicate_xrefs']} repeated, "
+        f"{stats['skipped_small'] + stats['skipped_low_entropy']} skipped as too small or uniform"
+    )
+    return "".join(pages)
@@ -0,0 +1,252 @@
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: Apache-2.0
+
+import asyncio
+import hashlib
+import threading
+import time
+from collections import Counter, OrderedDict, namedtuple
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_core.runnables import Runnable, RunnableGenerator, RunnableLambda
+from rag_redis.config import LLM_CACHE_L1_SIZE, LLM_CACHE_THRESHOLD, LLM_CACHE_TTL
+from rag_redis.embedding_cache import normalize_text
+
+# The generation of an index is read from Redis at most every GENERATION_REFRESH seconds, which bounds
+# the time a process keeps answering from the L1 entries, or retrieving from the cached results, of an
+# index that was ingested again.
+GENERATION_REFRESH = 1.0
+
+_Entry = namedtuple("_Entry", ["answer", "slot", "expires_at"])
+
+
+def _decode(value):
+    return value.decode("utf-8") if isinstance(value, bytes) else value
+
+
+def generation_key(index_name: str):
+    return f"llm-cache:generation:{index_name}"
+
+
+def invalidate_answers(redis_client, index_name: str):
+    """Invalidate the cached answers and retrieval results on `index_name` in every process, once its chunks changed."""
+    generation = redis_client.incr(generation_key(index_name))
+    print(f"Cached answers and retrieval results on {index_name} invalidated, generation {generation}")
+    return generation
+
+
+class SemanticResponseCache:
+    """Answers cached per index and looked up by question, in process first, then in Redis.
+
+    The L1 tier keeps the last `l1_size` answers. A question is first looked up by its normalized
+    text, without embedding it, then by the cosine similarity of its embedding with the L1
+    questions on the same index, computed with a single matrix product. The L2 tier is a Redis
+    search index of the answers, queried by KNN among the answers on the same index, whose entries
+    expire after `ttl` seconds. A cached answer is returned if its question has a similarity of at
+    least `threshold`. The entries are scoped by index and by the generation of the index, so
+    `invalidate_answers` makes the previous answers unreachable from every process.
+    """
+
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        redis_client,
+        threshold: float = LLM_CACHE_THRESHOLD,
+        l1_size: int = LLM_CACHE_L1_SIZE,
+        ttl: int = LLM_CACHE_TTL,
+    ):
+        assert l1_size > 0, "l1_size should be positive"
+        self.embeddings = embeddings
+        self.redis = redis_client
+        self.threshold = threshold
+        self.l1_size = l1_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # (scope, normalized question) -> _Entry, least recently used first
+        self._entries = OrderedDict()
+        # the normalized question embeddings of the L1 entries, by slot
+        self._vectors = None
+        self._slot_keys = [None] * l1_size
+        self._slot_scopes = np.full(l1_size, None, dtype=object)
+        self._free_slots = list(range(l1_size))
+        self._scopes = {}
+        self._l2_index = None
+        self._stats = Counter()
+
+    def _scope(self, index_name: str):
+        """The tag of the entries on the current generation of `index_name`."""
+        now = time.monotonic()
+        with self._lock:
+            cached = self._scopes.get(index_name)
+        if cached is not None and now - cached[1] < GENERATION_REFRESH:
+            return cached[0]
+        generation = int(self.redis.get(generation_key(index_name)) or 0)
+        scope = hashlib.sha1(f"{index_name}\x00{generation}".encode("utf-8")).hexdigest()
+        with self._lock:
+            if cached is not None and cached[0] != scope:
+                for key in [key for key in self._entries if key[0] == cached[0]]:
+                    self._l1_remove(key)
+            self._scopes[index_name] = (scope, now)
+        return scope
+
+    def _embed(self, question: str):
+        vector = np.asarray(self.embeddings.embed_query(question), dtype=np.float32)
+        return vector / (np.linalg.norm(vector) or 1)
+
+    def _l1_remove(self, key):
+        entry = self._entries.pop(key)
+        self._slot_keys[entry.slot] = None
+        self._slot_scopes[entry.slot] = None
+        self._free_slots.append(entry.slot)
+
+    def _l1_put(self, key, vector, answer: str):
+        with self._lock:
+            if key in self._entries:
+                self._l1_remove(key)
+            while len(self._entries) >= self.l1_size:
+                self._l1_remove(next(iter(self._entries)))
+            if self._vectors is None or self._vectors.shape[1] != len(vector):
+                self._vectors = np.zeros((self.l1_size, len(vector)), dtype=np.float32)
+            slot = self._free_slots.pop()
+            self._vectors[slot] = vector
+            self._slot_keys[slot] = key
+            self._slot_scopes[slot] = key[0]
+            self._entries[key] = _Entry(answer, slot, time.monotonic() + self.ttl)
+
+    def _l1_get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry.expires_at < time.monotonic():
+            self._l1_remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry.answer
+
+    def _l1_similar(self, scope: str, vector):
+        with self._lock:
+            if self._vectors is None or self._vectors.shape[1] != len(vector):
+                return None
+            mask = self._slot_scopes == scope
+            if not mask.any():
+                return None
+            scores = np.where(mask, self._vectors @ vector, -np.inf)
+            slot = int(np.argmax(scores))
+            if scores[slot] < self.threshold:
+                return None
+            return self._l1_get(self._slot_keys[slot])
+
+    def _l2_index_name(self, dim: int):
+        if self._l2_index is None:
+            import redis
+
+            index = f"llm-cache-{dim}"
+            create = f"FT.CREATE {index} ON HASH PREFIX 1 {index}: SCHEMA scope TAG vector VECTOR FLAT 6 TYPE FLOAT32"
+            try:
+                self.redis.execute_command(*create.split(), "DIM", dim, "DISTANCE_METRIC", "COSINE")
+            except redis.ResponseError as e:
+                if "exists" not in str(e).lower():
+                    raise
+            self._l2_index = index
+        return self._l2_index
+
+    def _l2_get(self, scope: str, vector):
+        query = f"(@scope:{{{scope}}})=>[KNN 1 @vector $vector AS distance]"
+        index = self._l2_index_name(len(vector))
+        parameters = ["PARAMS", 2, "vector", vector.tobytes(), "RETURN", 2, "distance", "answer", "DIALECT", 2]
+        result = self.redis.execute_command("FT.SEARCH", index, query, *parameters)
+        # the total, then the key and the fields of every document
+        if not result or result[0] == 0:
+            return None
+        fields = {_decode(name): value for name, value in zip(result[2][::2], result[2][1::2])}
+        # the cosine distance of Redis is 1 - the cosine similarity
+        if 1 - float(fields["distance"]) < self.threshold:
+            return None
+        return _decode(fields["answer"])
+
+    def _l2_put(self, scope: str, question: str, vector, answer: str):
+        index = self._l2_index_name(len(vector))
+        key = f"{index}:{hashlib.sha1(f'{scope}:{question}'.encode('utf-8')).hexdigest()}"
+        pipeline = self.redis.pipeline(transaction=False)
+        pipeline.hset(key, mapping={"scope": scope, "vector": vector.tobytes(), "question": question, "answer": answer})
+        pipeline.expire(key, self.ttl)
+        pipeline.execute()
+
+    def lookup(self, index_name: str, question: str):
+        """The cached answer to `question` on `index_name`, None on a miss."""
+        question = normalize_text(question)
+        try:
+            scope = self._scope(index_name)
+        except Exception as e:
+            print(f"[rag - llm cache] lookup failed: {e}")
+            return None
+        key = (scope, question)
+        with self._lock:
+            answer = self._l1_get(key)
+        tier = "l1_exact_hits"
+        if answer is None:
+            vector = self._embed(question)
+            answer = self._l1_similar(scope, vector)
+            tier = "l1_semantic_hits"
+            if answer is None:
+                try:
+                    answer = self._l2_get(scope, vector)
+                except Exception as e:
+                    print(f"[rag - llm cache] L2 lookup failed: {e}")
+                tier = "l2_hits"
+            if answer is not None:
+                # the question is answered from L1 by its text next time
+                self._l1_put(key, vector, answer)
+        with self._lock:
+            self._stats.update(lookups=1, **{tier if answer is not None else "misses": 1})
+        return answer
+
+    def update(self, index_name: str, question: str, answer: str):
+        question = normalize_text(question)
+        try:
+            vector = self._embed(question)
+            scope = self._scope(index_name)
+            self._l1_put((scope, question), vector, answer)
+            self._l2_put(scope, question, vector, answer)
+        except Exception as e:
+            print(f"[rag - llm cache] update failed: {e}")
+
+    def stats(self):
+        """The number of lookups, of hits in every tier, and the hit rate since the cache was created."""
+        with self._lock:
+            stats = dict(self._stats, size=len(self._entries))
+        hits = sum(stats.get(tier, 0) for tier in ["l1_exact_hits", "l1_semantic_hits", "l2_hits"])
+        stats.setdefault("lookups", 0)
+        stats["hit_rate"] = hits / stats["lookups"] if stats["lookups"] else 0.0
+        return stats
+
+    def cached(self, chain: Runnable, index_name: str):
+        """`chain` answering a question from the cache when it can, its streamed answers are cached once complete."""
+
+        def answer(question: str):
+            cached_answer = self.lookup(index_name, question)
+            if cached_answer is not None:
+                return cached_answer
+
+            def store(chunks):
+                answer = []
+                for chunk in chunks:
+                    answer.append(chunk)
+                    yield chunk
+                self.update(index_name, question, "".join(answer))
+
+            # langserve serves the chain through its async methods
+            async def astore(chunks):
+                answer = []
+                async for chunk in chunks:
+                    answer.append(chunk)
+                    yield chunk
+                # the answer is embedded and stored in Redis off the event loop
+                await asyncio.get_running_loop().run_in_executor(
+                    None, self.update, index_name, question, "".join(answer)
+                )
+
+            return chain | RunnableGenerator(store, astore)
+
+        return RunnableLambda(answer)
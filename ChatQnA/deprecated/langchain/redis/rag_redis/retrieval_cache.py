@@ -0,0 +1,90 @@
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: Apache-2.0
+
+import threading
+import time
+from collections import Counter, OrderedDict
+
+from rag_redis.config import RETRIEVAL_CACHE_SIZE, RETRIEVAL_CACHE_TTL
+from rag_redis.embedding_cache import normalize_text
+from rag_redis.response_cache import GENERATION_REFRESH, generation_key
+
+
+class RetrievalCache:
+    """The ids and scores of the chunks retrieved for the last `maxsize` queries, kept in process.
+
+    Results are keyed by index, by the generation of the index, by normalized query and by search
+    parameters, and expire after `ttl` seconds. The generation of an index is read from Redis, at
+    most every GENERATION_REFRESH seconds, and is incremented by `invalidate_answers` once the
+    index was ingested, so the results cached before are never returned again and age out of the
+    LRU. The chunks of a hit are fetched by id, and results whose chunks are gone are discarded.
+    """
+
+    def __init__(self, redis_client, maxsize: int = RETRIEVAL_CACHE_SIZE, ttl: float = RETRIEVAL_CACHE_TTL):
+        assert maxsize > 0, "maxsize should be positive"
+        self.redis = redis_client
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # key -> (results, expiry time), least recently used first
+        self._entries = OrderedDict()
+        self._generations = {}
+        self._stats = Counter()
+
+    def _generation(self, index_name: str):
+        now = time.monotonic()
+        with self._lock:
+            cached = self._generations.get(index_name)
+        if cached is not None and now - cached[1] < GENERATION_REFRESH:
+            return cached[0]
+        generation = int(self.redis.get(generation_key(index_name)) or 0)
+        with self._lock:
+            self._generations[index_name] = (generation, now)
+        return generation
+
+    def key(self, index_name: str, query: str, search_params: tuple):
+        """The key of the results of `query` on the current generation of `index_name`, None if it is unknown."""
+        try:
+            generation = self._generation(index_name)
+        except Exception as e:
+            print(f"[rag - retrieval cache] generation lookup failed: {e}")
+            return None
+        return (index_name, generation, normalize_text(query), search_params)
+
+    def get(self, key):
+        """The cached (chunk id, score) results of `key`, best first, None on a miss."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] < time.monotonic():
+                del self._entries[key]
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+            self._stats["hits" if entry is not None else "misses"] += 1
+        return entry[0] if entry is not None else None
+
+    def put(self, key, results):
+        with self._lock:
+            self._entries[key] = (tuple(results), time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def discard(self, key):
+        """Drop the results of `key` whose chunks could not all be fetched, they are retrieved again."""
+        with self._lock:
+            self._entries.pop(key, None)
+            self._stats["stale"] += 1
+
+    def stats(self):
+        """The number of lookups, of hits, and the hit rate since the cache was created."""
+        with self._lock:
+            hits, misses, stale = self._stats["hits"], self._stats["misses"], self._stats["stale"]
+            size = len(self._entries)
+        return {
+            "lookups": hits + misses,
+            "hits": hits - stale,
+            "misses": misses + stale,
+            "hit_rate": (hits - stale) / (hits + misses) if hits + misses else 0.0,
+            "size": size,
+        }
@@ -0,0 +1,8 @@
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: Apache-2.0
+
+import os
+import sys
+
+# the rag_redis package is imported from the redis folder, as by the ingest scripts
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
@@ -0,0 +1,75 @@
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: Apache-2.0
+
+import asyncio
+
+from langchain_core.embeddings import Embeddings
+from langchain_core.runnables import RunnableGenerator
+from rag_redis.response_cache import SemanticResponseCache
+
+
+class LengthEmbeddings(Embeddings):
+    def embed_documents(self, texts):
+        return [self.embed_query(text) for text in texts]
+
+    def embed_query(self, text):
+        return [float(len(text)), 1.0]
+
+
+class FakeRedis:
+    """The Redis commands of the cache, with an L2 tier that never answers."""
+
+    def get(self, key):
+        return None
+
+    def pipeline(self, transaction=True):
+        return self
+
+    def hset(self, key, mapping):
+        pass
+
+    def expire(self, key, ttl):
+        pass
+
+    def execute(self):
+        pass
+
+    def execute_command(self, *args):
+        return [0]
+
+
+ANSWER = ["OPEA ", "is ", "open."]
+
+
+def llm(chunks):
+    for _ in chunks:
+        yield from ANSWER
+
+
+async def allm(chunks):
+    async for _ in chunks:
+        for chunk in ANSWER:
+            yield chunk
+
+
+def cached_chain():
+    cache = SemanticResponseCache(LengthEmbeddings(), FakeRedis(), l1_size=8)
+    return cache, cache.cached(RunnableGenerator(llm, allm), "rag-redis")
+
+
+async def collect(stream):
+    return [chunk async for chunk in stream]
+
+
+def test_ainvoke_stores_then_answers_from_cache():
+    cache, chain = cached_chain()
+    assert asyncio.run(chain.ainvoke("What is OPEA?")) == "OPEA is open."
+    assert asyncio.run(chain.ainvoke("What is OPEA?")) == "OPEA is open."
+    assert cache.stats()["misses"] == 1 and cache.stats()["l1_exact_hits"] == 1
+
+
+def test_astream_stores_then_answers_from_cache():
+    cache, chain = cached_chain()
+    assert asyncio.run(collect(chain.astream("What is OPEA?"))) == ANSWER
+    assert "".join(asyncio.run(collect(chain.astream("What is OPEA?")))) == "OPEA is open."
+    assert cache.stats()["misses"] == 1 and cache.stats()["l1_exact_hits"] == 1
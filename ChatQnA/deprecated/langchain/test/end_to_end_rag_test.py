@@ -24,6 +24,7 @@ from langchain_core.language_models.llms import LLM
 from langchain_core.prompt_values import ChatPromptValue
 from langchain_openai import ChatOpenAI
 from langsmith.client import Client
+from rag_redis.embedding_cache import CachedEmbeddings, EmbeddingCache
 from transformers import AutoTokenizer, LlamaForCausalLM
 
 # Parameters and settings
@@ -70,10 +71,20 @@ def format_docs(docs: Sequence[Document]) -> str:
     return f"<documents>\n{formatted_str}\n</documents>"
 
 
-def ingest_dataset(args, langchain_docs):
+def create_embedder(args):
+    """TEI embeddings behind an LRU cache, and the Redis of the vector DB with --embedding_cache_redis."""
+    redis_client = None
+    if args.embedding_cache_redis:
+        import redis
+
+        redis_client = redis.Redis.from_url(args.db_url)
+    cache = EmbeddingCache(args.embedding_endpoint_url, args.embedding_cache_size, redis_client)
+    return CachedEmbeddings(HuggingFaceHubEmbeddings(model=args.embedding_endpoint_url), cache)
+
+
+def ingest_dataset(args, langchain_docs, embedder):
     clone_public_dataset(langchain_docs.dataset_id, dataset_name=langchain_docs.name)
     docs = list(langchain_docs.get_docs())
-    embedder = HuggingFaceHubEmbeddings(model=args.embedding_endpoint_url)
 
     _ = Redis.from_texts(
         # appending this little bit can sometimes help with semantic retrieval
@@ -93,8 +104,7 @@ def GetLangchainDataset(args):
     return langchain_docs
 
 
-def buildchain(args):
-    embedder = HuggingFaceHubEmbeddings(model=args.embedding_endpoint_url)
+def buildchain(args, embedder):
     vectorstore = Redis.from_existing_index(
         embedding=embedder, index_name=args.db_index, schema=args.db_schema, redis_url=args.db_url
     )
@@ -223,16 +233,26 @@ if __name__ == "__main__":
 
     parser.add_argument("-dbi", "--db_index", type=str, required=True, help="Vector DB Index Name")
 
+    parser.add_argument(
+        "-ecs", "--embedding_cache_size", type=int, default=10000, required=False, help="Embeddings cached in process"
+    )
+
+    parser.add_argument(
+        "-ecr", "--embedding_cache_redis", action="store_true", help="Also cache the embeddings in the Vector DB Redis"
+    )
+
     args = parser.parse_args()
+    embedder = create_embedder(args)
 
     if args.ingest_dataset:
         langchain_doc = GetLangchainDataset(args)
-        ingest_dataset(args, langchain_doc)
+        ingest_dataset(args, langchain_doc, embedder)
 
     tokenizer = AutoTokenizer.from_pretrained(args.model_name)
     os.environ["LANGCHAIN_ENDPOINT"] = "https://api.smith.langchain.com"
     os.environ["LANGCHAIN_API_KEY"] = args.langchain_token
     os.environ["HUGGINGFACEHUB_API_TOKEN"] = args.huggingface_token
 
-    chain = buildchain(args)
+    chain = buildchain(args, embedder)
     run_test(args, chain)
+    print("Embedding cache:", embedder.stats())
@@ -11,6 +11,7 @@ from fastapi import APIRouter, FastAPI, HTTPException, Request
 from fastapi.responses import StreamingResponse
 from langchain_community.llms import HuggingFaceEndpoint
 from prompts import codetrans_prompt_template
+from sse import SSEEncoder, format_bytes_repr
 from starlette.middleware.cors import CORSMiddleware
 
 app = FastAPI()
@@ -25,6 +26,7 @@ app.add_middleware(
 
 TGI_ENDPOINT = os.getenv("TGI_ENDPOINT", "http://localhost:8080")
 SERVICE_PORT = int(os.getenv("SERVER_PORT", 8000))
+SSE_FLUSH_INTERVAL = float(os.getenv("SSE_FLUSH_INTERVAL_MS", 20)) / 1000
 
 
 class CodeTranslationAPIRouter(APIRouter):
@@ -68,10 +70,10 @@ class CodeTranslationAPIRouter(APIRouter):
         print(f"[codetrans - stream] prompt:{prompt}")
 
         async def stream_generator():
-            for chunk in self.llm.stream(prompt):
-                chunk_repr = repr(chunk.encode("utf-8"))
-                print(f"[codetrans - stream] data: {chunk_repr}")
-                yield f"data: {chunk_repr}\n\n"
+            encoder = SSEEncoder(flush_interval=SSE_FLUSH_INTERVAL, formatter=format_bytes_repr)
+            async for frame in encoder.aencode(self.llm.astream(prompt)):
+                print(f"[codetrans - stream] {frame.strip()}")
+                yield frame
             yield "data: [DONE]\n\n"
 
         return StreamingResponse(stream_generator(), media_type="text/event-stream")
@@ -5,6 +5,7 @@
 
 #
 
+import asyncio
 import os
 import shutil
 import sys
@@ -21,6 +22,7 @@ from langchain_community.embeddings import HuggingFaceInstructEmbeddings
 from langchain_community.llms import HuggingFaceEndpoint
 from langchain_community.utilities import GoogleSearchAPIWrapper
 from langchain_community.vectorstores import Chroma
+from sse import SSEEncoder, format_legacy
 from starlette.middleware.cors import CORSMiddleware
 
 set_debug(True)
@@ -36,6 +38,7 @@ app.add_middleware(
 
 TGI_ENDPOINT = os.getenv("TGI_ENDPOINT", "http://localhost:8080")
 SHOW_INTERMEDIATE_LOG = os.getenv("SHOW_INTERMEDIATE_LOG", "True").lower() in ("true", "1")
+SSE_FLUSH_INTERVAL = float(os.getenv("SSE_FLUSH_INTERVAL_MS", 20)) / 1000
 
 
 class QueueCallbackHandler(BaseCallbackHandler):
@@ -185,24 +188,43 @@ async def web_search_chat_stream(request: Request):
             except Queue.Empty:
                 continue
 
-    def stream_generator():
-        import codecs
-
+    async def stream_generator():
         chat_response = ""
-        for res_dict in stream_callback(query={"question": query}):
-            text = res_dict["answer"]
-            chat_response += text
-            if text == " ":
-                yield "data: @#$\n\n"
-                continue
-            # if text.isspace():
-            #     continue
-            if "\n" in text or "\r" in text:
-                text = text.replace("\n", "<br/>").replace(" ", "@#$")
-                yield f"data: {text}\n\n"
-                continue
-            text = text.replace(" ", "@#$")
-            yield f"data: {text}\n\n"
+        loop = asyncio.get_running_loop()
+        token_queue = asyncio.Queue()
+
+        def forward_tokens():
+            # the chain runs in threads, its tokens are handed over to the event loop
+            try:
+                for res_dict in stream_callback(query={"question": query}):
+                    loop.call_soon_threadsafe(token_queue.put_nowait, res_dict["answer"])
+            except Exception as e:
+                loop.call_soon_threadsafe(token_queue.put_nowait, e)
+            finally:
+                # the stream always ends, even if the chain failed
+                loop.call_soon_threadsafe(token_queue.put_nowait, None)
+
+        Thread(target=forward_tokens, daemon=True).start()
+        error = None
+
+        async def tokens():
+            nonlocal chat_response, error
+            while True:
+                token = await token_queue.get()
+                if token is None:
+                    break
+                if isinstance(token, Exception):
+                    error = token
+                    continue
+                chat_response += token
+                yield token
+
+        # the buffered tokens are flushed on time even if the next token is late
+        async for frame in SSEEncoder(flush_interval=SSE_FLUSH_INTERVAL).aencode(tokens()):
+            yield frame
+        if error is not None:
+            print(f"LLM chain error: {error}")
+            yield f"data: {format_legacy('Internal Server Error')}\n\n"
         chat_response = chat_response.split("</s>")[0]
         print(f"\n\n[rag - chat_stream] stream response: {chat_response}\n\n")
         yield "data: [DONE]\n\n"